@@ -0,0 +1,590 @@
+import os
+import re
+import time
+import random
+import threading
+from collections import deque, Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from json_extract import first_json_value
+
+# Concurrent provider calls (also the size of the map()/submit() pool)
+AI_EXECUTOR_WORKERS = int(os.getenv("AI_EXECUTOR_WORKERS", "8"))
+# Retries per provider on 429 / 5xx / connection errors, with jittered exponential backoff
+AI_MAX_RETRIES = int(os.getenv("AI_MAX_RETRIES", "3"))
+AI_BACKOFF_BASE = float(os.getenv("AI_BACKOFF_BASE", "1.0"))
+AI_BACKOFF_MAX = float(os.getenv("AI_BACKOFF_MAX", "30"))
+# Circuit breaker: open after this many consecutive failures, probe again after the timeout
+AI_CIRCUIT_FAILURES = int(os.getenv("AI_CIRCUIT_FAILURES", "5"))
+AI_CIRCUIT_RESET_SECONDS = float(os.getenv("AI_CIRCUIT_RESET_SECONDS", "60"))
+# Longest a call waits for rate-limit tokens before falling through to the next provider
+AI_RATE_LIMIT_WAIT = float(os.getenv("AI_RATE_LIMIT_WAIT", "30"))
+# Output tokens charged against TPM limits on top of the prompt estimate
+AI_EXPECTED_OUTPUT_TOKENS = 300
+# Latency-aware routing: EWMA smoothing, error-rate ceiling for a "healthy" provider,
+# and the latency assumed for a provider/model that has no samples yet
+AI_EWMA_ALPHA = float(os.getenv("AI_EWMA_ALPHA", "0.2"))
+AI_ROUTING_MAX_ERROR_RATE = float(os.getenv("AI_ROUTING_MAX_ERROR_RATE", "0.5"))
+AI_ROUTING_DEFAULT_LATENCY_MS = 3000
+# Share of routed calls sent to a random other healthy provider so its latency stays current
+AI_ROUTING_EXPLORE_RATE = float(os.getenv("AI_ROUTING_EXPLORE_RATE", "0.05"))
+# Hedge delay (seconds) used until a provider has enough samples for a p95
+AI_HEDGE_DEFAULT_DELAY = float(os.getenv("AI_HEDGE_DEFAULT_DELAY", "4"))
+AI_HEDGE_MIN_SAMPLES = 10
+
+_STATUS_RE = re.compile(r'\b(429|5\d\d)\b')
+_RETRYABLE_TEXT = ('rate limit', 'resource exhausted', 'resourceexhausted', 'quota', 'overloaded',
+                   'unavailable', 'timed out', 'timeout', 'connection')
+
+
+class AIExecutorError(Exception):
+    """Raised when every provider failed, was throttled or had its circuit open."""
+
+    def __init__(self, message, errors=None):
+        super().__init__(message)
+        self.errors = errors or {}
+
+
+def estimate_tokens(text):
+    return len(text or '') // 4 + 1
+
+
+def error_status(exc):
+    """Best-effort HTTP status of a provider SDK exception."""
+    for attr in ('status_code', 'code', 'status'):
+        value = getattr(exc, attr, None)
+        if isinstance(value, int):
+            return value
+    response = getattr(exc, 'response', None)
+    if isinstance(getattr(response, 'status_code', None), int):
+        return response.status_code
+    match = _STATUS_RE.search(str(exc))
+    return int(match.group(1)) if match else None
+
+
+def is_retryable_error(exc):
+    status = error_status(exc)
+    if status is not None:
+        return status == 429 or status >= 500
+    text = f"{type(exc).__name__} {exc}".lower()
+    return any(t in text for t in _RETRYABLE_TEXT)
+
+
+def retry_after_seconds(exc):
+    response = getattr(exc, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+def contains_json(text):
+    """True if the text holds a parseable JSON object or array (fences allowed)."""
+    return first_json_value(text) is not None
+
+
+def backoff_delay(attempt, base=None, cap=None):
+    """Full-jitter exponential backoff."""
+    base = AI_BACKOFF_BASE if base is None else base
+    cap = AI_BACKOFF_MAX if cap is None else cap
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class TokenBucket:
+    """Refilling token bucket; `rate_per_minute` tokens are added per minute up to `capacity`."""
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(capacity or rate_per_minute)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, amount=1):
+        """Take tokens if available. Returns 0 on success, else the seconds to wait."""
+        amount = min(float(amount), self.capacity)
+        with self.lock:
+            self._refill(time.monotonic())
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return 0
+            return (amount - self.tokens) / self.rate if self.rate > 0 else float('inf')
+
+    def acquire(self, amount=1, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self.try_acquire(amount)
+            if wait == 0:
+                return True
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or wait > remaining:
+                    return False
+                wait = min(wait, remaining)
+            time.sleep(min(wait, 1.0))
+
+    def refund(self, amount=1):
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+    def available(self):
+        with self.lock:
+            self._refill(time.monotonic())
+            return self.tokens
+
+
+class LatencyTracker:
+    """EWMA latency and error rate for one provider/model, plus a recent window for p95."""
+
+    def __init__(self, alpha=None, window=200):
+        self.alpha = alpha or AI_EWMA_ALPHA
+        self.latency_ms = None
+        self.error_rate = 0.0
+        self.samples = 0
+        self.errors = 0
+        self.recent = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def record(self, latency_ms, ok):
+        with self.lock:
+            self.samples += 1
+            self.error_rate = self.alpha * (0.0 if ok else 1.0) + (1 - self.alpha) * self.error_rate
+            if not ok:
+                self.errors += 1
+                return
+            self.recent.append(latency_ms)
+            if self.latency_ms is None:
+                self.latency_ms = latency_ms
+            else:
+                self.latency_ms = self.alpha * latency_ms + (1 - self.alpha) * self.latency_ms
+
+    def percentile(self, pct):
+        with self.lock:
+            values = sorted(self.recent)
+        if not values:
+            return None
+        return round(values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))])
+
+    def snapshot(self):
+        return {
+            'samples': self.samples,
+            'errors': self.errors,
+            'ewma_latency_ms': round(self.latency_ms) if self.latency_ms is not None else None,
+            'ewma_error_rate': round(self.error_rate, 4),
+            'p50_ms': self.percentile(50),
+            'p95_ms': self.percentile(95),
+        }
+
+
+class CircuitBreaker:
+    """closed -> open after `failure_threshold` consecutive failures -> half_open after
+    `reset_timeout` seconds (one probe call) -> closed on success / open on failure."""
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, failure_threshold=None, reset_timeout=None):
+        self.failure_threshold = failure_threshold or AI_CIRCUIT_FAILURES
+        self.reset_timeout = AI_CIRCUIT_RESET_SECONDS if reset_timeout is None else reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self.probe_in_flight = False
+            if self.state == self.HALF_OPEN and not self.probe_in_flight:
+                self.probe_in_flight = True
+                return True
+            return False
+
+    def release_probe(self):
+        """Give back a half-open probe slot that was not used for a call."""
+        with self.lock:
+            self.probe_in_flight = False
+
+    def record_success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.probe_in_flight = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.probe_in_flight = False
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    print(f"[AI] Circuit opened after {self.failures} failure(s)")
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+class AIProvider:
+    """One LLM backend.
+
+    call(prompt, temperature) -> response text, or (text, usage) where usage
+        may hold the provider-reported 'prompt_tokens' / 'response_tokens'
+    available() -> bool (e.g. API key configured and client loaded)
+    cache_model() -> model identifier used in response cache keys
+    """
+
+    def __init__(self, name, call, available=None, cache_model=None, rpm=None, tpm=None):
+        self.name = name
+        self.call = call
+        self.available = available or (lambda: True)
+        self.cache_model = cache_model or (lambda: name)
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.breaker = CircuitBreaker()
+        self.stats = {'calls': 0, 'successes': 0, 'failures': 0, 'retries': 0,
+                      'throttled': 0, 'circuit_rejections': 0, 'cache_hits': 0}
+        self.stats_lock = threading.Lock()
+        self.latency = {}
+
+    def count(self, name, n=1):
+        with self.stats_lock:
+            self.stats[name] += n
+
+    def model(self):
+        try:
+            return self.cache_model() or self.name
+        except Exception:
+            return self.name
+
+    def tracker(self, model=None):
+        model = model or self.model()
+        with self.stats_lock:
+            if model not in self.latency:
+                self.latency[model] = LatencyTracker()
+            return self.latency[model]
+
+    def health(self):
+        """Routing view of this provider's current model."""
+        tracker = self.tracker()
+        has_capacity = not self.requests or self.requests.available() >= 1
+        healthy = self.breaker.state != CircuitBreaker.OPEN and tracker.error_rate < AI_ROUTING_MAX_ERROR_RATE
+        return healthy, has_capacity, tracker
+
+    def hedge_delay(self):
+        tracker = self.tracker()
+        p95 = tracker.percentile(95) if len(tracker.recent) >= AI_HEDGE_MIN_SAMPLES else None
+        return p95 / 1000.0 if p95 else AI_HEDGE_DEFAULT_DELAY
+
+    def acquire(self, prompt, timeout):
+        """Reserve one request and the estimated tokens; False if the limits can't be met in time."""
+        if self.requests and not self.requests.acquire(1, timeout):
+            return False
+        if self.tokens and not self.tokens.acquire(estimate_tokens(prompt) + AI_EXPECTED_OUTPUT_TOKENS, timeout):
+            if self.requests:
+                self.requests.refund(1)
+            return False
+        return True
+
+
+class AIExecutor:
+    """Rate-limited, retrying, circuit-breaking front end for several LLM providers.
+
+    call() runs on the calling thread; submit()/map() fan out over a bounded
+    thread pool. Providers are tried in order, falling through on exhausted
+    retries, throttling or an open circuit.
+    """
+
+    def __init__(self, providers, max_workers=None, max_retries=None, cache=None, rate_limit_wait=None, ledger=None):
+        self.providers = {p.name: p for p in providers}
+        self.order = [p.name for p in providers]
+        self.max_workers = max_workers or AI_EXECUTOR_WORKERS
+        self.max_retries = AI_MAX_RETRIES if max_retries is None else max_retries
+        self.rate_limit_wait = AI_RATE_LIMIT_WAIT if rate_limit_wait is None else rate_limit_wait
+        self.cache = cache
+        self.ledger = ledger
+        self.in_flight = threading.BoundedSemaphore(self.max_workers)
+        self._pool = None
+        self._hedge_pool = None
+        self._pool_lock = threading.Lock()
+        # Guards decisions, served and hedges (written by pool threads, read by routing_stats)
+        self.lock = threading.Lock()
+        self.decisions = deque(maxlen=100)
+        self.served = Counter()
+        self.hedges = Counter()
+
+    def _services(self, services):
+        if isinstance(services, str):
+            services = [services]
+        services = list(services or self.order)
+        return [s for s in services if s in self.providers]
+
+    def route(self, services=None, explore=False):
+        """Order providers for a call: healthy ones with spare request quota first,
+        then by EWMA latency; the caller's order breaks ties and places providers
+        that have no latency samples yet.
+
+        With explore=True a small share of calls (AI_ROUTING_EXPLORE_RATE) puts
+        another healthy provider first so slower ones keep being measured.
+        """
+        names = self._services(services)
+        ranks = {}
+
+        def rank(item):
+            index, name = item
+            healthy, has_capacity, tracker = self.providers[name].health()
+            latency = tracker.latency_ms if tracker.latency_ms is not None else AI_ROUTING_DEFAULT_LATENCY_MS
+            ranks[name] = (not healthy, not has_capacity, latency, index)
+            return ranks[name]
+
+        order = [name for _, name in sorted(enumerate(names), key=rank)]
+        if explore and len(order) > 1 and random.random() < AI_ROUTING_EXPLORE_RATE:
+            candidates = [n for n in order[1:] if not ranks[n][0] and not ranks[n][1]]
+            if candidates:
+                pick = random.choice(candidates)
+                order.remove(pick)
+                order.insert(0, pick)
+        return order
+
+    def _record_decision(self, requested, order, served_by, started, hedged=False):
+        decision = {
+            'at': round(time.time(), 3),
+            'requested': requested,
+            'order': order,
+            'served_by': served_by,
+            'hedged': hedged,
+            'latency_ms': round((time.perf_counter() - started) * 1000),
+        }
+        with self.lock:
+            self.served[served_by] += 1
+            self.decisions.append(decision)
+
+    def call(self, prompt, services=None, temperature=None, use_cache=True, route=False):
+        """Return (text, provider_name) from the first provider that succeeds.
+
+        With route=True the providers are re-ordered by route() first and the
+        decision is recorded for routing_stats().
+        """
+        started = time.perf_counter()
+        requested = self._services(services)
+        order = self.route(requested, explore=True) if route else requested
+        text, name = self._call_in_order(prompt, order, temperature, use_cache)
+        if route:
+            self._record_decision(requested, order, name, started)
+        return text, name
+
+    def _call_in_order(self, prompt, services, temperature, use_cache):
+        errors = {}
+        for name in services:
+            provider = self.providers[name]
+            try:
+                if not provider.available():
+                    continue
+            except Exception as e:
+                errors[name] = e
+                continue
+
+            key = None
+            if self.cache is not None:
+                key, cached = self.cache.lookup(provider.cache_model(), prompt, temperature, use_cache)
+                if cached is not None:
+                    provider.count('cache_hits')
+                    self._record(provider, prompt, cached, 0, cache_hit=True)
+                    return cached, name
+
+            try:
+                text = self._call_provider(provider, prompt, temperature)
+            except Exception as e:
+                errors[name] = e
+                continue
+            if key and text:
+                self.cache.put(key, provider.cache_model(), text)
+            return text, name
+
+        detail = '; '.join(f"{n}: {e}" for n, e in errors.items()) or 'no provider available'
+        raise AIExecutorError(f"All AI providers failed ({detail})", errors)
+
+    def _call_provider(self, provider, prompt, temperature):
+        for attempt in range(self.max_retries + 1):
+            if not provider.breaker.allow():
+                provider.count('circuit_rejections')
+                raise AIExecutorError(f"{provider.name} circuit open")
+            if not provider.acquire(prompt, self.rate_limit_wait):
+                provider.count('throttled')
+                provider.breaker.release_probe()
+                raise AIExecutorError(f"{provider.name} rate limit reached")
+
+            provider.count('calls')
+            tracker = provider.tracker()
+            started = time.perf_counter()
+            try:
+                with self.in_flight:
+                    result = provider.call(prompt, temperature)
+            except Exception as e:
+                elapsed_ms = (time.perf_counter() - started) * 1000
+                tracker.record(elapsed_ms, ok=False)
+                provider.count('failures')
+                self._record(provider, prompt, None, elapsed_ms, error=e)
+                if not is_retryable_error(e):
+                    # The provider answered; the request itself was bad
+                    provider.breaker.release_probe()
+                    raise
+                provider.breaker.record_failure()
+                if attempt >= self.max_retries:
+                    raise
+                delay = retry_after_seconds(e) or backoff_delay(attempt)
+                provider.count('retries')
+                print(f"[AI] {provider.name} error ({error_status(e) or type(e).__name__}); retrying in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            text, usage = result if isinstance(result, tuple) else (result, None)
+            tracker.record(elapsed_ms, ok=True)
+            provider.count('successes')
+            provider.breaker.record_success()
+            self._record(provider, prompt, text, elapsed_ms, usage=usage)
+            return text
+
+    def _record(self, provider, prompt, text, latency_ms, usage=None, cache_hit=False, error=None):
+        """Ledger row for one provider request or cache hit (token counts estimated if not reported)."""
+        if self.ledger is None:
+            return
+        usage = usage or {}
+        try:
+            self.ledger.record(
+                provider.name, provider.model(),
+                prompt_tokens=usage.get('prompt_tokens') or estimate_tokens(prompt),
+                response_tokens=usage.get('response_tokens') or (estimate_tokens(text) if text else 0),
+                latency_ms=latency_ms, status='error' if error else 'success',
+                cache_hit=cache_hit, error=error)
+        except Exception as e:
+            print(f"[AI] ledger record failed: {e}")
+
+    def call_hedged(self, prompt, services=None, temperature=None, use_cache=True, validate=None):
+        """Routed call that also fires the runner-up provider if the first one has not
+        answered within its p95 latency (or failed / answered invalidly).
+
+        The first answer accepted by `validate(text)` wins (any answer if
+        validate is None); the slower request is left to finish in the background.
+        """
+        started = time.perf_counter()
+        requested = self._services(services)
+        order = self.route(requested, explore=True)
+        if len(order) < 2:
+            return self.call(prompt, order, temperature, use_cache, route=True)
+
+        primary, secondary = order[0], order[1]
+        pool = self._get_hedge_pool()
+        futures = {pool.submit(self._bind(self._call_in_order), prompt, [primary], temperature, use_cache): primary}
+        pending = set(futures)
+        deadline = time.monotonic() + self.providers[primary].hedge_delay()
+        hedged = False
+        fallback, errors = None, {}
+
+        while pending:
+            timeout = None if hedged else max(0, deadline - time.monotonic())
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    text, name = future.result()
+                except Exception as e:
+                    errors[futures[future]] = e
+                    continue
+                if validate is None or validate(text):
+                    self._record_decision(requested, order, name, started, hedged)
+                    return text, name
+                fallback = fallback or (text, name)
+            if not hedged:
+                hedged = True
+                with self.lock:
+                    self.hedges[secondary] += 1
+                future = pool.submit(self._bind(self._call_in_order), prompt, [secondary], temperature, use_cache)
+                futures[future] = secondary
+                pending.add(future)
+
+        if fallback:
+            self._record_decision(requested, order, fallback[1], started, hedged)
+            return fallback
+        rest = [n for n in order if n not in (primary, secondary)]
+        if rest:
+            text, name = self._call_in_order(prompt, rest, temperature, use_cache)
+            self._record_decision(requested, order, name, started, hedged)
+            return text, name
+        detail = '; '.join(f"{n}: {e}" for n, e in errors.items()) or 'no provider available'
+        raise AIExecutorError(f"All AI providers failed ({detail})", errors)
+
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='ai-exec')
+            return self._pool
+
+    def _get_hedge_pool(self):
+        # Separate from the map() pool so a hedged call made inside a map() worker can't deadlock
+        with self._pool_lock:
+            if self._hedge_pool is None:
+                self._hedge_pool = ThreadPoolExecutor(max_workers=self.max_workers * 2, thread_name_prefix='ai-hedge')
+            return self._hedge_pool
+
+    def submit(self, prompt, services=None, temperature=None, use_cache=True):
+        return self._get_pool().submit(self._bind(self.call), prompt, services, temperature, use_cache)
+
+    def _bind(self, fn):
+        """Carry the caller's ledger agent name over to a pool thread."""
+        return self.ledger.bind(fn) if self.ledger is not None else fn
+
+    def map(self, prompts, services=None, temperature=None, use_cache=True):
+        """Run many prompts concurrently. Returns results in input order; each item is
+        (text, provider_name) or the exception raised for that prompt."""
+        futures = [self.submit(p, services, temperature, use_cache) for p in prompts]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def stats(self):
+        out = {}
+        for name in self.order:
+            provider = self.providers[name]
+            with provider.stats_lock:
+                stats = dict(provider.stats)
+            stats['circuit'] = provider.breaker.state
+            if provider.requests:
+                stats['rpm_tokens_available'] = round(provider.requests.tokens, 1)
+            if provider.tokens:
+                stats['tpm_tokens_available'] = round(provider.tokens.tokens)
+            out[name] = stats
+        return out
+
+    def routing_stats(self, services=None):
+        providers = {}
+        for name in self.order:
+            provider = self.providers[name]
+            healthy, has_capacity, _ = provider.health()
+            with provider.stats_lock:
+                models = dict(provider.latency)
+            providers[name] = {
+                'model': provider.model(),
+                'healthy': healthy,
+                'has_capacity': has_capacity,
+                'circuit': provider.breaker.state,
+                'hedge_delay_s': round(provider.hedge_delay(), 3),
+                'models': {m: t.snapshot() for m, t in models.items()},
+            }
+        with self.lock:
+            served, hedges, decisions = dict(self.served), dict(self.hedges), list(self.decisions)[-20:]
+        return {
+            'current_route': self.route(services),
+            'served': served,
+            'hedges_fired': hedges,
+            'providers': providers,
+            'recent_decisions': decisions,
+        }
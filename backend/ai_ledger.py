@@ -0,0 +1,225 @@
+import os
+import json
+import threading
+from collections import deque, defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+
+import db
+
+# Set AI_LEDGER_ENABLED=false to stop recording AI calls
+AI_LEDGER_ENABLED = os.getenv("AI_LEDGER_ENABLED", "true").lower() not in ("0", "false", "no")
+# Buffered rows are written when this many are pending, or every FLUSH_INTERVAL seconds
+AI_LEDGER_FLUSH_SIZE = int(os.getenv("AI_LEDGER_FLUSH_SIZE", "100"))
+AI_LEDGER_FLUSH_INTERVAL = float(os.getenv("AI_LEDGER_FLUSH_INTERVAL", "5"))
+# Rows kept in memory while the database is unreachable (oldest dropped first)
+AI_LEDGER_MAX_BUFFER = int(os.getenv("AI_LEDGER_MAX_BUFFER", "10000"))
+# Optional pricing for cost estimates: {"<model or provider>": [usd_per_1m_input, usd_per_1m_output]}
+try:
+    AI_PRICING = json.loads(os.getenv("AI_PRICING", "{}"))
+except ValueError:
+    AI_PRICING = {}
+
+STATUS_SUCCESS = 'success'
+STATUS_ERROR = 'error'
+STATUS_PARSE_FAILURE = 'parse_failure'
+UNKNOWN_AGENT = 'unknown'
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def estimate_cost(row):
+    price = AI_PRICING.get(row.get('model')) or AI_PRICING.get(row.get('provider'))
+    if not price or row.get('cache_hit'):
+        return 0.0
+    return ((row.get('prompt_tokens') or 0) * price[0] + (row.get('response_tokens') or 0) * price[1]) / 1e6
+
+
+class AICallLedger:
+    """Buffered recorder of AI calls for the ai_calls table.
+
+    record() only appends to an in-memory buffer; a background thread writes
+    the buffer with multi-row INSERTs. The agent name comes from the
+    innermost agent() context on the calling thread.
+    """
+
+    def __init__(self, flush_size=None, flush_interval=None, max_buffer=None, enabled=None):
+        self.flush_size = flush_size or AI_LEDGER_FLUSH_SIZE
+        self.flush_interval = AI_LEDGER_FLUSH_INTERVAL if flush_interval is None else flush_interval
+        self.enabled = AI_LEDGER_ENABLED if enabled is None else enabled
+        self.buffer = deque(maxlen=max_buffer or AI_LEDGER_MAX_BUFFER)
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.local = threading.local()
+        self._thread = None
+        self.stats = {'recorded': 0, 'written': 0, 'flushes': 0, 'write_errors': 0}
+
+    @contextmanager
+    def agent(self, name):
+        """Attribute AI calls made on this thread inside the block to `name`."""
+        stack = getattr(self.local, 'agents', None)
+        if stack is None:
+            stack = self.local.agents = []
+        stack.append(name)
+        try:
+            yield
+        finally:
+            stack.pop()
+
+    def current_agent(self):
+        stack = getattr(self.local, 'agents', None)
+        return stack[-1] if stack else None
+
+    def bind(self, fn):
+        """Wrap fn so it runs under the caller's agent name on another thread."""
+        name = self.current_agent()
+        if name is None:
+            return fn
+
+        def bound(*args, **kwargs):
+            with self.agent(name):
+                return fn(*args, **kwargs)
+        return bound
+
+    def record(self, provider, model, prompt_tokens=0, response_tokens=0, latency_ms=0,
+               status=STATUS_SUCCESS, cache_hit=False, error=None, agent=None):
+        if not self.enabled:
+            return None
+        row = {
+            'agent': (agent or self.current_agent() or UNKNOWN_AGENT)[:64],
+            'provider': provider,
+            'model': (model or '')[:128],
+            'prompt_tokens': int(prompt_tokens or 0),
+            'response_tokens': int(response_tokens or 0),
+            'latency_ms': int(round(latency_ms or 0)),
+            'status': status,
+            'cache_hit': bool(cache_hit),
+            'error': str(error)[:255] if error else None,
+            'created_at': datetime.now(),
+        }
+        self.local.last = row
+        with self.lock:
+            self.buffer.append(row)
+            self.stats['recorded'] += 1
+            pending = len(self.buffer)
+        self._ensure_thread()
+        if pending >= self.flush_size:
+            self.wakeup.set()
+        return row
+
+    def mark_parse_failure(self):
+        """Record that the last call on this thread returned unparseable output.
+
+        The call's own row may already be flushed, so this adds a separate
+        parse_failure event for the same agent, provider and model.
+        """
+        row = getattr(self.local, 'last', None)
+        if row is None:
+            return None
+        self.record(row['provider'], row['model'], status=STATUS_PARSE_FAILURE, agent=row['agent'])
+        # One event per call, however many times the caller reports it
+        self.local.last = None
+
+    def _ensure_thread(self):
+        if self._thread is not None:
+            return
+        with self.lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """Write everything buffered; rows stay buffered if the write fails."""
+        with self.flush_lock:
+            with self.lock:
+                rows = list(self.buffer)
+                self.buffer.clear()
+            if not rows:
+                return 0
+            try:
+                written = db.insert_ai_calls_batch(rows)
+            except Exception as e:
+                print(f"[AI-LEDGER] write failed: {e}")
+                written = 0
+                with self.lock:
+                    self.stats['write_errors'] += 1
+            if not written:
+                with self.lock:
+                    # Put them back in front of anything recorded meanwhile
+                    self.buffer.extendleft(reversed(rows))
+                return 0
+            with self.lock:
+                self.stats['written'] += written
+                self.stats['flushes'] += 1
+            return written
+
+    def pending(self):
+        with self.lock:
+            return list(self.buffer)
+
+    def metrics(self, hours=24, limit=50000):
+        """Per-agent calls, failures, cache hits, p50/p95 latency and token totals.
+
+        Read from ai_calls after a flush; if the database is unavailable the
+        unwritten buffer is summarized instead.
+        """
+        self.flush()
+        rows = db.get_ai_calls_since(hours, limit)
+        source = 'db'
+        if rows is None:
+            rows, source = self.pending(), 'buffer'
+        with self.lock:
+            ledger_stats = dict(self.stats, pending=len(self.buffer))
+        return {
+            'source': source,
+            'window_hours': hours,
+            'rows': len(rows),
+            'agents': summarize(rows, 'agent'),
+            'providers': summarize(rows, 'provider'),
+            'ledger': ledger_stats,
+        }
+
+
+def summarize(rows, key):
+    groups = defaultdict(list)
+    for row in rows:
+        groups[row.get(key) or UNKNOWN_AGENT].append(row)
+    out = {}
+    for name, group in groups.items():
+        # parse_failure rows are events about an earlier call, not calls
+        calls = [r for r in group if r.get('status') != STATUS_PARSE_FAILURE]
+        live = [r for r in calls if not r.get('cache_hit')]
+        latencies = [r['latency_ms'] for r in live if r.get('status') != STATUS_ERROR]
+        prompt_tokens = sum(r.get('prompt_tokens') or 0 for r in live)
+        response_tokens = sum(r.get('response_tokens') or 0 for r in live)
+        out[name] = {
+            'calls': len(calls),
+            'errors': sum(1 for r in calls if r.get('status') == STATUS_ERROR),
+            'parse_failures': len(group) - len(calls),
+            'cache_hits': len(calls) - len(live),
+            'cache_hit_rate': round((len(calls) - len(live)) / len(calls), 4) if calls else 0.0,
+            'latency_p50_ms': percentile(latencies, 50),
+            'latency_p95_ms': percentile(latencies, 95),
+            'prompt_tokens': prompt_tokens,
+            'response_tokens': response_tokens,
+            'prompt_tokens_p50': percentile([r.get('prompt_tokens') or 0 for r in live], 50),
+            'prompt_tokens_p95': percentile([r.get('prompt_tokens') or 0 for r in live], 95),
+            'estimated_cost_usd': round(sum(estimate_cost(r) for r in live), 6),
+        }
+    return dict(sorted(out.items(), key=lambda item: -item[1]['calls']))
+
+
+AI_LEDGER = AICallLedger()
@@ -8,19 +8,17 @@ import requests
 import traceback
 import random
 import time
-from datetime import datetime
-import html
+from datetime import datetime, timedelta
 import threading
-import imaplib
-import email
-from email.utils import parseaddr
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib.parse import urlparse
 from bs4 import BeautifulSoup
 from ddgs import DDGS
 from playwright.sync_api import sync_playwright
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from flask import Flask, request, jsonify, Blueprint
+from flask import Flask, request, jsonify, Blueprint, Response, stream_with_context
 from flask_cors import CORS
 # import google.generativeai as genai  # Temporarily commented out due to import issues
 # Ensure a name exists for legacy references to `genai` to avoid NameError
@@ -28,6 +26,22 @@ genai = None
 from dotenv import load_dotenv
 from serpapi import Client
 import db
+import search_filters
+from llm_cache import LLM_CACHE
+from ai_ledger import AI_LEDGER
+from smtp_pool import SMTPConnectionPool
+from brevo_transport import BrevoTransport, BREVO_BATCH_SIZE, TransportError, is_valid_address
+from outbox import OutboxWorkerPool, outbox_item
+from templating import TEMPLATES, SAVED_PLACEHOLDER_RE, text_to_html
+from send_scheduler import SendScheduler
+from reply_monitor import IMAPReplyMonitor
+from reply_index import ReplyIndex
+import prescoring
+import structured_output
+from structured_output import Schema, Field, StructuredOutputError
+from json_extract import iter_json_values, first_json_value
+from ai_executor import AIExecutor, AIProvider, AIExecutorError, contains_json, estimate_tokens
+from query_planner import QueryPlanner, is_dropped
 from justdial_scraper import JustDialScraper
 
 # Optional imports
@@ -114,8 +128,30 @@ db.init_db()
 
 # AI Configuration
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-GEMINI_MODEL = "gemini-pro"  # Updated to supported model
+# Optional pinned Gemini model (e.g. "models/gemini-1.5-flash"); skips list_models()
+GEMINI_MODEL = os.getenv("GEMINI_MODEL")
+GEMINI_MODEL_CACHE_TTL = int(os.getenv("GEMINI_MODEL_CACHE_TTL", "3600"))
+# Batched business analysis: prompt size budget (estimated tokens) and leads per prompt
+AI_BATCH_MAX_PROMPT_TOKENS = int(os.getenv("AI_BATCH_MAX_PROMPT_TOKENS", "6000"))
+AI_BATCH_MAX_LEADS = int(os.getenv("AI_BATCH_MAX_LEADS", "25"))
+AI_BATCH_MAX_RETRIES = int(os.getenv("AI_BATCH_MAX_RETRIES", "2"))
+# Failed analyses (each already retried AI_BATCH_MAX_RETRIES times) before a lead leaves 'new' as 'analysis_failed'
+ANALYSIS_MAX_ATTEMPTS = int(os.getenv("ANALYSIS_MAX_ATTEMPTS", "3"))
+# Batch AI scoring: leads per prompt and how many finished jobs to keep for status polling
+AI_SCORE_BATCH_SIZE = int(os.getenv("AI_SCORE_BATCH_SIZE", "10"))
+AI_SCORE_JOBS_KEEP = int(os.getenv("AI_SCORE_JOBS_KEEP", "20"))
+# Map-reduce extraction (ai-extract, clean-search-results): input tokens per chunk and concurrent chunks
+AI_EXTRACT_CHUNK_TOKENS = int(os.getenv("AI_EXTRACT_CHUNK_TOKENS", "3000"))
+AI_EXTRACT_CONCURRENCY = int(os.getenv("AI_EXTRACT_CONCURRENCY", "4"))
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
+# Per-provider quotas enforced by the AI executor (requests / tokens per minute)
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "60"))
+GEMINI_TPM = int(os.getenv("GEMINI_TPM", "1000000"))
+GROQ_RPM = int(os.getenv("GROQ_RPM", "30"))
+GROQ_TPM = int(os.getenv("GROQ_TPM", "12000"))
+# Route call_ai_service to the fastest healthy provider; optionally hedge slow calls
+AI_ROUTING = os.getenv("AI_ROUTING", "true").lower() not in ("0", "false", "no")
+AI_HEDGING = os.getenv("AI_HEDGING", "false").lower() in ("1", "true", "yes")
 SMTP_EMAIL = os.getenv("SMTP_EMAIL")
 SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")
 SMTP_SERVER = os.getenv("SMTP_SERVER", "smtp.gmail.com")
@@ -133,19 +169,19 @@ IMAP_EMAIL = os.getenv("REPLY_IMAP_EMAIL")
 IMAP_PASSWORD = os.getenv("REPLY_IMAP_PASSWORD")
 IMAP_SERVER = os.getenv("REPLY_IMAP_SERVER", "imap.gmail.com")
 IMAP_POLL_INTERVAL = int(os.getenv("IMAP_POLL_INTERVAL", "300"))
+# settings row holding the monitor's "uidvalidity:last uid" watermark
+IMAP_STATE_SETTING = 'imap_reply_watermark'
 AUTO_FOLLOWUP_INTERVAL = int(os.getenv("AUTO_FOLLOWUP_INTERVAL", "3600"))
 AUTO_FOLLOWUP_DELAY_DAYS = int(os.getenv("AUTO_FOLLOWUP_DELAY_DAYS", "2"))
 OUTREACH_DRY_RUN = os.getenv("OUTREACH_DRY_RUN", "true").lower() in ("1", "true", "yes")
+# AI-mode bulk outreach: concurrent message generations (send rates live in outbox.py)
+BULK_OUTREACH_CONCURRENCY = int(os.getenv("BULK_OUTREACH_CONCURRENCY", "8"))
+# message_type values bulk outreach may log (outreach_logs.type)
+BULK_MESSAGE_TYPES = ('email', 'whatsapp')
 
-# IMAP monitoring status (for debugging)
-LAST_IMAP_CHECK = None
-LAST_IMAP_ERROR = None
+# Last reply matched by the IMAP monitor (for debugging)
 LAST_IMAP_PROCESSED = None
 
-class SafeDict(dict):
-    def __missing__(self, key):
-        return ''
-
 OUTREACH_TEMPLATES = {
     "introduction": {
         "name": "Introduction",
@@ -222,15 +258,38 @@ def get_genai():
             print(f"[ERROR] Gemini configuration error: {e}")
     return genai_client
 
-def get_working_gemini_model():
-    """Get a Gemini model that supports generateContent"""
-    client = get_genai()
-    if not client:
-        return None
+# Resolved Gemini model cache (list_models() is a network round trip)
+GEMINI_MODEL_CACHE = {'name': None, 'resolved_at': 0.0}
+GEMINI_MODEL_NEGATIVE_TTL = 60
+# Models that answered NotFound, skipped until the expiry time: {model_name: expires_at}
+GEMINI_UNAVAILABLE_MODELS = {}
+gemini_model_lock = threading.Lock()
+gemini_unavailable_lock = threading.Lock()
+
+
+def mark_model_unavailable(model_name):
+    with gemini_unavailable_lock:
+        GEMINI_UNAVAILABLE_MODELS[model_name] = time.time() + GEMINI_MODEL_CACHE_TTL
+
+
+def is_model_unavailable(model_name):
+    with gemini_unavailable_lock:
+        expires_at = GEMINI_UNAVAILABLE_MODELS.get(model_name)
+        if expires_at is not None and expires_at <= time.time():
+            # Gemini 404s during rollouts too, so give the model another chance
+            del GEMINI_UNAVAILABLE_MODELS[model_name]
+            expires_at = None
+        return expires_at is not None
+
+
+def _resolve_gemini_model(client):
+    if GEMINI_MODEL and not is_model_unavailable(GEMINI_MODEL):
+        print(f"[OK] Using pinned Gemini model: {GEMINI_MODEL}")
+        return GEMINI_MODEL
     try:
         models = list(client.list_models())
         for model in models:
-            if 'generateContent' in model.supported_generation_methods:
+            if 'generateContent' in model.supported_generation_methods and not is_model_unavailable(model.name):
                 print(f"[OK] Using Gemini model: {model.name}")
                 return model.name
         print("[ERROR] No Gemini model supports generateContent")
@@ -239,6 +298,79 @@ def get_working_gemini_model():
         print(f"[ERROR] Failed to list Gemini models: {e}")
         return None
 
+
+def get_working_gemini_model(force_refresh=False):
+    """Get a Gemini model that supports generateContent
+
+    The resolved name is cached for GEMINI_MODEL_CACHE_TTL seconds (failures
+    for GEMINI_MODEL_NEGATIVE_TTL) so callers don't pay for list_models()
+    on every request.
+    """
+    client = get_genai()
+    if not client:
+        return None
+    with gemini_model_lock:
+        age = time.time() - GEMINI_MODEL_CACHE['resolved_at']
+        ttl = GEMINI_MODEL_CACHE_TTL if GEMINI_MODEL_CACHE['name'] else GEMINI_MODEL_NEGATIVE_TTL
+        if not force_refresh and GEMINI_MODEL_CACHE['resolved_at'] and age < ttl:
+            return GEMINI_MODEL_CACHE['name']
+        GEMINI_MODEL_CACHE['name'] = _resolve_gemini_model(client)
+        GEMINI_MODEL_CACHE['resolved_at'] = time.time()
+        return GEMINI_MODEL_CACHE['name']
+
+
+def is_model_not_found_error(exc):
+    """True for google.api_core NotFound (HTTP 404), matched on type and status code rather than message text."""
+    if any(cls.__name__ == 'NotFound' for cls in type(exc).__mro__):
+        return True
+    code = getattr(exc, 'code', None)
+    if callable(code):
+        return False  # gRPC errors expose code() as a status enum, not an HTTP code
+    return code == 404 or getattr(exc, 'status_code', None) == 404
+
+
+def gemini_generate(prompt, **kwargs):
+    """Run generate_content on the cached working model.
+
+    If the model has gone away (404 / NotFound) it is excluded, the cache is
+    refreshed and the request retried once on the newly resolved model.
+    """
+    client = get_genai()
+    if not client:
+        raise RuntimeError("Gemini client not configured")
+    model_name = get_working_gemini_model()
+    if not model_name:
+        raise RuntimeError("No supported Gemini model available")
+    try:
+        return client.GenerativeModel(model_name).generate_content(prompt, **kwargs)
+    except Exception as e:
+        if not is_model_not_found_error(e):
+            raise
+        print(f"[WARN] Gemini model {model_name} not found; refreshing model cache")
+        mark_model_unavailable(model_name)
+        model_name = get_working_gemini_model(force_refresh=True)
+        if not model_name:
+            raise
+        return client.GenerativeModel(model_name).generate_content(prompt, **kwargs)
+
+
+def gemini_generate_text(prompt, use_cache=True, agent=None):
+    """Gemini response text via the AI executor (rate limits, retries, LLM_CACHE).
+
+    `agent` names the caller in the AI call ledger (default: the enclosing AI_LEDGER.agent()).
+    """
+    with AI_LEDGER.agent(agent or AI_LEDGER.current_agent() or 'gemini_generate_text'):
+        text, _ = AI_EXECUTOR.call(prompt, services='gemini', use_cache=use_cache)
+    return text
+
+
+def warm_gemini_model_cache():
+    """Resolve the Gemini model in the background so the first request doesn't pay for it"""
+    if not GEMINI_API_KEY:
+        return
+    thread = threading.Thread(target=get_working_gemini_model, daemon=True)
+    thread.start()
+
 def get_groq():
     """Lazy load Groq API"""
     global groq_client
@@ -349,8 +481,11 @@ def export_to_google_sheets(leads, sheet_id, sheet_name="Leads"):
         return False
 
 def build_html_body(body, lead_id=None):
-    safe_lines = [html.escape(line) for line in (body or '').split('\n')]
-    paragraphs = ''.join(f"<p>{line}</p>" for line in safe_lines if line.strip() or line == '')
+    return html_document(text_to_html(body), lead_id)
+
+
+def html_document(paragraphs, lead_id=None):
+    """Wrap escaped paragraph HTML (text_to_html / CompiledTemplate.render_html) with the open-tracking pixel"""
     pixel = ''
     if lead_id and TRACKING_HOST:
         pixel_url = f"{TRACKING_HOST.rstrip('/')}/open?lead_id={lead_id}"
@@ -358,84 +493,229 @@ def build_html_body(body, lead_id=None):
     return f"<html><body>{paragraphs}{pixel}</body></html>"
 
 
-def send_email_smtp(to_email, subject, body, html_body, lead_name=None):
-    """Send email via SMTP"""
+smtp_pool = None
+smtp_pool_lock = threading.Lock()
+
+
+def get_smtp_pool():
+    """Lazy load the shared SMTP connection pool (None if SMTP isn't configured)"""
+    global smtp_pool
+    if smtp_pool is None and SMTP_EMAIL and SMTP_PASSWORD and SMTP_SERVER and SMTP_PORT:
+        with smtp_pool_lock:
+            if smtp_pool is None:
+                smtp_pool = SMTPConnectionPool(SMTP_SERVER, SMTP_PORT, SMTP_EMAIL, SMTP_PASSWORD)
+    return smtp_pool
+
+
+def send_email_smtp(to_email, subject, body, html_body, lead_name=None, message_id=None):
+    """Send email via SMTP over a pooled, already-authenticated session"""
     try:
-        import smtplib
-        from email.mime.text import MIMEText
-        from email.mime.multipart import MIMEMultipart
-        if not SMTP_EMAIL or not SMTP_PASSWORD or not SMTP_SERVER or not SMTP_PORT:
+        pool = get_smtp_pool()
+        if not pool:
             return False, "SMTP not configured"
         msg = MIMEMultipart('alternative')
         msg['From'] = f"Lead Outreach AI <{SMTP_EMAIL}>"
         msg['To'] = to_email
         msg['Subject'] = subject
+        if message_id:
+            msg['Message-ID'] = message_id
         msg.attach(MIMEText(body, 'plain'))
         msg.attach(MIMEText(html_body, 'html'))
-        
-        if SMTP_PORT == 587:
-            server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=10)
-            server.starttls()
-            server.login(SMTP_EMAIL, SMTP_PASSWORD)
-            server.send_message(msg)
-            server.quit()
-            return True, None
-        elif SMTP_PORT == 465:
-            server = smtplib.SMTP_SSL(SMTP_SERVER, SMTP_PORT, timeout=10)
-            server.login(SMTP_EMAIL, SMTP_PASSWORD)
-            server.send_message(msg)
-            server.quit()
-            return True, None
-        return False, f"Unsupported port {SMTP_PORT}"
+        pool.send_message(msg)
+        return True, None
     except Exception as e:
         return False, str(e)
 
+brevo_transport = None
+brevo_lock = threading.Lock()
+
+
+def get_brevo():
+    """Lazy load the Brevo transport (one keep-alive session for all sends)"""
+    global brevo_transport
+    if brevo_transport is None and BREVO_API_KEY:
+        with brevo_lock:
+            if brevo_transport is None:
+                brevo_transport = BrevoTransport(BREVO_API_KEY, SMTP_EMAIL or "outreach@yourdomain.com")
+    return brevo_transport
+
+
 def send_email(to_email, subject, body, lead_name=None, lead_id=None):
     """Send email via Brevo or SMTP fallback"""
-    if not to_email or not isinstance(to_email, str) or '@' not in to_email:
-        print(f"⚠️  Skipping email send: Invalid address '{to_email}'")
-        return False, "Invalid or missing recipient email address"
+    return send_emails_batch([{
+        'to': to_email, 'subject': subject, 'body': body, 'lead_name': lead_name, 'lead_id': lead_id,
+    }])[0]
 
-    html_body = build_html_body(body, lead_id)
-    if BREVO_API_KEY:
-        try:
-            url = "https://api.brevo.com/v3/smtp/email"
-            headers = {"accept": "application/json", "content-type": "application/json", "api-key": BREVO_API_KEY}
-            
-            recipient_name = lead_name
-            if not recipient_name:
-                recipient_name = to_email.split('@')[0] if to_email else "Lead"
-
-            payload = {
-                "sender": {"email": SMTP_EMAIL or "outreach@yourdomain.com", "name": "Lead Outreach AI"},
-                "to": [{"email": to_email, "name": recipient_name}],
-                "subject": subject,
-                "textContent": body,
-                "htmlContent": html_body
-            }
-            response = requests.post(url, headers=headers, json=payload, timeout=15)
-            if response.status_code in [200, 201, 202]:
-                print(f"✅ Sent via Brevo to {to_email} (status {response.status_code})")
-                return True, None
-            else:
-                err_text = f"Brevo API responded with {response.status_code}: {response.text}"
-                print(f"⚠️ Brevo send failed: {err_text}")
-                # Fallthrough to SMTP fallback with the reason
-                brevo_err = err_text
-        except Exception as e:
-            brevo_err = str(e)
-            print(f"⚠️ Exception while calling Brevo API: {brevo_err}")
-        # If we reach here, Brevo failed, try SMTP fallback and include Brevo reason
-        smtp_success, smtp_err = send_email_smtp(to_email, subject, body, html_body, lead_name)
+
+def send_emails_batch(emails, throttle=None):
+    """Send many emails; returns a (success, error) per email, in order.
+
+    Each email is a dict with to, subject, body and optional lead_name and
+    lead_id. With Brevo configured they go out in messageVersions batches;
+    recipients Brevo rejects are retried over SMTP.
+    """
+    return [(success, err) for success, err, *_ in _send_emails(emails, throttle)]
+
+
+def _send_emails(emails, throttle=None):
+    """send_emails_batch returning (success, error, provider, message_id); `throttle(provider, count)`
+    is called before messages are handed to a provider. message_id is the
+    Message-ID the email went out with (the provider's, when it assigns one)."""
+    throttle = throttle or (lambda provider, count: None)
+    results = [None] * len(emails)
+    messages, indexes = [], []
+    for i, item in enumerate(emails):
+        to_email = item.get('to')
+        if not to_email or not isinstance(to_email, str) or '@' not in to_email:
+            print(f"⚠️  Skipping email send: Invalid address '{to_email}'")
+            results[i] = (False, "Invalid or missing recipient email address", None, None)
+            continue
+        messages.append({
+            'to': to_email,
+            'name': item.get('lead_name'),
+            'subject': item['subject'],
+            'text': item['body'],
+            'html': item.get('html') or build_html_body(item['body'], item.get('lead_id')),
+            'message_id': item.get('message_id'),
+        })
+        indexes.append(i)
+
+    def via_smtp(message):
+        throttle('smtp', 1)
+        return send_email_smtp(message['to'], message['subject'], message['text'], message['html'], message['name'],
+                               message['message_id'])
+
+    brevo = get_brevo()
+    if not brevo:
+        for i, message in zip(indexes, messages):
+            results[i] = (*via_smtp(message), 'smtp', message['message_id'])
+        return results
+
+    throttle('brevo', len(messages))
+    for i, message, (ok, brevo_err) in zip(indexes, messages, brevo.send_batch(messages)):
+        if ok:
+            print(f"✅ Sent via Brevo to {message['to']}")
+            results[i] = (True, None, 'brevo', message['message_id'])
+            continue
+        print(f"⚠️ Brevo send failed: {brevo_err}")
+        if isinstance(brevo_err, TransportError):
+            # Brevo may still deliver it; SMTP now could send a duplicate, so leave it to the outbox retry
+            results[i] = (False, f"Brevo error: {brevo_err}", None, None)
+            continue
+        # Brevo rejected it, try SMTP fallback and include Brevo reason
+        smtp_success, smtp_err = via_smtp(message)
         if smtp_success:
-            print(f"✅ Sent via SMTP to {to_email} after Brevo failure: {brevo_err}")
-            return True, None
+            print(f"✅ Sent via SMTP to {message['to']} after Brevo failure: {brevo_err}")
+            results[i] = (True, None, 'smtp', message['message_id'])
         else:
             combined_err = f"Brevo error: {brevo_err}; SMTP error: {smtp_err}"
-            print(f"❌ Both Brevo and SMTP failed for {to_email}: {combined_err}")
-            return False, combined_err
-    else:
-        return send_email_smtp(to_email, subject, body, html_body, lead_name)
+            print(f"❌ Both Brevo and SMTP failed for {message['to']}: {combined_err}")
+            results[i] = (False, combined_err, None, None)
+    return results
+
+
+def deliver_outbox_rows(rows, throttle):
+    """Outbox worker delivery: send claimed rows, treating failures as dry runs when OUTREACH_DRY_RUN is set"""
+    sent = _send_emails([
+        {'to': row['to_email'], 'subject': row['subject'], 'body': row['body'], 'html': row.get('html_body'),
+         'lead_name': row.get('to_name'), 'lead_id': row.get('lead_id'), 'message_id': row.get('message_id')}
+        for row in rows
+    ], throttle)
+    outcomes = []
+    for row, (success, err, provider, message_id) in zip(rows, sent):
+        success, dry_run, reason = normalize_outreach_result(success, err)
+        outcomes.append({'success': success, 'error': reason, 'provider': 'dry_run' if dry_run else provider,
+                         'dry_run': dry_run,
+                         'message_id': message_id if message_id != row.get('message_id') else None})
+    return outcomes
+
+
+def apply_outbox_after_send(sent):
+    """Log delivered emails and advance their leads as described by each row's after_send.
+
+    `sent` is the (row, outcome) pairs of one worker batch; they are written
+    together with db.record_outreach_batch.
+    """
+    entries = []
+    for row, outcome in sent:
+        if not row.get('lead_id'):
+            continue
+        after = row.get('after_send') or {}
+        if isinstance(after, (str, bytes)):
+            after = json.loads(after)
+        log_message = after.get('log_message') or row['body']
+        if outcome.get('dry_run') and after.get('mark_dry_run', True):
+            log_message = f"{log_message}\n\n[DRY RUN MODE]"
+        entries.append({
+            'lead_id': row['lead_id'],
+            'type': after.get('log_type', 'email'),
+            'message': log_message,
+            'update_status': after.get('update_status', True),
+            'lead_status': after.get('lead_status'),
+            'sequence_step': after.get('sequence_step'),
+        })
+        if 'next_action_in' in after:
+            entries[-1]['next_action_in'] = after['next_action_in']
+    try:
+        db.record_outreach_batch(entries)
+    except Exception as e:
+        # The mail is already out: still index it for replies and schedule the next step
+        print(f"[OUTBOX] Failed to record sent batch: {e}")
+    for row, outcome in sent:
+        REPLY_INDEX.add_message(row.get('lead_id'), outcome.get('message_id') or row.get('message_id'))
+    now = datetime.now()
+    for entry in entries:
+        if 'next_action_in' in entry:
+            delay = entry['next_action_in']
+            SEND_SCHEDULER.notify(entry['lead_id'], None if delay is None else now + timedelta(seconds=delay))
+
+
+OUTBOX = OutboxWorkerPool(deliver_outbox_rows, on_sent=apply_outbox_after_send)
+
+
+def request_idempotency_key(data=None):
+    """Client-supplied Idempotency-Key header (or body field), if any"""
+    key = request.headers.get('Idempotency-Key') or (data or {}).get('idempotency_key')
+    return str(key).strip()[:150] if key else None
+
+
+def enqueue_emails(items):
+    """Queue outbox items (see outbox.outbox_item) and wake the senders.
+
+    Returns one dict per item: outbox_id, status ('queued', or the existing
+    row's status when the idempotency key was seen before), duplicate, and
+    error when the item couldn't be queued.
+    """
+    results = [None] * len(items)
+    valid = []
+    for i, item in enumerate(items):
+        if is_valid_address(item.get('to_email')):
+            item.setdefault('sender', SMTP_EMAIL)
+            valid.append(i)
+        else:
+            results[i] = {'outbox_id': None, 'status': 'failed', 'duplicate': False,
+                          'error': "Invalid or missing recipient email address"}
+    if not valid:
+        return results
+    try:
+        queued = db.enqueue_outbox([items[i] for i in valid])
+    except Exception as e:
+        print(f"❌ Failed to enqueue {len(valid)} email(s): {e}")
+        queued = {}
+    for i in valid:
+        key = items[i]['idempotency_key']
+        if key not in queued:
+            results[i] = {'outbox_id': None, 'status': 'failed', 'duplicate': False,
+                          'error': "Outbox unavailable (database not reachable)"}
+            continue
+        outbox_id, status, duplicate = queued[key]
+        results[i] = {'outbox_id': outbox_id, 'status': status, 'duplicate': duplicate}
+    OUTBOX.wake()
+    return results
+
+
+def enqueue_email(to_email, subject, body, **kwargs):
+    return enqueue_emails([outbox_item(to_email, subject, body, **kwargs)])[0]
 
 def get_snov_token():
     """Get Snov.io token"""
@@ -526,25 +806,42 @@ def normalize_outreach_result(success, err):
     return success, dry_run, reason
 
 
-def build_template_context(lead):
+def build_template_context(lead, contact_name=False):
+    """Placeholder values for a lead. Built-in templates address the company as
+    {name}; saved and drip templates (contact_name=True) use the contact's name."""
     location = lead.get('location') or lead.get('city') or ''
     fallback_name = (lead.get('company') or lead.get('email') or 'there').split('@')[0]
-    context = SafeDict({
-        'name': lead.get('company') or fallback_name,
+    return {
+        'name': (lead.get('name') or 'there') if contact_name else (lead.get('company') or fallback_name),
         'company': lead.get('company') or 'your company',
         'email': lead.get('email') or '',
         'location': location,
         'product': lead.get('ai_analysis', {}).get('product') if isinstance(lead.get('ai_analysis'), dict) else 'this solution',
         'cta': lead.get('notes', 'Let me know a good time to chat'),
-    })
-    return context
+    }
 
 
 def format_template(template, lead):
+    subject_t, body_t = TEMPLATES.compile_message(template.get('subject', 'Hello'), template.get('message', ''))
     context = build_template_context(lead)
-    subject = template.get('subject', 'Hello').format_map(context)
-    message = template.get('message', '').format_map(context)
-    return subject, message
+    return subject_t.render(context), body_t.render(context)
+
+
+def compile_email_template(template):
+    """Compiled (subject, body) for a saved email_templates row ({{name}} placeholders), cached by id and version"""
+    return TEMPLATES.compile_message(
+        template.get('subject') or '', template.get('body') or '',
+        key=('email_template', template.get('id')), version=template.get('updated_at'),
+        pattern=SAVED_PLACEHOLDER_RE,
+    )
+
+
+def render_email_template(compiled, lead, default_subject=None):
+    """Render a compiled saved template for a lead: (subject, text body, HTML body)"""
+    subject_t, body_t = compiled
+    context = build_template_context(lead, contact_name=True)
+    subject = subject_t.render(context) or default_subject
+    return subject, body_t.render(context), html_document(body_t.render_html(context), lead.get('id'))
 
 
 def resolve_follow_up_template(lead, template_key=None):
@@ -567,26 +864,232 @@ def get_follow_up_metadata(lead):
         'template_name': seq['title']
     }
 
-def call_ai_service(prompt, ai_service="gemini", temperature=0.1):
-    """Call Gemini or Groq with fallback"""
+GROQ_MODEL = "llama-3.3-70b-versatile"
+
+
+def _gemini_provider_call(prompt, temperature=None):
+    kwargs = {'generation_config': {'temperature': temperature}} if temperature is not None else {}
+    response = gemini_generate(prompt, **kwargs)
+    meta = getattr(response, 'usage_metadata', None)
+    usage = {
+        'prompt_tokens': getattr(meta, 'prompt_token_count', None),
+        'response_tokens': getattr(meta, 'candidates_token_count', None),
+    }
+    return getattr(response, 'text', str(response)), usage
+
+
+def _groq_provider_call(prompt, temperature=None):
+    res = get_groq().chat.completions.create(
+        model=GROQ_MODEL, messages=[{"role": "user", "content": prompt}],
+        temperature=0.1 if temperature is None else temperature
+    )
+    usage = {
+        'prompt_tokens': getattr(res.usage, 'prompt_tokens', None),
+        'response_tokens': getattr(res.usage, 'completion_tokens', None),
+    }
+    return res.choices[0].message.content, usage
+
+
+AI_EXECUTOR = AIExecutor([
+    AIProvider('gemini', _gemini_provider_call,
+               available=lambda: bool(get_genai() and get_working_gemini_model()),
+               cache_model=get_working_gemini_model, rpm=GEMINI_RPM, tpm=GEMINI_TPM),
+    AIProvider('groq', _groq_provider_call,
+               available=lambda: bool(get_groq()),
+               cache_model=lambda: f"groq:{GROQ_MODEL}", rpm=GROQ_RPM, tpm=GROQ_TPM),
+], cache=LLM_CACHE, ledger=AI_LEDGER)
+
+
+def call_ai_service(prompt, ai_service="gemini", temperature=0.1, use_cache=True, hedge=None, expect_json=False, agent=None):
+    """Call Gemini or Groq with fallback (responses cached unless use_cache=False).
+
+    `ai_service` is the preferred provider; with AI_ROUTING on, a faster healthy
+    provider is used instead. hedge=True (default AI_HEDGING) also fires the
+    runner-up after the first provider's p95 latency; with expect_json only
+    answers containing JSON count as a win. `agent` names the caller in the
+    AI call ledger.
+    """
     services = [ai_service, "groq" if ai_service == "gemini" else "gemini"]
-    for s in services:
-        try:
-            if s == "gemini":
-                _genai = get_genai()
-                if _genai:
-                    model_name = get_working_gemini_model()
-                    if model_name:
-                        model = _genai.GenerativeModel(model_name)
-                        res = model.generate_content(prompt)
-                        if res and hasattr(res, 'text'): return res.text, "gemini"
-            elif s == "groq":
-                client = get_groq()
-                if client:
-                    res = client.chat.completions.create(model="llama-3.3-70b-versatile", messages=[{"role": "user", "content": prompt}], temperature=temperature)
-                    return res.choices[0].message.content, "groq"
-        except: continue
-    return None, None
+    hedge = AI_HEDGING if hedge is None else hedge
+    try:
+        with AI_LEDGER.agent(agent or AI_LEDGER.current_agent() or 'call_ai_service'):
+            if hedge:
+                validate = contains_json if expect_json else None
+                return AI_EXECUTOR.call_hedged(prompt, services=services, temperature=temperature,
+                                               use_cache=use_cache, validate=validate)
+            return AI_EXECUTOR.call(prompt, services=services, temperature=temperature,
+                                    use_cache=use_cache, route=AI_ROUTING)
+    except AIExecutorError as e:
+        print(f"[AI] {e}")
+        return None, None
+
+# Structured output schemas (see structured_output.py)
+BUSINESS_ANALYSIS_SCHEMA = Schema('analyze_business', {
+    'trust_score': Field(int, required=True, minimum=0, maximum=100),
+    'business_maturity': Field(str, required=True, choices=('Startup', 'SMB', 'Enterprise')),
+    'growth_potential': Field(str, required=True, choices=('Low', 'Medium', 'High')),
+    'reasoning': Field(str, description='max 2 sentences'),
+})
+RESPONSE_ANALYSIS_SCHEMA = Schema('analyze_response', {
+    'sentiment': Field(str, required=True, choices=('positive', 'neutral', 'negative')),
+    'interest_level': Field(str, required=True, choices=('high', 'medium', 'low')),
+    'next_action': Field(str, required=True, description='reply_immediately, schedule_meeting, send_info, follow_up_later or do_not_contact'),
+    'reasoning': Field(str),
+})
+LEAD_DATA_SCHEMA = Schema('optimize_lead_data', {})
+EXTRACTED_LEADS_SCHEMA = Schema('extract_leads', {
+    'company_name': Field(str, required=True),
+    'contact_name': Field(str),
+    'official_website': Field(str),
+    'email': Field(str),
+    'phone_number': Field(str),
+    'full_address': Field(str),
+    'confidence': Field(int, minimum=0, maximum=100),
+    'confidence_score': Field(str, choices=('High', 'Medium', 'Low')),
+}, many=True)
+LEAD_SCORE_SCHEMA = Schema('score_lead', {
+    'overall_score': Field(int, required=True, minimum=0, maximum=100),
+    'business_score': Field(int, minimum=0, maximum=25),
+    'contact_score': Field(int, minimum=0, maximum=25),
+    'engagement_score': Field(int, minimum=0, maximum=25),
+    'conversion_score': Field(int, minimum=0, maximum=25),
+    'reasoning': Field(str, description='brief explanation'),
+})
+LEAD_ENRICHMENT_SCHEMA = Schema('enrich_lead', {
+    'company_info': Field(dict, required=True, description='industry, size, description, website'),
+    'contact_info': Field(dict, description='social_media (array), job_title, additional_emails (array)'),
+    'business_context': Field(dict, description='target_market, services (array), competition'),
+})
+
+
+def structured_gemini(task, schema, use_cache=True):
+    """Gemini call through the structured-output layer; returns the validated value.
+
+    The schema name is the agent name used for parse-failure stats. A
+    response that needed repair is replaced in the LLM cache by the repaired
+    JSON; one that could not be repaired is evicted.
+    """
+    prompt = structured_output.build_prompt(task, schema)
+
+    def generate(text, repair=False):
+        return gemini_generate_text(text, use_cache=use_cache and not repair, agent=schema.name)
+
+    try:
+        value, _, stage = structured_output.generate(schema.name, prompt, schema, generate,
+                                                     on_invalid=AI_LEDGER.mark_parse_failure)
+    except StructuredOutputError:
+        LLM_CACHE.discard(get_working_gemini_model(), prompt)
+        raise
+    if stage != structured_output.STAGE_PARSED and use_cache:
+        LLM_CACHE.replace(get_working_gemini_model(), prompt, json.dumps(value))
+    return value
+
+
+def chunk_text_by_tokens(text, max_tokens=None):
+    """Split free text into chunks under the token budget, on paragraph (then line) boundaries"""
+    max_tokens = max_tokens or AI_EXTRACT_CHUNK_TOKENS
+    max_chars = max_tokens * 4
+    pieces = []
+    for paragraph in re.split(r'\n\s*\n', text or ''):
+        if len(paragraph) <= max_chars:
+            pieces.append(paragraph)
+            continue
+        for line in paragraph.split('\n'):
+            # A single oversized line is cut hard
+            pieces.extend(line[i:i + max_chars] for i in range(0, len(line), max_chars))
+    chunks, current, used = [], [], 0
+    for piece in pieces:
+        if not piece.strip():
+            continue
+        cost = estimate_tokens(piece)
+        if current and used + cost > max_tokens:
+            chunks.append('\n\n'.join(current))
+            current, used = [], 0
+        current.append(piece)
+        used += cost
+    if current:
+        chunks.append('\n\n'.join(current))
+    return chunks
+
+
+def chunk_records_by_tokens(records, max_tokens=None):
+    """Split records (e.g. search results) into lists whose JSON fits the token budget"""
+    max_tokens = max_tokens or AI_EXTRACT_CHUNK_TOKENS
+    chunks, current, used = [], [], 0
+    for record in records:
+        cost = estimate_tokens(json.dumps(record, ensure_ascii=False))
+        if current and used + cost > max_tokens:
+            chunks.append(current)
+            current, used = [], 0
+        current.append(record)
+        used += cost
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _lead_dedupe_keys(lead):
+    keys = []
+    email_addr = (lead.get('email') or '').strip().lower()
+    if '@' in email_addr:
+        keys.append(('email', email_addr))
+    website = (lead.get('official_website') or '').strip().lower()
+    if website:
+        host = urlparse(website if '//' in website else '//' + website).netloc.split(':')[0]
+        if host.startswith('www.'):
+            host = host[4:]
+        if host:
+            keys.append(('domain', host))
+    digits = re.sub(r'\D', '', lead.get('phone_number') or '')
+    if len(digits) >= 7:
+        keys.append(('phone', digits[-10:]))
+    return keys
+
+
+def merge_extracted_leads(lead_lists):
+    """Merge leads from several chunks, deduplicating by email, website domain and phone.
+
+    Duplicates fill each other's missing fields and keep the higher confidence.
+    """
+    merged, index = [], {}
+    for leads in lead_lists:
+        for lead in leads:
+            keys = _lead_dedupe_keys(lead)
+            existing = next((index[k] for k in keys if k in index), None)
+            if existing is None:
+                existing = dict(lead)
+                merged.append(existing)
+            else:
+                for field, value in lead.items():
+                    if existing.get(field) in (None, '') and value not in (None, ''):
+                        existing[field] = value
+                if (lead.get('confidence') or 0) > (existing.get('confidence') or 0):
+                    existing['confidence'] = lead['confidence']
+                    existing['confidence_score'] = lead.get('confidence_score') or existing.get('confidence_score')
+            for key in _lead_dedupe_keys(existing):
+                index.setdefault(key, existing)
+    return merged
+
+
+def map_reduce_extract(tasks):
+    """Run one extraction prompt per chunk concurrently and merge the leads.
+
+    Returns (leads, failures) where failures maps chunk index -> error, so
+    callers can return partial results when only some chunks fail.
+    """
+    results, failures = {}, {}
+    with ThreadPoolExecutor(max_workers=max(1, min(AI_EXTRACT_CONCURRENCY, len(tasks)))) as pool:
+        futures = {pool.submit(structured_gemini, task, EXTRACTED_LEADS_SCHEMA): i for i, task in enumerate(tasks)}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                results[i] = future.result()
+            except Exception as e:
+                print(f"❌ Extraction chunk {i + 1}/{len(tasks)} failed: {e}")
+                failures[i] = e
+    leads = merge_extracted_leads(results[i] for i in sorted(results))
+    return leads, failures
+
 
 def looks_like_lead_dict(entry):
     """Return True if the dict contains keys typically present on a lead."""
@@ -596,33 +1099,11 @@ def looks_like_lead_dict(entry):
     return any(key in entry for key in lead_keys)
 
 def extract_json_from_text(text):
-    """Robustly extract JSON array or object from text"""
+    """Robustly extract JSON array or object from text (single pass, see json_extract)"""
     if not text:
         return None
-    
-    # Clean up common AI artifacts
-    text = text.strip()
-    text = re.sub(r'```json\s*', '', text)
-    text = re.sub(r'```\s*', '', text)
-    
-    decoder = json.JSONDecoder()
-    idx = 0
-    length = len(text)
-    while idx < length:
-        char = text[idx]
-        if char not in ('[', '{'):
-            idx += 1
-            continue
-        try:
-            obj, consumed = decoder.raw_decode(text[idx:])
-        except json.JSONDecodeError:
-            idx += 1
-            continue
-
-        if consumed <= 0:
-            idx += 1
-            continue
 
+    for obj, _, _ in iter_json_values(text):
         if isinstance(obj, list) and obj:
             if any(looks_like_lead_dict(item) for item in obj if isinstance(item, dict)):
                 return obj
@@ -634,27 +1115,25 @@ def extract_json_from_text(text):
             if looks_like_lead_dict(obj):
                 return [obj]
 
-        idx += consumed
-    
     return None
 
 def agent_ai_clean_search_results(search_results, ai_service="gemini"):
     """Clean search results with AI"""
     text = "".join([f"Title: {r.get('title')}\nURL: {r.get('href')}\nSnippet: {r.get('body')}\n---\n" for r in search_results])
     prompt = f"Extract business leads from these search results. Return ONLY a JSON array of objects with keys: name, email, website, phone, company, location, confidence_score, ai_analysis (reasoning, business_maturity, growth_potential), notes.\n\nINPUT:\n{text}"
-    res, _ = call_ai_service(prompt, ai_service)
+    res, _ = call_ai_service(prompt, ai_service, expect_json=True, agent='ai_clean_search_results')
     return extract_json_from_text(res) or []
 
 def agent_ai_extract_leads(text, ai_service="gemini"):
     """Extract leads from text with AI"""
     prompt = f"Extract business leads from this text. Return ONLY a JSON array of objects with keys: name, email, website, phone, company, location, confidence_score, ai_analysis (reasoning, business_maturity, growth_potential), notes.\n\nINPUT:\n{text}"
-    res, _ = call_ai_service(prompt, ai_service)
+    res, _ = call_ai_service(prompt, ai_service, expect_json=True, agent='ai_extract_leads')
     return extract_json_from_text(res) or []
 
 def agent_generate_outreach_message(lead, tone="professional", template="email", ai_service="gemini"):
     """Generate outreach message with AI"""
     prompt = f"Generate a {tone} {template} outreach message for this lead: {json.dumps(lead)}. Return JSON with keys: subject, message, cta, preview."
-    res, _ = call_ai_service(prompt, ai_service, temperature=0.7)
+    res, _ = call_ai_service(prompt, ai_service, temperature=0.7, expect_json=True, agent='generate_outreach_message')
     data = extract_json_from_text(res)
     if isinstance(data, list) and data: data = data[0]
     return {"success": True, **data} if data else {"success": False, "error": "AI failed"}
@@ -662,7 +1141,7 @@ def agent_generate_outreach_message(lead, tone="professional", template="email",
 def agent_generate_campaign_strategy(leads_count, industry, objective, ai_service="gemini"):
     """Generate campaign strategy with AI"""
     prompt = f"Create a strategy for {leads_count} leads in {industry} for {objective}. Return JSON with keys: campaign_overview, target_audience, sequence, messaging_strategy, timings, success_metrics, response_handling, escalation_path."
-    res, _ = call_ai_service(prompt, ai_service, temperature=0.7)
+    res, _ = call_ai_service(prompt, ai_service, temperature=0.7, expect_json=True, agent='campaign_strategy')
     data = extract_json_from_text(res)
     return {"success": True, "strategy": data} if data else {"success": False, "error": "AI failed"}
 
@@ -680,123 +1159,152 @@ def _update_lead_after_outreach(lead_id, status_value='outreach_sent', sequence_
     conn.close()
     return True
 
+def campaign_sequences_for(leads):
+    """{campaign_id: drip sequences} for the campaigns of `leads`, one query per campaign"""
+    return {cid: db.get_campaign_sequences(cid) for cid in {lead.get('campaign_id') for lead in leads} if cid}
+
+
+def next_drip_sequence(sequences, sequence_step):
+    # current_sequence_step holds the day_offset of the last drip sent
+    return next((seq for seq in sequences or [] if seq['day_offset'] > (sequence_step or 0)), None)
+
+
+def next_action_delay(lead, sequence_step, sequences=None):
+    """Seconds from a send until the lead's next scheduled send, or None when nothing follows.
+
+    Campaign leads with drip sequences get the next drip (day_offset days
+    after the previous email); everyone else gets the follow-up sequence
+    every AUTO_FOLLOWUP_DELAY_DAYS until it runs out.
+    """
+    if lead.get('campaign_id'):
+        if sequences is None:
+            sequences = db.get_campaign_sequences(lead['campaign_id'])
+        if sequences:
+            seq = next_drip_sequence(sequences, sequence_step)
+            return seq['day_offset'] * 86400 if seq else None
+    if (sequence_step or 0) < len(FOLLOW_UP_SEQUENCE) + 1:
+        return AUTO_FOLLOWUP_DELAY_DAYS * 86400
+    return None
+
+
 def dispatch_followup_for_lead(lead, template_key=None, triggered_by='follow-up'):
     template = resolve_follow_up_template(lead, template_key)
     if not template:
         return False, "Template not available", None
 
     subject, message = format_template(template, lead)
-    success, err = send_email(lead['email'], subject, message, lead.get('company'), lead_id=lead.get('id'))
-    if not success:
-        return False, err or "Failed to send follow-up", None
-
-    db.log_outreach(lead['id'], 'email', f"{triggered_by} follow-up: {template.get('name')}")
     next_step = min((lead.get('current_sequence_step') or 1) + 1, len(FOLLOW_UP_SEQUENCE) + 1)
-    _update_lead_after_outreach(lead['id'], status_value='followup_sent', sequence_step=next_step)
+    # One follow-up per sequence step: the scheduler and a manual click can't both send it
+    queued = enqueue_email(
+        lead['email'], subject, message,
+        idempotency_key=f"followup:{lead['id']}:{next_step}",
+        lead_id=lead['id'], to_name=lead.get('company'), kind='followup',
+        after_send={'log_message': f"{triggered_by} follow-up: {template.get('name')}",
+                    'lead_status': 'followup_sent', 'sequence_step': next_step,
+                    'next_action_in': next_action_delay(lead, next_step, sequences=[])},
+    )
+    if queued['status'] == 'failed':
+        return False, queued['error'] or "Failed to queue follow-up", None
     return True, None, next_step
 
-def extract_email_body(msg):
-    if msg.is_multipart():
-        for part in msg.walk():
-            content_type = part.get_content_type()
-            disposition = part.get_content_disposition()
-            if content_type == 'text/plain' and disposition in (None, 'inline'):
-                payload = part.get_payload(decode=True)
-                if payload:
-                    return payload.decode('utf-8', errors='ignore')
-    else:
-        payload = msg.get_payload(decode=True)
-        if payload:
-            return payload.decode('utf-8', errors='ignore')
-    return ''
+
+def dispatch_drip_for_lead(lead, sequences):
+    """Queue the lead's next campaign drip email; returns (queued, error)"""
+    seq = next_drip_sequence(sequences, lead.get('current_sequence_step'))
+    if not seq:
+        return True, None
+    print(f"Auto-Drip lead: {lead['id']} - Step {seq['day_offset']}")
+    subject, message, html_body = render_email_template(TEMPLATES.compile_message(
+        seq.get('template_subject') or '', seq.get('template_body') or '',
+        key=('campaign_sequence', seq.get('id')),
+    ), lead)
+    # The day_offset is stored as the step indicator once it is sent
+    success, reason, _ = agent_send_outreach(
+        lead, message, subject=subject, html_body=html_body,
+        idempotency_key=f"drip:{lead['id']}:{seq['day_offset']}",
+        kind='drip',
+        after_send={'log_type': 'email', 'sequence_step': seq['day_offset'],
+                    'next_action_in': next_action_delay(lead, seq['day_offset'], sequences)},
+    )
+    return success, reason
+
+
+def dispatch_scheduled_leads(leads):
+    """SendScheduler callback: queue the drip or follow-up each due lead is waiting for.
+
+    Returns the ids that could not be queued so they are retried later.
+    """
+    sequences = campaign_sequences_for(leads)
+    failed = []
+    for lead in leads:
+        drips = sequences.get(lead.get('campaign_id'))
+        if drips:
+            success, err = dispatch_drip_for_lead(lead, drips)
+        elif (lead.get('current_sequence_step') or 0) < len(FOLLOW_UP_SEQUENCE) + 1:
+            success, err, _ = dispatch_followup_for_lead(lead, triggered_by='auto follow-up')
+        else:
+            continue
+        if not success:
+            print(f"[AUTO FOLLOWUP] Failed for lead {lead.get('id')}: {err}")
+            failed.append(lead['id'])
+    return failed
+
+
+SEND_SCHEDULER = SendScheduler(dispatch_scheduled_leads, refill_interval=AUTO_FOLLOWUP_INTERVAL)
+
+def handle_incoming_replies(replies):
+    """Record one IMAP batch of (lead_id, message) replies matched by the reply index."""
+    global LAST_IMAP_PROCESSED
+    for lead_id, message in replies:
+        print(f"[IMAP] Reply detected from {message['sender']} matching lead id {lead_id} subject: {message['subject']}")
+    recorded = db.record_replies([(lead_id, message['subject'], message.get('body') or '') for lead_id, message in replies])
+    if recorded is None:
+        # Keeps the IMAP watermark before this batch so it is fetched again
+        raise RuntimeError("could not record replies in the database")
+    for lead_id, _ in replies:
+        SEND_SCHEDULER.notify(lead_id, None)
+    lead_id, message = replies[-1]
+    LAST_IMAP_PROCESSED = {'lead_id': lead_id, 'sender': message['sender'], 'subject': message['subject'], 'when': datetime.utcnow().isoformat()}
+
+
+REPLY_INDEX = ReplyIndex()
+REPLY_MONITOR = None
 
 
 def start_reply_monitor():
-    global LAST_IMAP_CHECK, LAST_IMAP_ERROR, LAST_IMAP_PROCESSED
+    """Watch the inbox over one persistent IMAP connection (IDLE, or polling every IMAP_POLL_INTERVAL)"""
+    global REPLY_MONITOR
 
     if not IMAP_EMAIL or not IMAP_PASSWORD:
         print("IMAP reply monitor disabled (missing credentials)")
         return
+    if REPLY_MONITOR is not None:
+        return
 
-    def monitor():
-        global LAST_IMAP_CHECK, LAST_IMAP_ERROR, LAST_IMAP_PROCESSED
-        while True:
-            mail = None
-            LAST_IMAP_CHECK = datetime.utcnow().isoformat()
-            processed_any = False
-            try:
-                mail = imaplib.IMAP4_SSL(IMAP_SERVER)
-                mail.login(IMAP_EMAIL, IMAP_PASSWORD)
-                mail.select('inbox')
-                status, messages = mail.search(None, 'UNSEEN')
-                ids = messages[0].split()
-                if ids:
-                    print(f"[IMAP] Found {len(ids)} unseen messages at {LAST_IMAP_CHECK}")
-                for msg_id in ids:
-                    _, msg_data = mail.fetch(msg_id, '(RFC822)')
-                    msg = email.message_from_bytes(msg_data[0][1])
-                    sender = parseaddr(msg.get('From', ''))[1]
-                    subject = msg.get('Subject', '')
-                    body = extract_email_body(msg)
-                    if not sender:
-                        mail.store(msg_id, '+FLAGS', '\\Seen')
-                        continue
-
-                    lead = db.get_lead_by_email(sender)
-                    if lead:
-                        print(f"[IMAP] Reply detected from {sender} matching lead id {lead.get('id')} subject: {subject}")
-                        marked = db.mark_lead_replied(lead['id'], subject, body)
-                        if marked:
-                            db.log_outreach(lead['id'], 'reply', f'Incoming reply: {subject or sender}')
-                        processed_any = True
-                        LAST_IMAP_PROCESSED = {'lead_id': lead.get('id'), 'sender': sender, 'subject': subject, 'when': datetime.utcnow().isoformat()}
-                    else:
-                        print(f"[IMAP] Incoming reply from {sender} did not match any lead")
-                    mail.store(msg_id, '+FLAGS', '\\Seen')
-                LAST_IMAP_ERROR = None
-            except Exception as exc:
-                LAST_IMAP_ERROR = str(exc)
-                print(f"[IMAP] Reply monitor error: {exc}")
-            finally:
-                if mail:
-                    try:
-                        mail.close()
-                    except Exception:
-                        pass
-                    try:
-                        mail.logout()
-                    except Exception:
-                        pass
-            if not processed_any:
-                # small heartbeat message for visibility
-                print(f"[IMAP] Poll complete at {LAST_IMAP_CHECK}, processed_any={processed_any}")
-            time.sleep(IMAP_POLL_INTERVAL)
-
-    thread = threading.Thread(target=monitor, daemon=True)
+    REPLY_MONITOR = IMAPReplyMonitor(
+        IMAP_SERVER, IMAP_EMAIL, IMAP_PASSWORD,
+        match=REPLY_INDEX.match_many,
+        on_replies=handle_incoming_replies,
+        load_state=lambda: db.get_setting(IMAP_STATE_SETTING),
+        save_state=lambda value: db.update_setting(IMAP_STATE_SETTING, value),
+        poll_interval=IMAP_POLL_INTERVAL,
+    )
+    thread = threading.Thread(target=REPLY_MONITOR.run_forever, daemon=True)
     thread.start()
 
 
 def start_auto_followups():
+    """Start the send scheduler for follow-ups and drips (AUTO_FOLLOWUP_INTERVAL is its index resync period)"""
     if AUTO_FOLLOWUP_INTERVAL <= 0:
         print("Auto follow-ups disabled (interval <= 0)")
         return
-
-    def scheduler():
-        while True:
-            try:
-                leads = db.get_auto_follow_up_candidates(AUTO_FOLLOWUP_DELAY_DAYS, len(FOLLOW_UP_SEQUENCE) + 1)
-                for lead in leads:
-                    if lead.get('replied'):  # skip answered leads
-                        continue
-                    success, err, _ = dispatch_followup_for_lead(lead, triggered_by='auto follow-up')
-                    if not success:
-                        print(f"[AUTO FOLLOWUP] Failed for lead {lead.get('id')}: {err}")
-            except Exception as exc:
-                print(f"[AUTO FOLLOWUP] Error: {exc}")
-            time.sleep(AUTO_FOLLOWUP_INTERVAL)
-
-    thread = threading.Thread(target=scheduler, daemon=True)
-    thread.start()
+    try:
+        backfilled = db.backfill_next_action_at(AUTO_FOLLOWUP_DELAY_DAYS, len(FOLLOW_UP_SEQUENCE) + 1)
+        if backfilled:
+            print(f"[AUTO FOLLOWUP] Scheduled {backfilled} previously contacted lead(s)")
+    except Exception as exc:
+        print(f"[AUTO FOLLOWUP] Backfill failed: {exc}")
+    SEND_SCHEDULER.start()
 
 
 def start_reminder_scheduler():
@@ -850,6 +1358,8 @@ def start_reminder_scheduler():
 
 
 def start_background_jobs():
+    warm_gemini_model_cache()
+    OUTBOX.start()
     start_reply_monitor()
     start_auto_followups()
     start_reminder_scheduler()
@@ -866,8 +1376,7 @@ def optimize_lead_data_with_ai(lead_data):
         client = get_genai()
         if not client:
             return lead_data
-        model = client.GenerativeModel(model_name)
-        prompt = f"""
+        task = f"""
         Analyze and improve this lead data. 
         Input: {json.dumps(lead_data)}
         
@@ -875,21 +1384,13 @@ def optimize_lead_data_with_ai(lead_data):
         1. Fix capitalization in Name and Company.
         2. If Company is missing but can be inferred from email domain (e.g. bob@google.com -> Google), fill it.
         3. Format phone number to standard international format if possible.
-        4. Return ONLY the valid JSON object with the same keys.
+        4. Keep exactly the same keys as the input.
         """
         
-        response = model.generate_content(prompt)
-        cleaned_json = getattr(response, 'text', str(response)).strip()
-        # Remove markdown code blocks if present
-        if cleaned_json.startswith('```json'):
-            cleaned_json = cleaned_json[7:-3]
-        elif cleaned_json.startswith('```'):
-            cleaned_json = cleaned_json[3:-3]
-            
         try:
-            return json.loads(cleaned_json)
-        except Exception:
-            print(f"AI optimization returned non-JSON: {cleaned_json[:200]}")
+            return structured_gemini(task, LEAD_DATA_SCHEMA)
+        except StructuredOutputError as e:
+            print(f"AI optimization returned non-JSON: {e}")
             return lead_data
     except Exception as e:
         print(f"AI Optimization failed: {e}")
@@ -1394,29 +1895,135 @@ def extract_contact_info(url):
         return [], [], [], []
 
 
-def search_with_serpapi(query, max_results=5):
-    """Search with SerpApi (Google)"""
+# SerpApi tuning: Google returns up to 100 organic results per request, and one
+# request costs one credit regardless of page size, so ask for full pages and
+# keep the surplus in a cache for later calls.
+SERPAPI_PAGE_SIZE = int(os.getenv("SERPAPI_PAGE_SIZE", "100"))
+SERPAPI_MAX_PAGES = int(os.getenv("SERPAPI_MAX_PAGES", "3"))
+SERPAPI_CACHE_TTL = int(os.getenv("SERPAPI_CACHE_TTL", "3600"))
+SERPAPI_CACHE_MAX_ENTRIES = int(os.getenv("SERPAPI_CACHE_MAX_ENTRIES", "500"))
+
+serpapi_client = None
+serpapi_client_lock = threading.Lock()
+SERP_CACHE = {}
+SERP_CACHE_LOCK = threading.Lock()
+# Paging a query is serialised per key (striped), so concurrent planner threads reuse one fetch
+SERP_FETCH_LOCKS = [threading.Lock() for _ in range(32)]
+
+
+class SearchUsage:
+    """Thread-safe counters for search API usage during one discovery run."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {'serpapi_credits': 0, 'serpapi_cache_hits': 0, 'serpapi_results': 0}
+
+    def add(self, key, amount=1):
+        with self._lock:
+            self.counts[key] = self.counts.get(key, 0) + amount
+
+    def as_dict(self):
+        with self._lock:
+            return dict(self.counts)
+
+
+def get_serpapi():
+    """Lazy load a long-lived SerpApi client (keeps its HTTP session alive)"""
+    global serpapi_client
+    if serpapi_client is None and SERPAPI_API_KEY:
+        with serpapi_client_lock:
+            if serpapi_client is None:
+                serpapi_client = Client(api_key=SERPAPI_API_KEY, timeout=10)
+    return serpapi_client
+
+
+def _serp_cache_get(key):
+    with SERP_CACHE_LOCK:
+        entry = SERP_CACHE.get(key)
+        if entry and time.time() - entry['fetched_at'] > SERPAPI_CACHE_TTL:
+            SERP_CACHE.pop(key, None)
+            entry = None
+        return entry
+
+
+def _serp_cache_put(key, entry):
+    with SERP_CACHE_LOCK:
+        if key not in SERP_CACHE and len(SERP_CACHE) >= SERPAPI_CACHE_MAX_ENTRIES:
+            oldest = min(SERP_CACHE, key=lambda k: SERP_CACHE[k]['fetched_at'])
+            SERP_CACHE.pop(oldest, None)
+        SERP_CACHE[key] = entry
+
+
+def search_with_serpapi(query, max_results=5, offset=0, target_results=None, usage=None):
+    """Search with SerpApi (Google)
+
+    Requests full pages (SERPAPI_PAGE_SIZE) and pages with `start=` until
+    `target_results` (default: offset + max_results) results are cached or
+    the engine runs out. Later calls for the same query are served from the
+    cache without spending another credit. Errors are raised unless earlier
+    pages already cover part of the requested window.
+    """
     if not SERPAPI_API_KEY:
         return []
+    target = max(target_results or 0, offset + max_results)
+    cache_key = ('google', query.strip().lower())
+    entry = _serp_cache_get(cache_key)
+
+    if entry and (len(entry['results']) >= target or entry['exhausted']):
+        if usage:
+            usage.add('serpapi_cache_hits')
+        return entry['results'][offset:offset + max_results]
+
+    with SERP_FETCH_LOCKS[hash(cache_key) % len(SERP_FETCH_LOCKS)]:
+        # Another thread may have paged this query while we waited
+        entry = _serp_cache_get(cache_key)
+        if entry and (len(entry['results']) >= target or entry['exhausted']):
+            if usage:
+                usage.add('serpapi_cache_hits')
+            return entry['results'][offset:offset + max_results]
+        return _fetch_serpapi_pages(query, cache_key, entry, target, offset, max_results, usage)
+
+
+def _fetch_serpapi_pages(query, cache_key, entry, target, offset, max_results, usage):
+    # Page on a copy: readers of the cached entry never see a half-filled list
+    entry = {**entry, 'results': list(entry['results'])} if entry else \
+        {'results': [], 'exhausted': False, 'fetched_at': time.time()}
+    client = get_serpapi()
     print(f"Performing search with SerpApi: {query}")
     try:
-        client = Client(api_key=SERPAPI_API_KEY)
-        results = client.search(q=query, engine="google", num=max_results)
-        organic_results = results.get("organic_results", [])
-        # Adapt SerpApi results to the format of DDGS results
-        adapted_results = []
-        for r in organic_results:
-            adapted_results.append({
-                'title': r.get('title'),
-                'href': r.get('link'),
-                'body': r.get('snippet')
-            })
-        return adapted_results
+        pages = 0
+        while len(entry['results']) < target and not entry['exhausted'] and pages < SERPAPI_MAX_PAGES:
+            start = len(entry['results'])
+            params = {'q': query, 'engine': "google", 'num': SERPAPI_PAGE_SIZE}
+            if start:
+                params['start'] = start
+            results = client.search(**params)
+            pages += 1
+            if usage:
+                usage.add('serpapi_credits')
+            organic_results = results.get("organic_results", []) or []
+            # Adapt SerpApi results to the format of DDGS results
+            for r in organic_results:
+                entry['results'].append({
+                    'title': r.get('title'),
+                    'href': r.get('link'),
+                    'body': r.get('snippet')
+                })
+            if not organic_results or not (results.get("serpapi_pagination") or {}).get("next"):
+                entry['exhausted'] = True
+        entry['fetched_at'] = time.time()
+        _serp_cache_put(cache_key, entry)
+        page = entry['results'][offset:offset + max_results]
+        if usage:
+            usage.add('serpapi_results', len(page))
+        return page
     except Exception as e:
-        print(f"SerpApi query failed: {e}")
-        return []
-
-import threading
+        page = entry['results'][offset:offset + max_results]
+        if not page:
+            # Nothing to fall back on: let search_the_web count the failure
+            raise
+        print(f"SerpApi paging failed, using {len(page)} results already fetched: {e}")
+        return page
 
 def run_with_timeout(func, args=(), kwargs=None, timeout=8):
     """Run `func` in a thread and return its result or raise TimeoutError."""
@@ -1439,17 +2046,22 @@ def run_with_timeout(func, args=(), kwargs=None, timeout=8):
     return result_container.get('result')
 
 
-def search_the_web(query, max_results=5):
-    """Optimized web search with multiple engines and timeouts."""
+def search_the_web(query, max_results=5, usage=None, raise_on_failure=False):
+    """Optimized web search with multiple engines and timeouts.
+
+    Pass a SearchUsage as `usage` to collect SerpApi credit usage. With
+    `raise_on_failure`, a search where every engine tried errored out raises
+    instead of returning an empty list.
+    """
     all_results = []
     seen_links = set()
+    errors = []
 
     # Primary: Use SerpApi if key is available
     if SERPAPI_API_KEY:
         try:
-            print(f"Performing search with SerpApi: {query}")
             # Run SerpApi with a timeout to avoid hanging
-            results = run_with_timeout(search_with_serpapi, args=(query,), kwargs={'max_results': max_results}, timeout=6)
+            results = run_with_timeout(search_with_serpapi, args=(query,), kwargs={'max_results': max_results, 'usage': usage}, timeout=8)
             for r in results:
                 link = r.get('href', '')
                 if link and link not in seen_links:
@@ -1457,8 +2069,10 @@ def search_the_web(query, max_results=5):
                     seen_links.add(link)
         except TimeoutError as te:
             print(f"SerpApi timed out: {te}")
+            errors.append(te)
         except Exception as e:
             print(f"SerpApi query failed: {e}")
+            errors.append(e)
 
     # Fallback 1: Use DuckDuckGo Search library (DDGS)
     if len(all_results) < max_results:
@@ -1473,8 +2087,10 @@ def search_the_web(query, max_results=5):
                     seen_links.add(link)
         except TimeoutError as te:
             print(f"DDGS timed out: {te}")
+            errors.append(te)
         except Exception as e:
             print(f"DDGS query failed: {e}")
+            errors.append(e)
 
     # Fallback 2: Direct Scrape (if everything else fails)
     if len(all_results) < 2:  # Extremely low results
@@ -1502,155 +2118,196 @@ def search_the_web(query, max_results=5):
                         seen_links.add(link)
         except Exception as e:
             print(f"Fallback 2 failed: {e}")
+            errors.append(e)
 
-
+    attempted = 2 + bool(SERPAPI_API_KEY)
+    if raise_on_failure and not all_results and len(errors) >= attempted:
+        raise RuntimeError(f"All search engines failed for {query!r}: {errors[-1]}")
     return all_results
 
 
-def agent_discovery(industry, location):
-    """Agent 1.5: Lead Discovery Agent (Real Web Search & Scraping)"""
+DISCOVERY_QUERY_TEMPLATES = [
+    '"{industry}" companies in "{location}" contact email phone',
+    '{industry} companies {location} email address contact',
+    'list of {industry} companies in {location} with contact details',
+    '{industry} agencies {location} email phone number',
+    '{industry} firms {location} contact information'
+]
+DISCOVERY_MAX_RAW_RESULTS = 15
+DISCOVERY_MAX_CANDIDATES = 10
+# Pages scraped in parallel while discovery streams leads
+DISCOVERY_SCRAPE_CONCURRENCY = int(os.getenv("DISCOVERY_SCRAPE_CONCURRENCY", "3"))
+
+
+def progress_event(stage, **data):
+    return {'type': 'progress', 'stage': stage, **data}
+
+
+def lead_event(lead):
+    return {'type': 'lead', 'lead': lead}
+
+
+def collect_leads(events):
+    """Drain a lead event generator and return just the leads"""
+    return [event['lead'] for event in events if event.get('type') == 'lead']
+
+
+def _lead_from_search_result(r, source, location=None):
+    """Scrape one search result and build a candidate lead (runs in a worker thread)"""
+    title = r.get('title', 'Unknown Company')
+    link = r.get('href', '')
+    snippet = r.get('body', '')
+
+    print(f"Scraping {link}...")
+    emails, phones, addresses, names = extract_contact_info(link)
+    print(f"Scraping result: {len(emails)} emails, {len(phones)} phones, {len(addresses)} addresses, {len(names)} names")
+
+    email = emails[0] if emails else ''
+    phone = phones[0] if phones else ''
+    address = addresses[0] if addresses else 'Unknown'
+    name = names[0] if names else ''
+
+    # If we still don't have an email, try to find email in snippet
+    if not email:
+        snippet_emails = re.findall(r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}', snippet)
+        if snippet_emails:
+            email = snippet_emails[0]
+            print(f"Found email in snippet: {email}")
+
+    # Extract company name from title
+    company_name = title.split('-')[0].split('|')[0].strip()
+    if len(company_name) < 3:
+        company_name = "Unknown Company"
+
+    # Create lead if we have either email or phone
+    if not email and not phone:
+        print("No email or phone found for this lead.")
+        return None
+
+    lead = {
+        'name': name if name else f'Contact at {company_name}',
+        'email': email,
+        'phone': phone,
+        'company': company_name,
+        'location': location or address,
+        'source': source
+    }
+
+    # Check if we already have this lead (basic duplicate check)
+    existing = db.get_lead_by_email(email) if email else None
+    if existing:
+        print(f"Duplicate lead skipped: {email or phone}")
+        return None
+
+    print(f"Found candidate lead: {company_name} - {email or phone}")
+    return optimize_lead_data_with_ai(lead)
+
+
+def _drain_lead_futures(pending, block):
+    """Yield lead events for finished scrape futures, removing them from `pending`."""
+    # as_completed yields each future as it finishes, so leads stream out one by one
+    finished = as_completed(list(pending)) if block else [f for f in pending if f.done()]
+    for future in finished:
+        pending.discard(future)
+        try:
+            lead = future.result()
+        except Exception as e:
+            print(f"Candidate processing failed: {e}")
+            continue
+        if lead:
+            yield lead_event(lead)
+
+
+def iter_discovery(industry, location, usage=None):
+    """Generator pipeline behind agent_discovery.
+
+    Searches query variations one at a time and hands every relevant result
+    to a small scrape pool as soon as it arrives, yielding progress and lead
+    events as they happen. Closing the generator stops the run; queued
+    scrapes are cancelled.
+    """
     print(f"🔍 Searching for {industry} in {location}...")
-    
-    found_leads = []
-    
-    # Try multiple query variations optimized for finding contact information
-    queries = [
-        f'"{industry}" companies in "{location}" contact email phone',
-        f'{industry} companies {location} email address contact',
-        f'list of {industry} companies in {location} with contact details',
-        f'{industry} agencies {location} email phone number',
-        f'{industry} firms {location} contact information'
-    ]
-    
-    all_results = []
-    seen_links = set()
+    usage = usage or SearchUsage()
+    industry_keywords = industry.lower().split()
+    location_lower = location.lower()
 
+    raw_results = []
+    seen_links = set()
+    submitted = 0
+    found = 0
+    pending = set()
+    pool = ThreadPoolExecutor(max_workers=DISCOVERY_SCRAPE_CONCURRENCY)
     try:
-        for query in queries:
-            results = search_the_web(query, max_results=8)  # Increased from 5 to 8 for more results
+        yield progress_event('started', industry=industry, location=location)
+        for template in DISCOVERY_QUERY_TEMPLATES:
+            if len(raw_results) >= DISCOVERY_MAX_RAW_RESULTS:
+                break
+            query = template.format(industry=industry, location=location)
+            results = search_the_web(query, max_results=8, usage=usage)
+            fresh = []
             for r in results:
                 link = r.get('href', '')
                 if link and link not in seen_links:
-                    all_results.append(r)
                     seen_links.add(link)
-            
-            if len(all_results) >= 15:  # Increased threshold
-                break
-        
-        if not all_results:
-            print("❌ No results from any search engine. Returning empty list.")
-            return []
+                    fresh.append(r)
+            raw_results.extend(fresh)
+            yield progress_event('searched', query=query, results=len(fresh), total_results=len(raw_results))
 
-        print(f"✅ Found {len(all_results)} total raw results.")
+            for r in fresh:
+                if submitted >= DISCOVERY_MAX_CANDIDATES:
+                    break
+                title = r.get('title', '').lower()
+                snippet = r.get('body', '').lower()
+                # Only keep results mentioning the industry or location
+                industry_match = any(k in title or k in snippet for k in industry_keywords)
+                location_match = location_lower in title or location_lower in snippet
+                if not (industry_match or location_match):
+                    continue
+                # Skip social media, aggregators and listicles - we want official company pages
+                verdict = search_filters.classify_result(r, profile='discovery')
+                if not verdict.accepted:
+                    print(f"Skipping {verdict.reason} ({verdict.match}): {r.get('href')}")
+                    continue
+                submitted += 1
+                pending.add(pool.submit(_lead_from_search_result, r, 'ai_discovery_web', location))
 
-        # Filter results to only include relevant ones (contain industry or location in title/href)
-        filtered_results = []
-        industry_lower = industry.lower()
-        location_lower = location.lower()
-        
-        # Split industry into keywords for broader matching
-        industry_keywords = industry_lower.split()
-        
-        for r in all_results:
-            title = r.get('title', '').lower()
-            href = r.get('href', '').lower()
-            snippet = r.get('body', '').lower()
-            
-            # Check if any industry keyword is present
-            industry_match = any(k in title for k in industry_keywords) or any(k in snippet for k in industry_keywords)
-            location_match = location_lower in title or location_lower in snippet
-            
-            if industry_match or location_match:
-                filtered_results.append(r)
-        
-        if not filtered_results:
-            print("⚠️ No strictly relevant results found after filtering. Using top raw results.")
-            filtered_results = all_results[:5] # Fallback to top 5 raw results
-        else:
-            print(f"✅ Filtered down to {len(filtered_results)} relevant results.")
-
-        for i, r in enumerate(filtered_results[:10]):  # Process top 10 filtered results
-            print(f"--- Processing result {i+1} ---")
-            title = r.get('title', 'Unknown Company')
-            link = r.get('href', '')
-            snippet = r.get('body', '')
-            print(f"Title: {title}")
-            print(f"Link: {link}")
-            
-            # Skip only social media and irrelevant directories
-            if any(x in link.lower() for x in ['linkedin.com', 'facebook.com', 'twitter.com', 'instagram.com']):
-                print("Skipping social media link.")
-                continue
-            
-            # Skip aggregators and listicles if user wants "official pages"
-            # Common patterns for listicles: "top-10", "best-20", "clutch.co", "yelp.com", "justdial.com", "sulekha.com"
-            # But wait, user might WANT justdial if they are scraping it specifically. 
-            # However, for "Web Search" (Smart Lead Finder), we usually want direct company sites.
-            # The user specifically asked to avoid "Top 20" etc.
-            
-            skip_keywords = ['top-', 'best-', 'list-of', 'directory', 'clutch.co', 'yelp.com', 'sulekha.com', 'justdial.com', 'yellowpages', 'thumbtack', 'upwork', 'fiverr']
-            if any(k in link.lower() for k in skip_keywords) or any(k in title.lower() for k in ['top ', 'best ', 'list of ']):
-                print(f"Skipping aggregator/listicle: {link}")
-                continue
+            for event in _drain_lead_futures(pending, block=False):
+                found += 1
+                yield event
 
-            print(f"Scraping {link}...")
-            emails, phones, addresses, names = extract_contact_info(link)
-            print(f"Scraping result: {len(emails)} emails, {len(phones)} phones, {len(addresses)} addresses, {len(names)} names")
-
-            # If no email found on page, try to guess from snippet
-            email = emails[0] if emails else ''
-            phone = phones[0] if phones else ''
-            address = addresses[0] if addresses else ''
-            name = names[0] if names else ''
-
-            # If we still don't have an email, try to find email in snippet
-            if not email:
-                snippet_emails = re.findall(r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}', snippet)
-                if snippet_emails:
-                    email = snippet_emails[0]
-                    print(f"Found email in snippet: {email}")
-
-            # Extract company name from title
-            company_name = title.split('-')[0].split('|')[0].strip()
-            if len(company_name) < 3:
-                company_name = "Unknown Company"
-
-            # Create lead if we have either email or phone
-            if email or phone:
-                # Use extracted name if available, otherwise create a generic one
-                contact_name = name if name else f'Contact at {company_name}'
-                lead = {
-                    'name': contact_name,
-                    'email': email,
-                    'phone': phone,
-                    'company': company_name,
-                    'location': location,
-                    'source': 'ai_discovery_web'
-                }
-
-                # Check if we already have this lead (basic duplicate check)
-                existing = db.get_lead_by_email(email) if email else None
-                if not existing:
-                    # Optimize with AI before returning
-                    lead = optimize_lead_data_with_ai(lead)
-                    
-                    # db.insert_lead(lead) # Don't insert yet, just return
-                    found_leads.append(lead)
-                    print(f"Found candidate lead: {company_name} - {email or phone}")
-                else:
-                    print(f"Duplicate lead skipped: {email or phone}")
-            else:
-                print("No email or phone found for this lead.")
-                
+        if not raw_results:
+            print("❌ No results from any search engine. Returning empty list.")
+        elif submitted == 0:
+            print("⚠️ No strictly relevant results found after filtering. Using top raw results.")
+            for r in raw_results[:5]:
+                if search_filters.classify_result(r, profile='discovery').accepted:
+                    submitted += 1
+                    pending.add(pool.submit(_lead_from_search_result, r, 'ai_discovery_web', location))
+
+        yield progress_event('scraping', candidates=submitted, total_results=len(raw_results))
+        for event in _drain_lead_futures(pending, block=True):
+            found += 1
+            yield event
     except Exception as e:
-        import traceback
         print(f"Discovery Error: {e}")
         traceback.print_exc()
-        # Fallback to mock if search fails completely (e.g. rate limits)
-        return []
-            
-    print(f"--- Discovery finished. Found {len(found_leads)} total leads. ---")
-    return found_leads
+        yield {'type': 'error', 'error': str(e)}
+    finally:
+        # Drop queued scrapes by hand: shutdown(cancel_futures=True) needs Python 3.9
+        for future in pending:
+            future.cancel()
+        pool.shutdown(wait=False)
+
+    print(f"--- Discovery finished. Found {found} total leads. Search usage: {usage.as_dict()} ---")
+    yield progress_event('done', leads=found, usage=usage.as_dict())
+
+
+def agent_discovery(industry, location, usage=None):
+    """Agent 1.5: Lead Discovery Agent (Real Web Search & Scraping)
+
+    Pass a SearchUsage as `usage` to get the search credits used by this run.
+    """
+    return collect_leads(iter_discovery(industry, location, usage=usage))
 
 def agent_scrape_specific_url(url):
     """Enhanced Agent: Scrape specific URL for comprehensive lead information"""
@@ -1772,9 +2429,8 @@ def agent_analyze_business(lead):
                 "growth_potential": "Medium",
                 "reasoning": "Gemini client not configured"
             }
-        model = client.GenerativeModel(model_name)
         
-        prompt = f"""
+        task = f"""
         Analyze this business lead for a B2B service provider (Digital Marketing/Tech Services).
         
         Lead Details:
@@ -1788,23 +2444,9 @@ def agent_analyze_business(lead):
         2. Classify 'business_maturity' as 'Startup', 'SMB', or 'Enterprise'.
         3. Estimate 'growth_potential' as 'Low', 'Medium', or 'High'.
         4. Provide a short 'reasoning' (max 2 sentences).
-        
-        Return ONLY a valid JSON object with keys: trust_score, business_maturity, growth_potential, reasoning.
         """
         
-        response = model.generate_content(prompt)
-        cleaned_json = response.text.strip()
-        if cleaned_json.startswith('```json'):
-            cleaned_json = cleaned_json[7:-3]
-        elif cleaned_json.startswith('```'):
-            cleaned_json = cleaned_json[3:-3]
-            
-        analysis = json.loads(cleaned_json)
-        
-        # Ensure types are correct
-        analysis['trust_score'] = int(analysis.get('trust_score', 50))
-        
-        return analysis
+        return structured_gemini(task, BUSINESS_ANALYSIS_SCHEMA)
         
     except Exception as e:
         print(f"❌ AI Analysis Failed: {e}")
@@ -1816,6 +2458,196 @@ def agent_analyze_business(lead):
             "reasoning": f"AI Analysis failed: {str(e)}"
         }
 
+BUSINESS_MATURITY_VALUES = BUSINESS_ANALYSIS_SCHEMA.fields['business_maturity'].choices
+GROWTH_POTENTIAL_VALUES = BUSINESS_ANALYSIS_SCHEMA.fields['growth_potential'].choices
+
+
+def _quoted_choices(values):
+    """'A', 'B', or 'C'"""
+    quoted = [f"'{v}'" for v in values]
+    return ', '.join(quoted[:-1]) + ', or ' + quoted[-1] if len(quoted) > 1 else ''.join(quoted)
+
+
+BATCH_ANALYSIS_PROMPT = f"""
+Analyze these business leads for a B2B service provider (Digital Marketing/Tech Services).
+
+For EACH lead:
+1. Estimate 'trust_score' (0-100) based on company name professionalism, location, and contact info quality.
+2. Classify 'business_maturity' as {_quoted_choices(BUSINESS_MATURITY_VALUES)}.
+3. Estimate 'growth_potential' as {_quoted_choices(GROWTH_POTENTIAL_VALUES)}.
+4. Provide a short 'reasoning' (max 2 sentences).
+
+Return ONLY a valid JSON array with one object per lead and keys:
+id (copied from the input), trust_score, business_maturity, growth_potential, reasoning.
+
+Leads (one JSON object per line):
+"""
+
+
+def _analysis_input_line(lead):
+    return json.dumps({
+        'id': lead['id'],
+        'company': lead.get('company') or 'Unknown',
+        'location': lead.get('location') or 'Unknown',
+        'email': lead.get('email') or 'Unknown',
+        'phone': lead.get('phone') or 'Unknown',
+    }, ensure_ascii=False)
+
+
+def pack_leads_by_token_budget(leads, max_tokens=None, max_leads=None):
+    """Split leads into prompt-sized batches of (lead, input_line) pairs"""
+    max_tokens = max_tokens or AI_BATCH_MAX_PROMPT_TOKENS
+    max_leads = max_leads or AI_BATCH_MAX_LEADS
+    budget = max(1, max_tokens - estimate_tokens(BATCH_ANALYSIS_PROMPT))
+    batches, current, used = [], [], 0
+    for lead in leads:
+        line = _analysis_input_line(lead)
+        cost = estimate_tokens(line)
+        if current and (used + cost > budget or len(current) >= max_leads):
+            batches.append(current)
+            current, used = [], 0
+        current.append((lead, line))
+        used += cost
+    if current:
+        batches.append(current)
+    return batches
+
+
+def parse_json_array(text):
+    """Return the first JSON array found in an AI response, or None"""
+    return first_json_value(text, list)
+
+
+def validate_business_analysis(item):
+    """Normalize one analysis object, or return None if it is unusable"""
+    analysis, _ = BUSINESS_ANALYSIS_SCHEMA.validate_item(item)
+    if analysis is None:
+        return None
+    return {
+        'trust_score': analysis['trust_score'],
+        'business_maturity': analysis['business_maturity'],
+        'growth_potential': analysis['growth_potential'],
+        'reasoning': analysis.get('reasoning') or '',
+    }
+
+
+def _batch_analysis_prompt(batch):
+    return BATCH_ANALYSIS_PROMPT + "\n".join(line for _, line in batch)
+
+
+def _parse_batch_analysis(batch, text):
+    """Map a batch response back to {lead_id: analysis} for the valid items"""
+    ids = {str(lead['id']): lead['id'] for lead, _ in batch}
+    analyses = {}
+    for item in parse_json_array(text) or []:
+        if not isinstance(item, dict):
+            continue
+        lead_id = ids.get(str(item.get('id')).strip())
+        analysis = validate_business_analysis(item)
+        if lead_id is not None and analysis:
+            analyses[lead_id] = analysis
+    return analyses
+
+
+def agent_analyze_businesses(leads, max_tokens=None, max_leads=None, max_retries=None):
+    """Batched agent_analyze_business: several leads per Gemini prompt.
+
+    Items missing from or invalid in a response are retried (only those
+    items) up to `max_retries` times. Returns ({lead_id: analysis}, failed_ids).
+    """
+    leads = [lead for lead in leads or [] if lead and lead.get('id') is not None]
+    max_retries = AI_BATCH_MAX_RETRIES if max_retries is None else max_retries
+    if not leads:
+        return {}, []
+
+    if not GEMINI_API_KEY or not get_genai() or not get_working_gemini_model():
+        # Same mock / default behaviour as the single-lead agent
+        return {lead['id']: agent_analyze_business(lead) for lead in leads}, []
+
+    results = {}
+    pending = leads
+    for attempt in range(max_retries + 1):
+        if not pending:
+            break
+        batches = pack_leads_by_token_budget(pending, max_tokens, max_leads)
+        print(f"🤖 Analyzing {len(pending)} businesses with Gemini in {len(batches)} batch(es) (attempt {attempt + 1})")
+        failed = []
+        # Batches run concurrently within the Gemini quota; never cached, so a
+        # retried batch can't be answered with the response that just failed
+        with AI_LEDGER.agent('analyze_business_batch'):
+            responses = AI_EXECUTOR.map([_batch_analysis_prompt(b) for b in batches], services='gemini', use_cache=False)
+        for batch, response in zip(batches, responses):
+            if isinstance(response, Exception):
+                print(f"❌ Batch analysis of {len(batch)} leads failed: {response}")
+                analyses = {}
+            else:
+                analyses = _parse_batch_analysis(batch, response[0])
+            for lead, _ in batch:
+                if lead['id'] in analyses:
+                    results[lead['id']] = analyses[lead['id']]
+                else:
+                    failed.append(lead)
+        pending = failed
+
+    if pending:
+        print(f"⚠️ Batch analysis gave up on {len(pending)} lead(s)")
+    return results, [lead['id'] for lead in pending]
+
+
+def analyze_leads_staged(leads, use_prescoring=None, **kwargs):
+    """Two-stage analysis: vectorized rule pre-scoring decides the clear accepts and
+    rejects, only the uncertain leads go to the batched LLM analyzer.
+
+    Returns (analyses, failed_ids, stage_counts); every analysis carries
+    'decided_by' ('rules' or 'llm').
+    """
+    use_prescoring = prescoring.PRESCORE_ENABLED if use_prescoring is None else use_prescoring
+    if use_prescoring:
+        analyses, uncertain, counts = prescoring.prescore_leads(leads)
+    else:
+        analyses, uncertain, counts = {}, list(leads), {}
+
+    llm_analyses, failed = agent_analyze_businesses(uncertain, **kwargs) if uncertain else ({}, [])
+    for lead_id, analysis in llm_analyses.items():
+        analysis['decided_by'] = prescoring.STAGE_LLM
+        analyses[lead_id] = analysis
+
+    stage_counts = {
+        prescoring.STAGE_RULES: len(analyses) - len(llm_analyses),
+        prescoring.STAGE_LLM: len(llm_analyses),
+        'prescore': counts,
+    }
+    if use_prescoring:
+        print(f"[PRESCORE] {stage_counts[prescoring.STAGE_RULES]} lead(s) decided by rules, "
+              f"{len(uncertain)} sent to the LLM")
+    return analyses, failed, stage_counts
+
+
+def analyze_leads_batch(leads, **kwargs):
+    """Analyze leads (rules first, then batched LLM), decide outreach and persist with one batched UPDATE"""
+    analyses, failed, stages = analyze_leads_staged(leads, **kwargs)
+    rows, results = [], []
+    for lead in leads:
+        analysis = analyses.get(lead.get('id'))
+        if not analysis:
+            continue
+        decision = agent_decide_outreach(analysis)
+        status = 'analyzed' if decision == 'OUTREACH' else 'skipped'
+        rows.append((lead['id'], json.dumps(analysis), analysis.get('trust_score', 0), status))
+        results.append({'lead_id': lead['id'], 'analysis': analysis, 'decision': decision,
+                        'status': status, 'decided_by': analysis.get('decided_by')})
+    try:
+        db.update_leads_analysis_batch(rows)
+        # Without this a lead the AI can't analyze stays 'new' and is retried every autopilot cycle
+        given_up = db.record_analysis_failures(failed, ANALYSIS_MAX_ATTEMPTS)
+    except Exception as e:
+        print(f"❌ Failed to save batch analysis: {e}")
+        return {'results': results, 'failed': failed, 'saved': 0, 'stages': stages, 'error': str(e)}
+    if given_up:
+        print(f"⚠️ {given_up} lead(s) marked analysis_failed after {ANALYSIS_MAX_ATTEMPTS} failed analyses")
+    return {'results': results, 'failed': failed, 'saved': len(rows), 'stages': stages}
+
+
 def agent_decide_outreach(analysis):
     """Agent 4: Decision Agent (Mock)"""
     trust_score = analysis.get('trust_score', 0)
@@ -1869,7 +2701,6 @@ def agent_generate_message(lead, strategy="polite"):
         if not client:
             # Fallback to simple template if Gemini isn't available
             return f"Hello {name},\n\nMy name is Mogeshwaran and I work with a digital marketing agency. I noticed {company} and thought we might be able to help with your online marketing needs.\n\nWould you be open to a quick conversation?\n\nThank you,\nMogeshwaran"
-        model = client.GenerativeModel(model_name)
         
         prompt = f"""
         Write a cold outreach email for a digital marketing agency.
@@ -1889,37 +2720,36 @@ def agent_generate_message(lead, strategy="polite"):
         Return ONLY the email body text. No subject line.
         """
         
-        response = model.generate_content(prompt)
-        return response.text.strip()
+        return gemini_generate_text(prompt, use_cache=False, agent='generate_message').strip()
         
     except Exception as e:
         print(f"❌ AI Message Generation Failed: {e}")
         return f"Hello {name},\n\nI noticed {company} and thought we might be able to help with your online marketing needs.\n\nWould you be open to a quick conversation?\n\nThank you,\nMogeshwaran"
 
-def agent_send_outreach(lead, message, subject=None):
-    """Agent 7: Outreach Agent (Real SMTP + Mock Fallback)
+def agent_send_outreach(lead, message, subject=None, idempotency_key=None, kind='outreach', after_send=None,
+                        html_body=None):
+    """Agent 7: Outreach Agent (queues the email on the outbox)
+
+    The outbox workers send it (Brevo/SMTP, HTML, tracking) and log it
+    against the lead once delivered.
 
-    Returns a tuple: (success: bool, reason: str|None)
+    Returns a tuple: (queued: bool, reason: str|None, outbox result dict|None)
     """
     if not subject:
         subject = f"Connecting with {lead.get('company', 'your team')}"
 
-    # Use the consolidated send_email helper which handles Brevo/SMTP, HTML, and Tracking
-    success, err = send_email(lead.get('email'), subject, message, lead_name=lead.get('name'), lead_id=lead.get('id'))
-
-    # Normalize result (checks for DRY_RUN)
-    success, dry_run, reason = normalize_outreach_result(success, err)
-
-    if success:
-        log_message = message if not dry_run else f"{message}\n\n[DRY RUN MODE]"
-        try:
-            db.log_outreach(lead['id'], 'email', log_message)
-        except Exception as e:
-            print(f"⚠️ Failed to log outreach for lead {lead.get('id')}: {e}")
-        return True, reason
-    else:
-        print(f"❌ Outreach Failed for {lead.get('email')}: {reason}")
-        return False, reason
+    if after_send is None:
+        after_send = {'log_type': 'email',
+                      'next_action_in': next_action_delay(lead, lead.get('current_sequence_step'))}
+    queued = enqueue_email(
+        lead.get('email'), subject, message,
+        idempotency_key=idempotency_key, lead_id=lead.get('id'), to_name=lead.get('name'),
+        kind=kind, after_send=after_send, html_body=html_body,
+    )
+    if queued['status'] == 'failed':
+        print(f"❌ Outreach Failed for {lead.get('email')}: {queued['error']}")
+        return False, queued['error'], None
+    return True, None, queued
 
 def autonomous_loop():
     """Background task for Autopilot Mode"""
@@ -1930,102 +2760,30 @@ def autonomous_loop():
 
         print("--- Autopilot Running ---")
         pending_leads = db.get_pending_leads()
-        
+
+        new_leads = [lead for lead in pending_leads if lead['status'] == 'new']
+        if new_leads:
+            print(f"Auto-Analyzing {len(new_leads)} lead(s)")
+            analyze_leads_batch(new_leads)
+
+        # Leads with an email still waiting in the outbox keep their status until it is sent
+        in_flight = db.get_outbox_pending_lead_ids([lead['id'] for lead in pending_leads])
+
         for lead in pending_leads:
-            if lead['status'] == 'new':
-                print(f"Auto-Analyzing lead: {lead['id']}")
-                analysis = agent_analyze_business(lead)
-                decision = agent_decide_outreach(analysis)
-                status = 'analyzed' if decision == 'OUTREACH' else 'skipped'
-                db.update_lead_analysis(lead['id'], json.dumps(analysis), analysis.get('trust_score', 0), status)
-                
-            elif lead['status'] == 'analyzed':
+            if lead['id'] in in_flight:
+                continue
+            if lead['status'] == 'analyzed':
                 print(f"Auto-Outreach lead: {lead['id']}")
                 # Get analysis for strategy determination
                 analysis = json.loads(lead.get('ai_analysis', '{}'))
                 strategy = agent_message_strategy(lead, analysis)
                 message = agent_generate_message(lead, strategy)
-                success, reason = agent_send_outreach(lead, message)
+                success, reason, _ = agent_send_outreach(lead, message, idempotency_key=f"auto-outreach:{lead['id']}")
                 if not success:
                     print(f"Auto-outreach failed for lead {lead.get('id')}: {reason}")
                 
-            elif lead['status'] == 'outreach_sent' and lead.get('campaign_id'):
-                # Check for drip sequence
-                campaign_id = lead['campaign_id']
-                sequences = db.get_campaign_sequences(campaign_id)
-                current_step = lead.get('current_sequence_step', 0)
-                last_outreach = lead.get('last_outreach_at')
-                
-                # Find next step
-                next_step = None
-                for seq in sequences:
-                    if seq['day_offset'] > current_step: # Assuming current_step stores the day_offset of last sent
-                         # Actually, let's store the index or just check day_offset logic
-                         # Simplified: current_sequence_step is the index of the last sent sequence. 0 means initial.
-                         pass
-
-                # Better logic:
-                # current_sequence_step = 0 (Initial sent)
-                # We look for a sequence with day_offset > 0
-                
-                # Let's assume sequences are ordered by day_offset
-                # If current_sequence_step is 0, we look for the first follow up (e.g. day 3)
-                
-                # Find the sequence that corresponds to the *next* step
-                # We need to know what "step 1" means. Is it the 1st follow up? Yes.
-                
-                # Let's say current_sequence_step = 0.
-                # We want to find a sequence where day_offset is appropriate.
-                
-                if not last_outreach:
-                    continue
-                    
-                import datetime
-                days_since_last = (datetime.datetime.now() - last_outreach).days
-                
-                # Find the next sequence to send
-                target_seq = None
-                for seq in sequences:
-                    # If this sequence hasn't been sent yet (we can track this by storing the last sent day_offset in current_sequence_step)
-                    # Let's say current_sequence_step stores the day_offset of the last email.
-                    # Initial email is day_offset 0.
-                    
-                    if seq['day_offset'] > lead.get('current_sequence_step', 0):
-                        # This is a potential next step
-                        # Check if enough time has passed from INITIAL outreach? Or LAST outreach?
-                        # Usually drip is "Day 3" means 3 days after start.
-                        
-                        # We need the date of the FIRST outreach to calculate absolute day offset.
-                        # Or we just use relative gaps.
-                        
-                        # Simple approach: Day 3 means 3 days after the previous step? Or 3 days from start?
-                        # Standard is days from start.
-                        # But we only have last_outreach_at.
-                        
-                        # Let's use relative for simplicity in this MVP.
-                        # If seq['day_offset'] is 3, it means 3 days after the previous email.
-                        
-                        if days_since_last >= seq['day_offset']:
-                            target_seq = seq
-                            break
-                
-                if target_seq:
-                    print(f"Auto-Drip lead: {lead['id']} - Step {target_seq['day_offset']}")
-                    # Generate message using template
-                    # We can use AI to personalize the template
-                    template = target_seq['template_body']
-                    # Simple variable substitution
-                    message = template.replace('{name}', lead.get('name', 'there')).replace('{company}', lead.get('company', 'your company'))
-                    
-                    # Send
-                    success, reason = agent_send_outreach(lead, message)
-                    if not success:
-                        print(f"Auto-drip failed for lead {lead.get('id')}: {reason}")
-                    
-                    # Update state
-                    # We use the day_offset as the step indicator
-                    db.update_lead_sequence_step(lead['id'], target_seq['day_offset'])
-                
+            # Campaign drips are sent by SEND_SCHEDULER when next_action_at comes due
+
         print("--- Autopilot Cycle Complete ---")
 
 def agent_analyze_response(response_text, lead):
@@ -2051,32 +2809,21 @@ def agent_analyze_response(response_text, lead):
         client = get_genai()
         if not client:
             return {"interest_level": "low", "sentiment": "negative", "next_action": "stop", "reasoning": "Gemini client not available"}
-        model = client.GenerativeModel(model_name)
         
-        prompt = f"""
+        task = f"""
         Analyze this email response from a lead.
         
         Lead: {lead.get('name', 'Unknown')} ({lead.get('company', 'Unknown Company')})
         Response Text: "{response_text}"
         
         Task:
-        1. Determine 'sentiment' (Positive, Neutral, Negative).
-        2. Estimate 'interest_level' (High, Medium, Low).
+        1. Determine 'sentiment' (positive, neutral, negative).
+        2. Estimate 'interest_level' (high, medium, low).
         3. Recommend 'next_action' (reply_immediately, schedule_meeting, send_info, follow_up_later, do_not_contact).
         4. Provide a short 'reasoning'.
-        
-        Return ONLY a valid JSON object with keys: sentiment, interest_level, next_action, reasoning.
         """
         
-        response = model.generate_content(prompt)
-        cleaned_json = response.text.strip()
-        if cleaned_json.startswith('```json'):
-            cleaned_json = cleaned_json[7:-3]
-        elif cleaned_json.startswith('```'):
-            cleaned_json = cleaned_json[3:-3]
-            
-        analysis = json.loads(cleaned_json)
-        return analysis
+        return structured_gemini(task, RESPONSE_ANALYSIS_SCHEMA, use_cache=False)
         
     except Exception as e:
         print(f"❌ AI Response Analysis Failed: {e}")
@@ -2098,100 +2845,132 @@ def agent_followup_logic(lead, response_analysis, follow_up_count):
     else:
         return False
 
-def agent_targeted_search(location, niche, offering):
-    """Agent 1.7: Targeted Lead Finder (Smart Search)"""
-    print(f"🎯 Targeted Search: {niche} in {location} for {offering}")
-    
-    # Negative keywords to exclude aggregators and listicles
-    negatives = '-site:justdial.com -site:sulekha.com -site:indiamart.com -site:tripadvisor.com -site:yelp.com -"top 10" -"top 20" -"best 10" -"list of"'
-    
-    queries = []
-    if offering == "Landing Page":
-        # Strategy: Find businesses that rely on social media or free emails (likely no website)
-        queries = [
-            f'site:facebook.com "{niche}" "{location}" "phone" "gmail.com"',
-            f'site:instagram.com "{niche}" "{location}" "contact" "gmail.com"',
-            f'"{niche}" "{location}" "@gmail.com" {negatives}', 
-            f'"{niche}" "{location}" "contact number" {negatives}'
-        ]
-    elif offering == "Billing Software":
-        # Strategy: Find retail/wholesale businesses that have high transaction volume
-        queries = [
-            f'"{niche}" "{location}" "store" contact email {negatives}',
-            f'"{niche}" "{location}" "distributors" contact {negatives}',
-            f'"{niche}" shop "{location}" phone number {negatives}',
-            f'"{niche}" wholesalers "{location}" contact {negatives}'
-        ]
-    else:
-        # General search
-        queries = [f'"{niche}" in "{location}" contact details email phone {negatives}']
+TARGETED_QUERY_TEMPLATES = {
+    # Strategy: Find businesses that rely on social media or free emails (likely no website)
+    "Landing Page": [
+        'site:facebook.com "{niche}" "{location}" "phone" "gmail.com"',
+        'site:instagram.com "{niche}" "{location}" "contact" "gmail.com"',
+        '"{niche}" "{location}" "@gmail.com" {negatives}',
+        '"{niche}" "{location}" "contact number" {negatives}'
+    ],
+    # Strategy: Find retail/wholesale businesses that have high transaction volume
+    "Billing Software": [
+        '"{niche}" "{location}" "store" contact email {negatives}',
+        '"{niche}" "{location}" "distributors" contact {negatives}',
+        '"{niche}" shop "{location}" phone number {negatives}',
+        '"{niche}" wholesalers "{location}" contact {negatives}'
+    ],
+}
+GENERAL_QUERY_TEMPLATES = ['"{niche}" in "{location}" contact details email phone {negatives}']
+
+# Negative keywords to exclude aggregators and listicles
+TARGETED_NEGATIVES = '-site:justdial.com -site:sulekha.com -site:indiamart.com -site:tripadvisor.com -site:yelp.com -"top 10" -"top 20" -"best 10" -"list of"'
+
+
+def _collect_targeted_leads(results, location, offering, found_leads, seen_urls):
+    """Turn search results into targeted leads, appending to found_leads.
+
+    Returns (new_leads, duplicates) for the query planner's statistics.
+    """
+    added = 0
+    duplicates = 0
+    for r in results:
+        link = r.get('href', '')
+        title = r.get('title', '').lower()
+        snippet = r.get('body', '').lower()
+
+        if link in seen_urls:
+            duplicates += 1
+            continue
+
+        # Filter out listicles/directories based on title
+        verdict = search_filters.classify_result(r, profile='targeted_search')
+        if not verdict.accepted:
+            print(f"      Skipping {verdict.reason} ({verdict.match}): {title}")
+            continue
+
+        seen_urls.add(link)
+
+        # Extract emails from snippet
+        emails = re.findall(r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}', snippet)
+        # Extract phones (simple pattern for Indian numbers often found in snippets)
+        phones = re.findall(r'(?:\+91[\-\s]?)?[6789]\d{9}', snippet)
+
+        email = emails[0] if emails else ''
+        phone = phones[0] if phones else ''
+
+        # Clean up company name
+        company_name = r.get('title', '').split('-')[0].split('|')[0].split(':')[0].strip()
+        if "profile" in company_name.lower() or "login" in company_name.lower():
+            continue
+
+        # If we found at least one contact method
+        if email or phone:
+            lead = {
+                'name': f"Owner/Manager",
+                'email': email,
+                'phone': phone,
+                'company': company_name,
+                'location': location,
+                'source': f'targeted_{offering.lower().replace(" ", "_")}',
+                'status': 'new',
+                'trust_score': 60
+            }
+
+            # Deduplicate by email or phone locally before adding
+            if not any(l['email'] == email for l in found_leads if email) and \
+               not any(l['phone'] == phone for l in found_leads if phone):
+                found_leads.append(lead)
+                added += 1
+                print(f"      Found lead: {company_name} ({email or phone})")
+            else:
+                duplicates += 1
+    return added, duplicates
 
-    found_leads = []
-    seen_urls = set()
 
-    # Keywords that indicate a listicle or directory in the title
-    listicle_indicators = ['top 10', 'top 20', 'top 50', 'best ', 'list of', 'directory', 'yellow pages', 'listings', 'providers in']
+def iter_targeted_search(location, niche, offering, max_leads=None, usage=None):
+    """Generator form of agent_targeted_search yielding progress and lead events.
 
-    for query in queries:
-        print(f"   Running query: {query}")
-        try:
-            results = search_the_web(query, max_results=15)
-            
-            for r in results:
-                link = r.get('href', '')
-                title = r.get('title', '').lower()
-                snippet = r.get('body', '').lower()
+    Query templates are ordered and pruned by the adaptive query planner and
+    run concurrently; the run stops early once `max_leads` leads are found or
+    the generator is closed.
+    """
+    print(f"🎯 Targeted Search: {niche} in {location} for {offering}")
+    usage = usage or SearchUsage()
 
-                if link in seen_urls:
-                    continue
-                
-                # Filter out listicles/directories based on title
-                if any(indicator in title for indicator in listicle_indicators):
-                    print(f"      Skipping listicle/directory: {title}")
-                    continue
+    templates = TARGETED_QUERY_TEMPLATES.get(offering, GENERAL_QUERY_TEMPLATES)
+    planner = QueryPlanner(offering, templates)
+    planner.load_stats()
 
-                seen_urls.add(link)
-                
-                # Extract emails from snippet
-                emails = re.findall(r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}', snippet)
-                # Extract phones (simple pattern for Indian numbers often found in snippets)
-                phones = re.findall(r'(?:\+91[\-\s]?)?[6789]\d{9}', snippet)
-                
-                email = emails[0] if emails else ''
-                phone = phones[0] if phones else ''
-                
-                # Clean up company name
-                company_name = r.get('title', '').split('-')[0].split('|')[0].split(':')[0].strip()
-                if "profile" in company_name.lower() or "login" in company_name.lower():
-                    continue
+    found_leads = []
+    seen_urls = set()
+    emitted = 0
+
+    yield progress_event('started', location=location, niche=niche, offering=offering)
+    steps = planner.iter_run(
+        lambda query: search_the_web(query, max_results=15, usage=usage, raise_on_failure=True),
+        lambda results: _collect_targeted_leads(results, location, offering, found_leads, seen_urls),
+        target=max_leads,
+        niche=niche,
+        location=location,
+        negatives=TARGETED_NEGATIVES
+    )
+    try:
+        for step in steps:
+            yield progress_event('searched', **step)
+            while emitted < len(found_leads) and not (max_leads and emitted >= max_leads):
+                yield lead_event(found_leads[emitted])
+                emitted += 1
+    finally:
+        steps.close()
+
+    print(f"🎯 Targeted search finished with {emitted} leads. Search usage: {usage.as_dict()}")
+    yield progress_event('done', leads=emitted, usage=usage.as_dict())
 
-                # If we found at least one contact method
-                if email or phone:
-                    lead = {
-                        'name': f"Owner/Manager",
-                        'email': email,
-                        'phone': phone,
-                        'company': company_name,
-                        'location': location,
-                        'source': f'targeted_{offering.lower().replace(" ", "_")}',
-                        'status': 'new',
-                        'trust_score': 60
-                    }
-                    
-                    # Deduplicate by email or phone locally before adding
-                    if not any(l['email'] == email for l in found_leads if email) and \
-                       not any(l['phone'] == phone for l in found_leads if phone):
-                        
-                        # AI Optimization (Optional, can be slow)
-                        # lead = optimize_lead_data_with_ai(lead)
-                        
-                        found_leads.append(lead)
-                        print(f"      Found lead: {company_name} ({email or phone})")
-        except Exception as e:
-            print(f"    Query failed: {e}")
-            continue
 
-    return found_leads
+def agent_targeted_search(location, niche, offering, max_leads=None, usage=None):
+    """Agent 1.7: Targeted Lead Finder (Smart Search)"""
+    return collect_leads(iter_targeted_search(location, niche, offering, max_leads=max_leads, usage=usage))
 
 # --- API ENDPOINTS ---
 
@@ -2202,10 +2981,16 @@ def targeted_search():
     niche = data.get('niche', 'Small Business')
     offering = data.get('offering', 'General')
     
+    try:
+        max_leads = int(data.get('max_leads') or 0) or None
+    except (TypeError, ValueError):
+        max_leads = None
+    
     if not location or not niche:
         return jsonify({"error": "Missing location or niche"}), 400
         
-    leads = agent_targeted_search(location, niche, offering)
+    usage = SearchUsage()
+    leads = agent_targeted_search(location, niche, offering, max_leads=max_leads, usage=usage)
     
     # Save to DB
     saved_count = 0
@@ -2221,71 +3006,53 @@ def targeted_search():
             
     return jsonify({
         "message": f"Search complete. Found {len(leads)} leads, {saved_count} new added.", 
-        "leads": leads
+        "leads": leads,
+        "usage": usage.as_dict()
     })
 
-def agent_keyword_search(keywords):
-    """Agent 1.6: Lead Discovery Agent (Keyword Search)"""
+@api.route('/targeted-search/query-stats', methods=['GET'])
+def targeted_query_stats():
+    """Per-template yield statistics used by the adaptive query planner"""
+    stats = db.get_all_query_template_stats()
+    for row in stats:
+        runs = row.get('runs') or 0
+        row['leads_per_run'] = round((row.get('leads') or 0) / runs, 2) if runs else None
+        row['avg_latency_ms'] = round((row.get('total_latency_ms') or 0) / runs) if runs else None
+        row['dropped'] = is_dropped(row)
+    return jsonify({"templates": stats})
+
+def iter_keyword_search(keywords, usage=None):
+    """Generator form of agent_keyword_search yielding progress and lead events"""
     print(f"Searching for keywords: {keywords}...")
-    
-    found_leads = []
+    usage = usage or SearchUsage()
     query = f"{keywords} contact email"
-    
+    found = 0
+    pending = set()
+    pool = ThreadPoolExecutor(max_workers=DISCOVERY_SCRAPE_CONCURRENCY)
     try:
-        results = search_the_web(query, max_results=10)
-        
-        for r in results:
-            title = r.get('title', 'Unknown Company')
-            link = r.get('href', '')
-            snippet = r.get('body', '')
-            
-            if any(x in link.lower() for x in ['linkedin.com', 'facebook.com', 'twitter.com', 'instagram.com']):
-                continue
-
-            print(f"Scraping {link}...")
-            emails, phones, addresses, names = extract_contact_info(link)
-
-            email = emails[0] if emails else ''
-            phone = phones[0] if phones else ''
-            address = addresses[0] if addresses else 'Unknown'
-            name = names[0] if names else ''
-
-            if not email:
-                snippet_emails = re.findall(r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}', snippet)
-                if snippet_emails:
-                    email = snippet_emails[0]
-
-            company_name = title.split('-')[0].split('|')[0].strip()
-            if len(company_name) < 3:
-                company_name = "Unknown Company"
-
-            if email or phone:
-                contact_name = name if name else f'Contact at {company_name}'
-                lead = {
-                    'name': contact_name,
-                    'email': email,
-                    'phone': phone,
-                    'company': company_name,
-                    'location': address,
-                    'source': 'ai_keyword_search'
-                }
-
-                existing = db.get_lead_by_email(email) if email else None
-                if not existing:
-                    # Optimize with AI
-                    lead = optimize_lead_data_with_ai(lead)
-                    
-                    # db.insert_lead(lead) # Don't insert yet
-                    found_leads.append(lead)
-                    print(f"Found candidate lead: {company_name} - {email or phone}")
-                else:
-                    print(f"Duplicate lead skipped: {email or phone}")
-                
+        yield progress_event('started', keywords=keywords)
+        results = search_the_web(query, max_results=10, usage=usage)
+        candidates = [r for r in results if search_filters.classify_result(r, profile='keyword_search').accepted]
+        yield progress_event('searched', query=query, results=len(results), candidates=len(candidates))
+        for r in candidates:
+            pending.add(pool.submit(_lead_from_search_result, r, 'ai_keyword_search'))
+        for event in _drain_lead_futures(pending, block=True):
+            found += 1
+            yield event
     except Exception as e:
         print(f"Keyword Discovery Error: {e}")
-        return []
-            
-    return found_leads
+        yield {'type': 'error', 'error': str(e)}
+    finally:
+        for future in pending:
+            future.cancel()
+        pool.shutdown(wait=False)
+
+    yield progress_event('done', leads=found, usage=usage.as_dict())
+
+
+def agent_keyword_search(keywords, usage=None):
+    """Agent 1.6: Lead Discovery Agent (Keyword Search)"""
+    return collect_leads(iter_keyword_search(keywords, usage=usage))
 
 @api.route('/web-search', methods=['POST'])
 def web_search():
@@ -2314,27 +3081,7 @@ def web_search():
         
     try:
         results = search_the_web(search_query, max_results=20)
-        
-        filtered_results = []
-        skip_keywords = [
-            'top-', 'best-', 'list-of', 'directory', 'clutch.co', 'yelp.com', 
-            'sulekha.com', 'justdial.com', 'yellowpages', 'thumbtack', 'upwork', 
-            'fiverr', 'linkedin.com', 'facebook.com', 'instagram.com', 'glassdoor',
-            'goodfirms', 'designrush', 'sortlist', 'themanifest'
-        ]
-        
-        skip_titles = ['top 10', 'top 20', 'top 30', 'top 50', 'top 100', 'best ', 'list of ', 'directory', 'reviews']
-
-        for r in results:
-            link = r.get('href', '')
-            title = r.get('title', '').lower()
-            
-            if not link: continue
-            if any(k in link.lower() for k in skip_keywords): continue
-            if any(k in title for k in skip_titles): continue
-                
-            filtered_results.append(r)
-            
+        filtered_results = search_filters.filter_results(results, profile='web_search')
         return jsonify({"results": filtered_results})
     except Exception as e:
         print(f"Web Search Route Error: {e}")
@@ -2364,46 +3111,54 @@ def ai_extract():
         client = get_genai()
         if not client:
             return jsonify({"error": "Gemini client not initialized"}), 503
-        model = client.GenerativeModel(model_name)
-        prompt = f"""
+        chunks = chunk_text_by_tokens(text)
+        tasks = [f"""
         Extract qualified business leads from the following text. 
-        Text: {text}
-        
-        Return a list of leads in valid JSON format. Each lead should have:
-        - company_name
-        - contact_name (if available, else null)
-        - official_website
-        - email
-        - phone_number
-        - full_address
-        - confidence (0-100)
-        - confidence_score (High/Medium/Low)
+        Text: {chunk}
         
         Rules:
         1. Only return valid business information.
         2. If a field is missing, use null.
-        3. Return ONLY the JSON list.
-        """
-        
-        response = model.generate_content(prompt)
-        content = getattr(response, 'text', str(response)).strip()
+        """ for chunk in chunks]
         
-        # Clean up Markdown
-        if content.startswith('```json'):
-            content = content[7:-3]
-        elif content.startswith('```'):
-            content = content[3:-3]
-            
-        try:
-            leads = json.loads(content)
-        except Exception as e:
-            print(f"AI extraction returned non-JSON: {content[:200]}")
-            raise
-        return jsonify({"leads": leads, "message": f"Successfully extracted {len(leads)} leads."})
+        leads, failures = map_reduce_extract(tasks)
+        if failures and len(failures) == len(tasks):
+            # Nothing came back: surface the first error as before
+            raise failures[min(failures)]
+        response = {"leads": leads, "message": f"Successfully extracted {len(leads)} leads."}
+        if failures:
+            response.update({"partial": True, "chunks": len(tasks), "failed_chunks": len(failures)})
+        return jsonify(response)
     except Exception as e:
         print(f"AI Extraction error: {e}")
         return jsonify({"error": str(e)}), 500
 
+def heuristic_leads_from_results(results):
+    """Leads from search results without AI: title/domain as company, first email in the text"""
+    leads = []
+    email_re = re.compile(r"[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}")
+    for r in results:
+        body = r.get('body', '')
+        title = r.get('title', '')
+        href = r.get('href', '')
+        emails = email_re.findall(body + ' ' + title)
+        primary_email = emails[0] if emails else None
+        domain = ''
+        try:
+            domain = urlparse(href).netloc
+        except:
+            domain = ''
+        leads.append({
+            'company_name': title or domain or 'Unknown',
+            'official_website': href or None,
+            'email': primary_email,
+            'phone_number': None,
+            'full_address': None,
+            'confidence': 50,
+            'confidence_score': 'Medium'
+        })
+    return leads
+
 @api.route('/clean-search-results', methods=['POST'])
 def clean_search_results():
     data = request.json
@@ -2426,50 +3181,28 @@ def clean_search_results():
         if not model_name:
             return jsonify({"error": "No supported Gemini model found for generateContent."}), 500
 
-        model = client.GenerativeModel(model_name)
-        prompt = f"""
+        chunks = chunk_records_by_tokens(results)
+        tasks = [f"""
         Below are search results. Extract business leads from them.
-        Results: {json.dumps(results)}
-        
-        Return a list of leads in JSON format:
-        [
-          {{"company_name": "...", "contact_name": "...", "official_website": "...", "email": "...", "phone_number": "...", "full_address": "...", "confidence": 0-100}}
-        ]
-        """
+        Results: {json.dumps(chunk)}
+        """ for chunk in chunks]
         
-        try:
-            response = model.generate_content(prompt)
-            content = getattr(response, 'text', str(response)).strip()
-            if content.startswith('```json'): content = content[7:-3]
-            elif content.startswith('```'): content = content[3:-3]
-            leads = json.loads(content)
+        leads, failures = map_reduce_extract(tasks)
+        if not failures:
             return jsonify({"leads": leads})
-        except Exception as ai_exc:
-            # Log and fall back to a simple heuristic extractor so the feature still works
-            print(f"Gemini generation failed: {ai_exc}\n{traceback.format_exc()}")
-            fallback_leads = []
-            email_re = re.compile(r"[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}")
-            for r in results:
-                body = r.get('body', '')
-                title = r.get('title', '')
-                href = r.get('href', '')
-                emails = email_re.findall(body + ' ' + title)
-                primary_email = emails[0] if emails else None
-                domain = ''
-                try:
-                    domain = urlparse(href).netloc
-                except:
-                    domain = ''
-                fallback_leads.append({
-                    'company_name': title or domain or 'Unknown',
-                    'official_website': href or None,
-                    'email': primary_email,
-                    'phone_number': None,
-                    'full_address': None,
-                    'confidence': 50,
-                    'confidence_score': 'Medium'
-                })
-            return jsonify({"leads": fallback_leads, "fallback": True, "reason": str(ai_exc)})
+        # Fall back to a simple heuristic extractor for the chunks Gemini failed on
+        failed_results = [r for i in sorted(failures) for r in chunks[i]]
+        fallback_leads = heuristic_leads_from_results(failed_results)
+        reason = str(failures[min(failures)])
+        if len(failures) == len(tasks):
+            return jsonify({"leads": fallback_leads, "fallback": True, "reason": reason})
+        return jsonify({
+            "leads": merge_extracted_leads([leads, fallback_leads]),
+            "partial": True,
+            "chunks": len(tasks),
+            "failed_chunks": len(failures),
+            "reason": reason,
+        })
     except Exception as e:
         # Provide a clearer, actionable error for the client
         err_msg = str(e)
@@ -2483,6 +3216,89 @@ def clean_search_results():
             "trace": tb
         }), 502
 
+@api.route('/ai/routing', methods=['GET'])
+def ai_routing_stats():
+    """Per provider/model EWMA latency and error rate, hedges fired and recent routing decisions"""
+    stats = AI_EXECUTOR.routing_stats(request.args.get('services', '').split(',') if request.args.get('services') else None)
+    stats['routing_enabled'] = AI_ROUTING
+    stats['hedging_enabled'] = AI_HEDGING
+    return jsonify(stats)
+
+
+@api.route('/metrics/brevo', methods=['GET'])
+def brevo_metrics():
+    """Brevo transport counters: HTTP requests, batches, batched messages, fallbacks"""
+    brevo = get_brevo()
+    if not brevo:
+        return jsonify({"configured": False})
+    return jsonify({"configured": True, **brevo.snapshot()})
+
+
+@api.route('/outbox/stats', methods=['GET'])
+def outbox_stats():
+    """Outbox queue depth by status, lag of the oldest due email, throughput and worker counters"""
+    stats = db.get_outbox_stats()
+    return jsonify({"available": stats is not None, **(stats or {}), "workers": OUTBOX.snapshot()})
+
+
+@api.route('/outbox/<int:outbox_id>', methods=['GET'])
+def outbox_item_status(outbox_id):
+    item = db.get_outbox_item(outbox_id)
+    if not item:
+        return jsonify({"error": "Outbox item not found"}), 404
+    return jsonify(item)
+
+
+@api.route('/outbox/retry', methods=['POST', 'OPTIONS'])
+def outbox_retry_dead():
+    """Requeue dead-lettered emails: {"ids": [...]} or all of them when omitted"""
+    if request.method == 'OPTIONS':
+        return jsonify({"status": "ok"})
+    ids = (request.get_json(silent=True) or {}).get('ids')
+    requeued = db.requeue_dead_outbox(ids)
+    OUTBOX.wake()
+    return jsonify({"requeued": requeued})
+
+
+@api.route('/metrics/scheduler', methods=['GET'])
+def scheduler_metrics():
+    """Send scheduler: heap size, horizon, next due leads and dispatch counters"""
+    return jsonify({"running": SEND_SCHEDULER.thread is not None, **SEND_SCHEDULER.snapshot()})
+
+
+@api.route('/metrics/smtp', methods=['GET'])
+def smtp_pool_metrics():
+    """SMTP pool counters (opened, logins, sent, reconnects, NOOPs, rotations) and per-connection stats"""
+    pool = get_smtp_pool()
+    if not pool:
+        return jsonify({"configured": False})
+    return jsonify({"configured": True, **pool.stats()})
+
+
+@api.route('/metrics/ai', methods=['GET'])
+def ai_call_metrics():
+    """Per-agent and per-provider AI call counts, p50/p95 latency, tokens and cache hits (?hours=24)"""
+    hours = request.args.get('hours', 24, type=int)
+    return jsonify(AI_LEDGER.metrics(hours=hours))
+
+
+@api.route('/metrics/structured-output', methods=['GET'])
+def structured_output_metrics():
+    """Per-agent parse outcomes: parsed, local_repair, reask, failed and failure rates"""
+    return jsonify(structured_output.PARSE_STATS.snapshot())
+
+
+@api.route('/metrics/llm-cache', methods=['GET'])
+def llm_cache_metrics():
+    """Hit-rate metrics for the LLM response cache (memory tier + DB tier)"""
+    stats = LLM_CACHE.metrics()
+    try:
+        stats['db'] = db.get_llm_cache_stats()
+    except Exception as e:
+        stats['db'] = {'error': str(e)}
+    return jsonify(stats)
+
+
 @api.route('/ai-health', methods=['GET'])
 def ai_health():
     """Return basic AI service configuration status (Gemini)"""
@@ -2491,7 +3307,8 @@ def ai_health():
     return jsonify({
         "gemini_api_key_set": bool(GEMINI_API_KEY),
         "gemini_client_loaded": bool(client),
-        "gemini_model": model_name or "No supported model found"
+        "gemini_model": model_name or "No supported model found",
+        "executor": AI_EXECUTOR.stats()
     })
 
 
@@ -2544,6 +3361,7 @@ def ai_generate():
     if not model_name:
         return jsonify({"error": "No Gemini model available for generation."}), 503
 
+    started = time.perf_counter()
     try:
         # Try common generate method signatures.
         if hasattr(client, 'generate'):
@@ -2573,9 +3391,14 @@ def ai_generate():
         except Exception:
             text = str(resp)
 
+        AI_LEDGER.record('gemini', model_name, prompt_tokens=estimate_tokens(json.dumps(prompt or messages)),
+                         response_tokens=estimate_tokens(text), latency_ms=(time.perf_counter() - started) * 1000,
+                         agent='ai_generate_proxy')
         return jsonify({"success": True, "model": model_name, "response": text})
     except Exception as e:
         print(f"[ERROR] Gemini generate failed: {e}")
+        AI_LEDGER.record('gemini', model_name, latency_ms=(time.perf_counter() - started) * 1000,
+                         status='error', error=e, agent='ai_generate_proxy')
         return jsonify({"error": str(e)}), 500
 
 
@@ -2684,8 +3507,9 @@ def keyword_search():
     if not keywords:
         return jsonify({"error": "Missing keywords"}), 400
         
-    leads = agent_keyword_search(keywords)
-    return jsonify({"message": f"Found and added {len(leads)} leads", "leads": leads})
+    usage = SearchUsage()
+    leads = agent_keyword_search(keywords, usage=usage)
+    return jsonify({"message": f"Found and added {len(leads)} leads", "leads": leads, "usage": usage.as_dict()})
 
 @api.route('/search-leads', methods=['POST'])
 def search_leads():
@@ -2697,7 +3521,8 @@ def search_leads():
         return jsonify({"error": "Missing industry or location"}), 400
 
     try:
-        leads = agent_discovery(industry, location)
+        usage = SearchUsage()
+        leads = agent_discovery(industry, location, usage=usage)
         if not leads:
             # Graceful fallback: provide mock suggestions so the UI can demonstrate behavior
             print(f"[DISCOVERY] No leads found for '{industry}' in '{location}'; returning mock suggestions.")
@@ -2705,12 +3530,99 @@ def search_leads():
                 {"name": f"Owner at {industry.title()} Co {i}", "email": f"contact+{i}@{industry.replace(' ','')}.example.com", "phone": "", "company": f"{industry.title()} Co {i}", "location": location, "source": "mock_discovery"}
                 for i in range(1,4)
             ]
-        return jsonify({"message": f"Found {len(leads)} leads", "leads": leads})
+        return jsonify({"message": f"Found {len(leads)} leads", "leads": leads, "usage": usage.as_dict()})
     except Exception as e:
         print(f"Search API error: {e}")
         traceback.print_exc()
         return jsonify({"error": "Discovery failed", "details": str(e)}), 500
 
+# --- Streaming (SSE / NDJSON) variants of the search endpoints ---
+
+def stream_events(events, max_leads=None, on_lead=None):
+    """Stream agent events to the client as they are produced.
+
+    Uses Server-Sent Events by default, or newline-delimited JSON when the
+    request asks for `format=ndjson`. Stops after `max_leads` leads; when the
+    client disconnects, the agent generator is closed so no further
+    searches or scrapes are started.
+    """
+    fmt = (request.args.get('format') or (request.get_json(silent=True) or {}).get('format') or 'sse').lower()
+
+    def generate():
+        leads = 0
+        try:
+            for event in events:
+                if event.get('type') == 'lead':
+                    if on_lead:
+                        on_lead(event['lead'])
+                    leads += 1
+                payload = json.dumps(event, default=str)
+                if fmt == 'ndjson':
+                    yield payload + "\n"
+                else:
+                    yield f"event: {event.get('type', 'message')}\ndata: {payload}\n\n"
+                if max_leads and leads >= max_leads:
+                    done = json.dumps({'type': 'progress', 'stage': 'done', 'leads': leads, 'reason': 'max_leads'})
+                    yield done + "\n" if fmt == 'ndjson' else f"event: progress\ndata: {done}\n\n"
+                    break
+        finally:
+            events.close()
+
+    mimetype = 'application/x-ndjson' if fmt == 'ndjson' else 'text/event-stream'
+    return Response(
+        stream_with_context(generate()),
+        mimetype=mimetype,
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+def _stream_params():
+    # EventSource can only issue GET requests, so accept query args as well as JSON
+    data = request.get_json(silent=True) or {}
+    params = {**request.args.to_dict(), **data}
+    try:
+        params['max_leads'] = int(params.get('max_leads') or 0) or None
+    except (TypeError, ValueError):
+        params['max_leads'] = None
+    return params
+
+
+@api.route('/search-leads/stream', methods=['GET', 'POST'])
+def search_leads_stream():
+    params = _stream_params()
+    industry = params.get('industry')
+    location = params.get('location')
+    if not industry or not location:
+        return jsonify({"error": "Missing industry or location"}), 400
+    return stream_events(iter_discovery(industry, location), max_leads=params['max_leads'])
+
+
+@api.route('/keyword-search/stream', methods=['GET', 'POST'])
+def keyword_search_stream():
+    params = _stream_params()
+    keywords = params.get('keywords')
+    if not keywords:
+        return jsonify({"error": "Missing keywords"}), 400
+    return stream_events(iter_keyword_search(keywords), max_leads=params['max_leads'])
+
+
+@api.route('/targeted-search/stream', methods=['GET', 'POST'])
+def targeted_search_stream():
+    params = _stream_params()
+    location = params.get('location', 'Tamil Nadu')
+    niche = params.get('niche', 'Small Business')
+    offering = params.get('offering', 'General')
+    if not location or not niche:
+        return jsonify({"error": "Missing location or niche"}), 400
+
+    def save_lead(lead):
+        # Same persistence as /targeted-search, but as each lead arrives
+        if not (lead['email'] and db.get_lead_by_email(lead['email'])):
+            db.insert_lead(lead)
+
+    events = iter_targeted_search(location, niche, offering, max_leads=params['max_leads'])
+    return stream_events(events, max_leads=params['max_leads'], on_lead=save_lead)
+
 @api.route('/scrape-url', methods=['POST'])
 def scrape_url():
     data = request.json
@@ -3010,6 +3922,37 @@ def analyze_lead(id):
     return jsonify({"analysis": analysis, "decision": decision})
 
 
+@api.route('/analyze/batch', methods=['POST', 'OPTIONS'])
+def analyze_leads_bulk():
+    """Analyze many leads with batched prompts.
+
+    Body: {"lead_ids": [...]} or {"status": "new", "limit": 500};
+    "prescore": false skips the rule-based first stage.
+    """
+    if request.method == 'OPTIONS':
+        return '', 204
+    data = request.get_json(silent=True) or {}
+    lead_ids = data.get('lead_ids') or []
+    try:
+        batch_size = int(data['batch_size']) if data.get('batch_size') is not None else None
+    except (TypeError, ValueError):
+        return jsonify({"error": "batch_size must be an integer"}), 400
+    try:
+        if lead_ids:
+            leads = db.get_leads_by_ids(lead_ids)
+        else:
+            leads = db.get_leads_by_status(data.get('status') or 'new', data.get('limit') or 500)
+    except (TypeError, ValueError):
+        return jsonify({"error": "lead_ids must be a list of integers"}), 400
+    if not leads:
+        return jsonify({"results": [], "failed": [], "saved": 0, "message": "No leads to analyze"})
+
+    use_prescoring = data.get('prescore')
+    summary = analyze_leads_batch(leads, use_prescoring=None if use_prescoring is None else bool(use_prescoring))
+    summary['requested'] = len(leads)
+    return jsonify(summary)
+
+
 @api.route('/bulk-scrape-simple', methods=['POST'])
 def bulk_scrape_simple():
     try:
@@ -3032,30 +3975,8 @@ def bulk_scrape_simple():
             search_results = search_the_web(keyword, max_results=20)
             
             # Filter out listicles/aggregators
-            skip_keywords = [
-                'top-', 'best-', 'list-of', 'directory', 'clutch.co', 'yelp.com', 
-                'sulekha.com', 'justdial.com', 'yellowpages', 'thumbtack', 'upwork', 
-                'fiverr', 'linkedin.com', 'facebook.com', 'instagram.com', 'glassdoor',
-                'goodfirms', 'designrush', 'sortlist', 'themanifest'
-            ]
-            skip_titles = ['top 10', 'top 20', 'top 30', 'top 50', 'top 100', 'best ', 'list of ', 'directory', 'reviews']
-            
-            for r in search_results:
-                link = r.get('href', '')
-                title = r.get('title', '').lower()
-                
-                if not link: continue
-                
-                # Skip aggregators
-                if any(k in link.lower() for k in skip_keywords):
-                    print(f"Skipping aggregator/listicle (URL): {link}")
-                    continue
-                    
-                if any(k in title for k in skip_titles):
-                    print(f"Skipping aggregator/listicle (Title): {title}")
-                    continue
-                    
-                urls.append(link)
+            official = search_filters.filter_results(search_results, profile='bulk_scrape', log_prefix='')
+            urls.extend(r.get('href') for r in official)
             
             # Limit to top 10 to avoid long wait times
             urls = urls[:10]
@@ -3150,10 +4071,7 @@ def generate_draft(id):
             template_id = data.get('template_id')
             template = db.get_template_by_id(template_id)
             if template:
-                message = template['body']
-                subject = template.get('subject') or subject
-                message = message.replace('{{name}}', lead.get('name', '') or 'there')
-                message = message.replace('{{company}}', lead.get('company', '') or 'your company')
+                subject, message, _ = render_email_template(compile_email_template(template), lead, subject)
         else: # AI
             # Ensure analysis exists
             if not lead.get('ai_analysis'):
@@ -3209,6 +4127,7 @@ def outreach_lead(id):
         outreach_type = data.get('outreach_type', 'ai') # 'ai', 'template', 'manual'
 
         message = ""
+        html_body = None
         subject = data.get('subject') or f"Partnership Opportunity with {lead.get('company', 'your team')}"
         strategy = "Manual/Template"
 
@@ -3221,11 +4140,7 @@ def outreach_lead(id):
             if not template:
                  return jsonify({"error": "Template not found"}), 404
 
-            # Simple variable substitution
-            message = template['body']
-            subject = template.get('subject') or subject
-            message = message.replace('{{name}}', lead.get('name', '') or 'there')
-            message = message.replace('{{company}}', lead.get('company', '') or 'your company')
+            subject, message, html_body = render_email_template(compile_email_template(template), lead, subject)
 
         elif outreach_type == 'manual':
             message = data.get('manual_body')
@@ -3250,20 +4165,26 @@ def outreach_lead(id):
             strategy = agent_message_strategy(lead, analysis)
             message = agent_generate_message(lead, strategy)
 
-        # Send (send_email/agent_send_outreach will validate recipient email)
-        success, reason = agent_send_outreach(lead, message, subject=subject)
+        # Queue (agent_send_outreach validates the recipient email)
+        success, reason, queued = agent_send_outreach(
+            lead, message, subject=subject, idempotency_key=request_idempotency_key(data), html_body=html_body
+        )
 
         if success:
-            # Note: agent_send_outreach calls db.log_outreach which already
-            # sets the lead status and last_outreach_at. No separate update needed.
+            # The outbox worker logs the send, which sets the lead status
+            # and last_outreach_at. No separate update needed.
             return jsonify({
                 "success": True,
-                "message": "Outreach sent successfully", 
+                "queued": True,
+                "outbox_id": queued['outbox_id'],
+                "status": queued['status'],
+                "duplicate": queued['duplicate'],
+                "message": "Outreach queued for sending",
                 "content": message,
                 "strategy": strategy
-            })
+            }), 202
         else:
-            err_msg = reason or "Failed to send outreach. Please check SMTP/Brevo/Network settings."
+            err_msg = reason or "Failed to queue outreach."
             print(f"❌ Outreach endpoint failed for lead {id}: {err_msg}")
             return jsonify({"error": "Failed to send outreach", "details": err_msg}), 500
 
@@ -3298,10 +4219,13 @@ def debug_env():
 @api.route('/debug/imap-status', methods=['GET'])
 def debug_imap_status():
     """Return basic IMAP monitor status for debugging"""
+    status = REPLY_MONITOR.status if REPLY_MONITOR else {}
     return jsonify({
-        "last_check": LAST_IMAP_CHECK,
-        "last_error": LAST_IMAP_ERROR,
-        "last_processed": LAST_IMAP_PROCESSED
+        "last_check": status.get('last_sync'),
+        "last_error": status.get('last_error'),
+        "last_processed": LAST_IMAP_PROCESSED,
+        "monitor": status,
+        "index": REPLY_INDEX.snapshot()
     })
 
 @api.route('/debug/mark-replied', methods=['POST'])
@@ -3383,26 +4307,151 @@ def send_outreach_route():
     lead_id, msg, subject = data.get('lead_id'), data.get('message'), data.get('subject')
     lead = db.get_lead_by_id(lead_id)
     if not lead: return jsonify({"error": "Lead not found"}), 404
-    success, err = send_email(lead['email'], subject, msg, lead.get('company'), lead_id=lead_id)
-    success, dry_run, reason = normalize_outreach_result(success, err)
-    if not success:
-        return jsonify({"error": reason or "Failed to send outreach"}), 500
-
-    log_message = msg if not dry_run else f"{msg}\n\n[DRY RUN MODE]"
-    db.log_outreach(lead_id, 'email', log_message)
-    _update_lead_after_outreach(
-        lead_id,
-        status_value='outreach_sent',
-        sequence_step=max(2, lead.get('current_sequence_step') or 1)
+    step = max(2, lead.get('current_sequence_step') or 1)
+    queued = enqueue_email(
+        lead['email'], subject, msg,
+        idempotency_key=request_idempotency_key(data), lead_id=lead_id, to_name=lead.get('company'),
+        after_send={'lead_status': 'outreach_sent', 'sequence_step': step,
+                    'next_action_in': next_action_delay(lead, step)},
     )
-    response = {"success": True}
-    if dry_run:
-        response["dry_run"] = True
-        response["message"] = reason
-    return jsonify(response)
+    if queued['status'] == 'failed':
+        return jsonify({"error": queued['error'] or "Failed to queue outreach"}), 500
+    return jsonify({"success": True, "queued": True, "outbox_id": queued['outbox_id'],
+                    "status": queued['status'], "duplicate": queued['duplicate']}), 202
+
+
+def _enqueue_bulk_messages(items, message_type, idempotency_key=None):
+    """Queue (lead, subject, message[, html]) items on the outbox; returns per-lead result dicts"""
+    sequences = campaign_sequences_for([item[0] for item in items])
+    outcomes = enqueue_emails([
+        outbox_item(
+            item[0]['email'], item[1], item[2], html_body=item[3] if len(item) > 3 else None,
+            # A client key covers the whole request, so scope it per lead
+            idempotency_key=f"{idempotency_key}:{item[0]['id']}" if idempotency_key else None,
+            lead_id=item[0]['id'], to_name=item[0].get('company'),
+            after_send={'log_type': message_type, 'lead_status': 'outreach_sent', 'sequence_step': 2,
+                        'next_action_in': next_action_delay(item[0], 2, sequences.get(item[0].get('campaign_id')))},
+        )
+        for item in items
+    ])
+    results = []
+    for (lead, *_), outcome in zip(items, outcomes):
+        if outcome['status'] == 'failed':
+            results.append({'lead_id': lead['id'], 'status': 'failed', 'error': outcome['error']})
+        else:
+            results.append({'lead_id': lead['id'], 'status': 'duplicate' if outcome['duplicate'] else 'queued',
+                            'outbox_id': outcome['outbox_id']})
+    return results
+
+
+def _generate_bulk_message(lead, analysis):
+    if not analysis:
+        analysis = agent_analyze_business(lead)
+        db.update_lead_analysis(lead['id'], json.dumps(analysis), analysis.get('trust_score', 0), 'analyzed')
+    strat = agent_message_strategy(lead, analysis)
+    return agent_generate_message(lead, strat)
+
+
+def parse_lead_ids(lead_ids):
+    """Split request lead ids into (ids as ints, ids that aren't integers), keeping their order."""
+    ids, invalid = [], []
+    for lead_id in lead_ids:
+        try:
+            ids.append(int(lead_id))
+        except (TypeError, ValueError):
+            invalid.append(lead_id)
+    return ids, invalid
+
+
+def iter_bulk_outreach_ai(lead_ids, subject, message_type='email', idempotency_key=None):
+    """Pipelined AI-mode bulk outreach, yielding progress and per-lead result events.
+
+    Stages: one batched fetch of all leads, batched analysis of only the leads
+    missing one, concurrent message generation, and an enqueue stage that
+    hands messages to the outbox as soon as they are ready. AI throughput is
+    bounded by the AI executor's provider quotas; sending is throttled by the
+    outbox workers.
+    """
+    counts = {'queued': 0, 'duplicates': 0, 'failed': 0}
+
+    def result(item):
+        if item['status'] == 'failed':
+            counts['failed'] += 1
+        elif item['status'] == 'duplicate':
+            counts['duplicates'] += 1
+        else:
+            counts['queued'] += 1
+        return {'type': 'result', **item}
+
+    lead_ids, invalid = parse_lead_ids(lead_ids)
+    for lead_id in invalid:
+        yield result({'lead_id': lead_id, 'status': 'failed', 'error': 'Invalid lead id'})
+    by_id = {lead['id']: lead for lead in db.get_leads_by_ids(lead_ids)}
+    leads = []
+    for lead_id in lead_ids:
+        lead = by_id.get(lead_id)
+        if not lead or not lead.get('email'):
+            yield result({'lead_id': lead_id, 'status': 'failed', 'error': 'Lead not found or has no email'})
+        else:
+            leads.append(lead)
+    yield {'type': 'progress', 'stage': 'fetched', 'leads': len(leads)}
+
+    analyses = {}
+    unanalyzed = []
+    for lead in leads:
+        analysis = lead.get('ai_analysis')
+        if isinstance(analysis, str):
+            try:
+                analysis = json.loads(analysis or '{}')
+            except ValueError:
+                analysis = None
+        if analysis:
+            analyses[lead['id']] = analysis
+        else:
+            unanalyzed.append(lead)
+    if unanalyzed:
+        new_analyses, _, _ = analyze_leads_staged(unanalyzed)
+        db.update_leads_analysis_batch([
+            (lid, json.dumps(a), a.get('trust_score', 0), 'analyzed') for lid, a in new_analyses.items()
+        ])
+        analyses.update(new_analyses)
+    yield {'type': 'progress', 'stage': 'analyzed', 'analyzed': len(unanalyzed)}
+
+    pool = ThreadPoolExecutor(max_workers=max(1, min(BULK_OUTREACH_CONCURRENCY, len(leads) or 1)))
+    futures = {}
+    try:
+        futures = {pool.submit(_generate_bulk_message, lead, analyses.get(lead['id'])): lead for lead in leads}
+        remaining = set(futures)
+        ready = []
+        for future in as_completed(futures):
+            remaining.discard(future)
+            lead = futures[future]
+            try:
+                ready.append((lead, subject, future.result()))
+            except Exception as e:
+                yield result({'lead_id': lead['id'], 'status': 'failed', 'error': f"Message generation failed: {e}"})
+            # Queue whatever is ready in one insert, unless more messages are already waiting
+            if not ready or (any(f.done() for f in remaining) and len(ready) < BREVO_BATCH_SIZE):
+                continue
+            try:
+                outcomes = _enqueue_bulk_messages(ready, message_type, idempotency_key)
+            except Exception as e:
+                outcomes = [{'lead_id': item[0]['id'], 'status': 'failed', 'error': str(e)} for item in ready]
+            ready = []
+            for outcome in outcomes:
+                yield result(outcome)
+    finally:
+        # Client went away or we finished: don't start generations nobody will send
+        for future in futures:
+            future.cancel()
+        pool.shutdown(wait=False)
+    yield {'type': 'done', **counts}
+
 
 @api.route('/bulk-outreach', methods=['POST', 'OPTIONS'])
 def bulk_outreach():
+    """Send to many leads. In mode='ai' pass "stream": true (or ?format=sse|ndjson)
+    to receive per-lead results as they happen."""
     if request.method == 'OPTIONS':
         return jsonify({"status": "ok"})
     data = request.json or {}
@@ -3415,44 +4464,58 @@ def bulk_outreach():
 
     if not lead_ids or not isinstance(lead_ids, list):
         return jsonify({"error": "lead_ids array is required"}), 400
-
-    sent, failed, dry_runs = 0, 0, 0
-    errors = []
+    if message_type not in BULK_MESSAGE_TYPES:
+        return jsonify({"error": f"message_type must be one of: {', '.join(BULK_MESSAGE_TYPES)}"}), 400
+
+    idempotency_key = request_idempotency_key(data)
+
+    if mode == 'ai':
+        events = iter_bulk_outreach_ai(lead_ids, subject_raw, message_type, idempotency_key)
+        if data.get('stream') or request.args.get('format'):
+            return stream_events(events)
+        results, summary = [], {}
+        for event in events:
+            if event['type'] == 'result':
+                results.append(event)
+            elif event['type'] == 'done':
+                summary = event
+        errors = [r['error'] for r in results if r['status'] == 'failed' and r.get('error')]
+        return jsonify({"queued": summary.get('queued', 0), "duplicates": summary.get('duplicates', 0),
+                        "failed": summary.get('failed', 0), "errors": errors, "results": results}), 202
+
+    items = []
+    lead_ids, invalid = parse_lead_ids(lead_ids)
+    skipped = [{'lead_id': lead_id, 'status': 'failed', 'error': 'Invalid lead id'} for lead_id in invalid]
+
+    # One IN (...) query for every lead and a single template lookup
+    by_id = {lead['id']: lead for lead in db.get_leads_by_ids(lead_ids)}
+    template = db.get_template_by_id(template_id) if mode == 'template' and template_id else None
+    compiled = compile_email_template(template) if template else None
 
     for lead_id in lead_ids:
-        lead = db.get_lead_by_id(lead_id)
+        lead = by_id.get(lead_id)
         if not lead or not lead.get('email'):
-            failed += 1; continue
+            skipped.append({'lead_id': lead_id, 'status': 'failed', 'error': 'Lead not found or has no email'})
+            continue
         
         l_msg, l_subj = message_raw, subject_raw
         
-        if mode == 'ai':
-             # Reuse AI generation logic
-             analysis = lead['ai_analysis'] if isinstance(lead['ai_analysis'], dict) else json.loads(lead['ai_analysis'] or '{}')
-             if not analysis:
-                 analysis = agent_analyze_business(lead)
-                 db.update_lead_analysis(lead_id, json.dumps(analysis), analysis.get('trust_score', 0), 'analyzed')
-             strat = agent_message_strategy(lead, analysis)
-             l_msg = agent_generate_message(lead, strat)
-        elif mode == 'template' and template_id:
-             template = db.get_template_by_id(template_id)
-             if template:
-                 l_msg = template['body'].replace('{{name}}', lead.get('name', '') or 'there').replace('{{company}}', lead.get('company', '') or 'your company')
-                 l_subj = template.get('subject') or l_subj
-
-        success, err = send_email(lead['email'], l_subj, l_msg, lead.get('company'), lead_id=lead_id)
-        success, dry_run, reason = normalize_outreach_result(success, err)
-        
-        if not success:
-            failed += 1; errors.append(reason); continue
+        l_html = None
+        if compiled:
+            l_subj, l_msg, l_html = render_email_template(compiled, lead, l_subj)
+        items.append((lead, l_subj, l_msg, l_html))
 
-        log_message = l_msg if not dry_run else f"{l_msg}\n\n[DRY RUN MODE]"
-        db.log_outreach(lead_id, message_type, log_message)
-        _update_lead_after_outreach(lead_id, status_value='outreach_sent', sequence_step=2)
-        sent += 1
-        if dry_run: dry_runs += 1
+    results = skipped + _enqueue_bulk_messages(items, message_type, idempotency_key)
+    failed = 0
+    errors = []
+    for outcome in results:
+        if outcome['status'] == 'failed':
+            failed += 1; errors.append(outcome['error'])
+    queued = sum(1 for r in results if r['status'] == 'queued')
+    duplicates = sum(1 for r in results if r['status'] == 'duplicate')
 
-    return jsonify({"sent": sent, "failed": failed, "dry_runs": dry_runs, "errors": errors})
+    return jsonify({"queued": queued, "duplicates": duplicates, "failed": failed, "errors": errors,
+                    "results": results}), 202
 
 @api.route('/search-domain', methods=['POST'])
 def search_domain_route():
@@ -3545,10 +4608,12 @@ def add_conversation_message_api(lead_id):
     if send_email_flag and direction == 'outbound':
         lead = db.get_lead_by_id(lead_id)
         if lead:
-            success, reason = agent_send_outreach(lead, message, subject=data.get('subject'))
-            send_result = {"success": success, "reason": reason}
-            # Log in outreach logs as well
-            db.log_outreach(lead_id, 'email', message)
+            success, reason, queued = agent_send_outreach(
+                lead, message, subject=data.get('subject'),
+                idempotency_key=f"conversation:{msg_id}", kind='conversation',
+            )
+            send_result = {"success": success, "reason": reason, "queued": success,
+                           "outbox_id": queued['outbox_id'] if queued else None}
 
     return jsonify({"message_id": msg_id, "send_result": send_result})
 
@@ -3562,7 +4627,7 @@ def follow_up_lead():
     if not lead: return jsonify({"error": "Lead not found"}), 404
     success, err, next_step = dispatch_followup_for_lead(lead, template_key, triggered_by='manual follow-up')
     if not success: return jsonify({"error": err}), 500
-    return jsonify({"success": True, "next_step": next_step})
+    return jsonify({"success": True, "queued": True, "next_step": next_step}), 202
 
 @api.route('/outreach-templates', methods=['GET'])
 def get_outreach_templates():
@@ -3637,6 +4702,183 @@ def manage_lead_scores(lead_id):
         db.save_lead_score(lead_id, score_type, score, reasoning)
         return jsonify({"success": True})
 
+LEAD_SCORING_CRITERIA = """
+        Scoring Criteria:
+        1. Business Quality (0-25): Company size, industry, reputation
+        2. Contact Quality (0-25): Email/phone validity, contact info completeness
+        3. Engagement Potential (0-25): Likelihood of responding to outreach
+        4. Conversion Potential (0-25): Likelihood of becoming a customer
+"""
+
+LEAD_SCORE_BATCH_SCHEMA = Schema('score_leads_batch', dict(
+    {'lead_id': Field(int, required=True, description='id of the lead being scored')},
+    **LEAD_SCORE_SCHEMA.fields), many=True)
+
+# Background batch-scoring jobs, by job id
+SCORING_JOBS = {}
+scoring_jobs_lock = threading.Lock()
+
+
+def lead_score_rows(lead_id, scores):
+    """lead_scores rows (lead_id, score_type, score, reasoning) for one AI scoring result"""
+    reasoning = scores.get('reasoning') or ''
+    return [
+        (lead_id, 'ai_business', scores.get('business_score') or 0, f"Business quality: {reasoning}"),
+        (lead_id, 'engagement', scores.get('engagement_score') or 0, f"Engagement potential: {reasoning}"),
+        (lead_id, 'overall', scores.get('overall_score') or 0, reasoning),
+    ]
+
+
+def _score_batch_prompt(leads):
+    lines = "\n".join(json.dumps({
+        'lead_id': lead['id'],
+        'company': lead.get('company') or 'Unknown',
+        'name': lead.get('name') or 'Unknown',
+        'email': lead.get('email') or 'Unknown',
+        'phone': lead.get('phone') or 'Unknown',
+        'location': lead.get('location') or 'Unknown',
+    }, ensure_ascii=False) for lead in leads)
+    task = f"""
+        Score each of these business leads on a scale of 0-100 based on the following criteria:
+        {LEAD_SCORING_CRITERIA}
+        Return exactly one object per lead, with its lead_id.
+
+        Leads (one JSON object per line):
+        {lines}
+        """
+    return structured_output.build_prompt(task, LEAD_SCORE_BATCH_SCHEMA)
+
+
+def _parse_score_batch(leads, text):
+    value, errors, stage = structured_output.parse(text, LEAD_SCORE_BATCH_SCHEMA)
+    structured_output.PARSE_STATS.record(LEAD_SCORE_BATCH_SCHEMA.name, stage or 'failed')
+    wanted = {lead['id'] for lead in leads}
+    return {item['lead_id']: item for item in value or [] if item['lead_id'] in wanted}
+
+
+def score_leads_batch(leads, batch_size=None, use_cache=True, max_retries=1, progress=None):
+    """Score many leads with Gemini, several leads per prompt.
+
+    Prompts run concurrently on the AI executor (within the Gemini quota).
+    Leads missing from a response are retried in fresh, uncached prompts up
+    to max_retries times. progress(scored_count) is called as prompts finish.
+    Returns (scores by lead id, failed lead ids).
+    """
+    batch_size = max(1, batch_size or AI_SCORE_BATCH_SIZE)
+    results = {}
+    pending = list(leads)
+    for attempt in range(max_retries + 1):
+        if not pending:
+            break
+        chunks = [pending[i:i + batch_size] for i in range(0, len(pending), batch_size)]
+        with AI_LEDGER.agent('score_leads_batch'):
+            futures = {
+                AI_EXECUTOR.submit(_score_batch_prompt(chunk), services='gemini', use_cache=use_cache and attempt == 0): chunk
+                for chunk in chunks
+            }
+        failed = []
+        for future in as_completed(futures):
+            chunk = futures[future]
+            try:
+                scores = _parse_score_batch(chunk, future.result()[0])
+            except Exception as e:
+                print(f"❌ Batch scoring of {len(chunk)} leads failed: {e}")
+                scores = {}
+            results.update(scores)
+            failed.extend(lead for lead in chunk if lead['id'] not in scores)
+            if progress:
+                progress(len(results))
+        pending = failed
+    return results, [lead['id'] for lead in pending]
+
+
+def _update_scoring_job(job_id, **fields):
+    with scoring_jobs_lock:
+        SCORING_JOBS[job_id].update(fields)
+
+
+def _run_scoring_job(job_id, leads, batch_size, use_cache):
+    _update_scoring_job(job_id, status='running')
+    try:
+        scores, failed = score_leads_batch(
+            leads, batch_size=batch_size, use_cache=use_cache,
+            progress=lambda done: _update_scoring_job(job_id, scored=done))
+        rows = [row for lead_id, lead_scores in scores.items() for row in lead_score_rows(lead_id, lead_scores)]
+        written = db.save_lead_scores_batch(rows)
+        _update_scoring_job(job_id, status='completed', scored=len(scores), failed=len(failed),
+                            failed_ids=failed[:100], rows_written=written, finished_at=datetime.now().isoformat())
+        print(f"✅ Scoring job {job_id}: {len(scores)} scored, {len(failed)} failed, {written} rows written")
+    except Exception as e:
+        print(f"❌ Scoring job {job_id} failed: {e}")
+        _update_scoring_job(job_id, status='failed', error=str(e), finished_at=datetime.now().isoformat())
+
+
+def start_scoring_job(leads, batch_size=None, use_cache=True):
+    job_id = uuid.uuid4().hex[:12]
+    job = {
+        'id': job_id, 'status': 'queued', 'total': len(leads), 'scored': 0, 'failed': 0,
+        'rows_written': 0, 'started_at': datetime.now().isoformat(), 'finished_at': None,
+    }
+    with scoring_jobs_lock:
+        finished = [j for j in SCORING_JOBS.values() if j['finished_at']]
+        for old in sorted(finished, key=lambda j: j['finished_at'])[:max(0, len(finished) - AI_SCORE_JOBS_KEEP + 1)]:
+            del SCORING_JOBS[old['id']]
+        SCORING_JOBS[job_id] = job
+    thread = threading.Thread(target=_run_scoring_job, args=(job_id, leads, batch_size, use_cache), daemon=True)
+    thread.start()
+    return dict(job)
+
+
+@api.route('/leads/score/ai/batch', methods=['POST'])
+def ai_score_leads_batch():
+    """Score many leads in the background.
+
+    Body: {"lead_ids": [...]} or a filter {"status", "min_trust_score",
+    "max_trust_score", "unscored_only", "limit"} (an empty filter rescores
+    every lead); optional "batch_size" and "refresh". Poll the returned job
+    at GET /api/leads/score/ai/batch/<job_id>.
+    """
+    if not GEMINI_API_KEY:
+        return jsonify({"error": "Gemini API key not configured"}), 400
+    data = request.get_json(silent=True) or {}
+    lead_ids = data.get('lead_ids') or []
+    try:
+        if lead_ids:
+            leads = db.get_leads_by_ids(lead_ids)
+        else:
+            leads = db.get_leads_for_scoring(
+                status=data.get('status'),
+                min_trust_score=data.get('min_trust_score'),
+                max_trust_score=data.get('max_trust_score'),
+                unscored_only=bool(data.get('unscored_only')),
+                limit=data.get('limit'))
+    except (TypeError, ValueError):
+        return jsonify({"error": "lead_ids, trust scores and limit must be integers"}), 400
+    if not leads:
+        return jsonify({"error": "No leads matched"}), 404
+
+    job = start_scoring_job(leads, batch_size=batch_size, use_cache=not data.get('refresh'))
+    return jsonify({"success": True, "job": job}), 202
+
+
+@api.route('/leads/score/ai/batch', methods=['GET'])
+def list_scoring_jobs():
+    with scoring_jobs_lock:
+        jobs = [dict(job) for job in SCORING_JOBS.values()]
+    return jsonify({"jobs": sorted(jobs, key=lambda j: j['started_at'], reverse=True)})
+
+
+@api.route('/leads/score/ai/batch/<job_id>', methods=['GET'])
+def get_scoring_job(job_id):
+    with scoring_jobs_lock:
+        job = SCORING_JOBS.get(job_id)
+        job = dict(job) if job else None
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    job['progress'] = round(job['scored'] / job['total'], 4) if job['total'] else 1.0
+    return jsonify(job)
+
+
 @api.route('/leads/<int:lead_id>/score/ai', methods=['POST'])
 def ai_score_lead(lead_id):
     """AI-powered lead scoring"""
@@ -3656,7 +4898,6 @@ def ai_score_lead(lead_id):
         if not client:
             return jsonify({"error": "Gemini client failed to initialize"}), 503
 
-        model = client.GenerativeModel(model_name)
         
         prompt = f"""
         Score this business lead on a scale of 0-100 based on the following criteria:
@@ -3667,33 +4908,13 @@ def ai_score_lead(lead_id):
         - Email: {lead.get('email', 'Unknown')}
         - Phone: {lead.get('phone', 'Unknown')}
         - Location: {lead.get('location', 'Unknown')}
-        
-        Scoring Criteria:
-        1. Business Quality (0-25): Company size, industry, reputation
-        2. Contact Quality (0-25): Email/phone validity, contact info completeness
-        3. Engagement Potential (0-25): Likelihood of responding to outreach
-        4. Conversion Potential (0-25): Likelihood of becoming a customer
-        
-        Return a JSON object with:
-        - overall_score: number 0-100
-        - business_score: number 0-25
-        - contact_score: number 0-25
-        - engagement_score: number 0-25
-        - conversion_score: number 0-25
-        - reasoning: brief explanation
+        {LEAD_SCORING_CRITERIA}
         """
         
-        response = model.generate_content(prompt)
-        content = response.text.strip()
-        if content.startswith('```json'): content = content[7:-3]
-        elif content.startswith('```'): content = content[3:-3]
-        
-        scores = json.loads(content)
+        scores = structured_gemini(prompt, LEAD_SCORE_SCHEMA, use_cache=request.args.get('refresh') != 'true')
         
         # Save individual scores
-        db.save_lead_score(lead_id, 'ai_business', scores.get('business_score', 0), f"Business quality: {scores.get('reasoning', '')}")
-        db.save_lead_score(lead_id, 'engagement', scores.get('engagement_score', 0), f"Engagement potential: {scores.get('reasoning', '')}")
-        db.save_lead_score(lead_id, 'overall', scores.get('overall_score', 0), scores.get('reasoning', ''))
+        db.save_lead_scores_batch(lead_score_rows(lead_id, scores))
         
         return jsonify({"success": True, "scores": scores})
     
@@ -3742,7 +4963,6 @@ def ai_enrich_lead(lead_id):
         if not client:
             return jsonify({"error": "Gemini client failed to initialize"}), 503
 
-        model = client.GenerativeModel(model_name)
         
         prompt = f"""
         Enrich this business lead with additional information. Research and infer:
@@ -3754,36 +4974,14 @@ def ai_enrich_lead(lead_id):
         - Phone: {lead.get('phone', 'Unknown')}
         - Location: {lead.get('location', 'Unknown')}
         
-        Provide enrichment data in JSON format:
-        {{
-          "company_info": {{
-            "industry": "inferred industry",
-            "size": "company size estimate",
-            "description": "company description",
-            "website": "company website if known"
-          }},
-          "contact_info": {{
-            "social_media": ["linkedin_url", "twitter_handle"],
-            "job_title": "inferred job title",
-            "additional_emails": ["alternative emails"]
-          }},
-          "business_context": {{
-            "target_market": "target customers",
-            "services": ["services offered"],
-            "competition": "main competitors"
-          }}
-        }}
         """
         
-        response = model.generate_content(prompt)
-        content = response.text.strip()
-        if content.startswith('```json'): content = content[7:-3]
-        elif content.startswith('```'): content = content[3:-3]
-        
-        enrichment_data = json.loads(content)
+        enrichment_data = structured_gemini(prompt, LEAD_ENRICHMENT_SCHEMA, use_cache=request.args.get('refresh') != 'true')
         
         # Save enrichment data
         for data_type, data in enrichment_data.items():
+            if data is None:
+                continue
             db.save_lead_enrichment(lead_id, data_type, data, "AI Enrichment", 75)
         
         return jsonify({"success": True, "enrichment": enrichment_data})
@@ -0,0 +1,127 @@
+"""Benchmark: single-pass JSON extraction vs. the old raw_decode(text[idx:]) scan.
+
+Scenarios are multi-hundred-KB model outputs: a large lead array wrapped in
+prose, the same array preceded by malformed fragments (stray brackets,
+unbalanced quotes, truncated objects), and the streaming extractor fed in
+4 KB chunks.
+
+Usage: python bench_json_extract.py [num_leads] [noise_fragments]
+"""
+import re
+import sys
+import json
+import time
+
+from json_extract import iter_json_values, JSONStreamExtractor
+
+
+def looks_like_lead_dict(entry):
+    return isinstance(entry, dict) and any(k in entry for k in ('company', 'company_name', 'email', 'website'))
+
+
+def as_leads(obj):
+    """The lead list a decoded value stands for, or None."""
+    if isinstance(obj, list) and obj and any(looks_like_lead_dict(i) for i in obj if isinstance(i, dict)):
+        return obj
+    if isinstance(obj, dict) and looks_like_lead_dict(obj):
+        return [obj]
+    return None
+
+
+def legacy_extract(text):
+    """The previous extract_json_from_text: copies the tail and retries at every bracket."""
+    text = text.strip()
+    text = re.sub(r'```json\s*', '', text)
+    text = re.sub(r'```\s*', '', text)
+    decoder = json.JSONDecoder()
+    idx, length = 0, len(text)
+    while idx < length:
+        if text[idx] not in ('[', '{'):
+            idx += 1
+            continue
+        try:
+            obj, consumed = decoder.raw_decode(text[idx:])
+        except json.JSONDecodeError:
+            idx += 1
+            continue
+        if as_leads(obj):
+            return as_leads(obj)
+        idx += consumed
+    return None
+
+
+def new_extract(text):
+    for obj, _, _ in iter_json_values(text):
+        if as_leads(obj):
+            return as_leads(obj)
+    return None
+
+
+def stream_extract(text, chunk_size=4096):
+    extractor = JSONStreamExtractor()
+    for i in range(0, len(text), chunk_size):
+        for obj in extractor.feed(text[i:i + chunk_size]):
+            if as_leads(obj):
+                return as_leads(obj)
+    for obj in extractor.close():
+        if as_leads(obj):
+            return as_leads(obj)
+    return None
+
+
+def make_leads(n):
+    return [
+        {
+            'company': f'Company {i} "Pvt" Ltd {{branch}} [main]',
+            'email': f'info{i}@company{i}.in',
+            'website': f'https://company{i}.in/contact?ref=[x]',
+            'phone': f'+91 98{i:08d}',
+            'notes': 'Offers \\"premium\\" services; see {site} and [docs]',
+        }
+        for i in range(n)
+    ]
+
+
+def make_noise(n):
+    fragments = [
+        'Here is what I found [see note 1] about {the companies}. ',
+        'Some rows were "incomplete and ',
+        '{"company": "Truncated Co", "email": ',
+        '[1, 2, 3, ',
+        'Stray closers ]] }} and an opener { that never closes. ',
+        '\n',
+    ]
+    return ''.join(fragments[i % len(fragments)] for i in range(n))
+
+
+def timed(label, fn, text, repeat=3):
+    # Best of a few runs
+    elapsed = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = fn(text)
+        run = time.perf_counter() - start
+        elapsed = run if elapsed is None else min(elapsed, run)
+    print(f"  {label:<22} {elapsed * 1000:10.1f} ms  -> {len(out) if out else 0} leads")
+    return out, elapsed
+
+
+def run(label, text):
+    print(f"\n{label} ({len(text) / 1024:.0f} KB)")
+    legacy, legacy_t = timed('legacy', legacy_extract, text)
+    new, new_t = timed('single pass', new_extract, text)
+    stream, _ = timed('streaming (4 KB)', stream_extract, text)
+    if not (legacy == new == stream):
+        print("  !! results differ")
+    if new_t:
+        print(f"  speedup: {legacy_t / new_t:.1f}x")
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1500
+    noise = int(sys.argv[2]) if len(sys.argv) > 2 else 3000
+    payload = json.dumps(make_leads(n), indent=2)
+
+    run('Lead array wrapped in prose', f"```json\nSure! Here are the leads:\n{payload}\nLet me know if you need more.\n```")
+    run('Malformed fragments before the array', make_noise(noise) + payload)
+    run('Truncated response (array never closes)', make_noise(noise // 10) + payload[:-2])
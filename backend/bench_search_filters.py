@@ -0,0 +1,140 @@
+"""Benchmark: shared search-result classifier vs. the per-call keyword scans it replaced.
+
+Each profile is checked against a copy of the legacy filter from the search
+path that uses it: the accepted results must be identical, except that full
+domains ("facebook.com") now only match the host, so a result the legacy scan
+dropped for a domain found in its path or query string is kept. Both are
+timed (best of 3) on the same synthetic results.
+
+Usage: python bench_search_filters.py [num_results]
+"""
+import sys
+import time
+import random
+
+from urllib.parse import urlsplit
+
+from search_filters import get_classifier
+
+SOCIAL = ['linkedin.com', 'facebook.com', 'twitter.com', 'instagram.com']
+DISCOVERY_SKIP = ['top-', 'best-', 'list-of', 'directory', 'clutch.co', 'yelp.com', 'sulekha.com', 'justdial.com',
+                  'yellowpages', 'thumbtack', 'upwork', 'fiverr']
+DISCOVERY_TITLES = ['top ', 'best ', 'list of ']
+TARGETED_TITLES = ['top 10', 'top 20', 'top 50', 'best ', 'list of', 'directory', 'yellow pages', 'listings',
+                   'providers in']
+WEB_SKIP = [
+    'top-', 'best-', 'list-of', 'directory', 'clutch.co', 'yelp.com',
+    'sulekha.com', 'justdial.com', 'yellowpages', 'thumbtack', 'upwork',
+    'fiverr', 'linkedin.com', 'facebook.com', 'instagram.com', 'glassdoor',
+    'goodfirms', 'designrush', 'sortlist', 'themanifest'
+]
+WEB_TITLES = ['top 10', 'top 20', 'top 30', 'top 50', 'top 100', 'best ', 'list of ', 'directory', 'reviews']
+
+HOSTS = [
+    'acme-digital.in', 'www.brightpixel.co', 'clutch.co', 'www.justdial.com', 'in.linkedin.com',
+    'www.yelp.com', 'shop.greenleaf.com', 'blog.example.org', 'www.goodfirms.co', 'fastbooks.io',
+    'www.upwork.co.in', 'twitter.com',
+]
+PATHS = ['/', '/contact-us', '/top-10-agencies-chennai', '/about', '/list-of-companies', '/services/seo',
+         '/directory/it', '/?ref=facebook.com']
+TITLES = [
+    'Acme Digital - SEO Agency in Chennai', 'Top 10 Marketing Agencies in Chennai', 'Contact Us | Bright Pixel',
+    'Best Billing Software Providers', 'Green Leaf Stores', 'List of IT Companies in Coimbatore', 'FastBooks Reviews',
+    'Top Rated Plumbers', 'Yellow Pages Listings',
+]
+
+
+def make_results(n, seed=42):
+    rnd = random.Random(seed)
+    return [
+        {
+            'title': rnd.choice(TITLES),
+            'href': f"https://{rnd.choice(HOSTS)}{rnd.choice(PATHS)}" if rnd.random() > 0.01 else '',
+            'body': 'Call us at +91 9876543210 or mail hello@example.com',
+        }
+        for _ in range(n)
+    ]
+
+
+def legacy_discovery(results):
+    kept = []
+    for r in results:
+        link = r.get('href', '')
+        title = r.get('title', '')
+        if any(x in link.lower() for x in SOCIAL):
+            continue
+        if any(k in link.lower() for k in DISCOVERY_SKIP) or any(k in title.lower() for k in DISCOVERY_TITLES):
+            continue
+        kept.append(r)
+    return kept
+
+
+def legacy_keyword(results):
+    return [r for r in results if not any(x in r.get('href', '').lower() for x in SOCIAL)]
+
+
+def legacy_targeted(results):
+    return [r for r in results if not any(k in r.get('title', '').lower() for k in TARGETED_TITLES)]
+
+
+def legacy_web(results):
+    kept = []
+    for r in results:
+        link = r.get('href', '')
+        title = r.get('title', '').lower()
+        if not link:
+            continue
+        if any(k in link.lower() for k in WEB_SKIP):
+            continue
+        if any(k in title for k in WEB_TITLES):
+            continue
+        kept.append(r)
+    return kept
+
+
+LEGACY = {
+    'discovery': legacy_discovery,
+    'keyword_search': legacy_keyword,
+    'targeted_search': legacy_targeted,
+    'web_search': legacy_web,
+    'bulk_scrape': legacy_web,
+}
+
+
+def domain_outside_host(result, patterns):
+    """True when a full-domain pattern occurs in the URL but not in its host."""
+    link = result['href'].lower()
+    host = urlsplit(link).hostname or ''
+    return any('.' in p and p in link and p not in host for p in patterns)
+
+
+def best_of(fn, *args, repeat=3):
+    best, out = None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = fn(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return out, best
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    results = make_results(n)
+    classifier = get_classifier()
+    print(f"Classifying {n} synthetic search results (best of 3)")
+    print(f"{'profile':<18} {'legacy ms':>10} {'classifier ms':>14} {'speedup':>8}  kept")
+    print("-" * 62)
+    for profile, legacy in LEGACY.items():
+        legacy_kept, legacy_t = best_of(legacy, results)
+        (kept, _, _), new_t = best_of(classifier.partition, results, profile)
+        if profile in ('discovery', 'keyword_search'):
+            # These paths used to hand link-less results to a scrape that could only fail; now they are skipped
+            legacy_kept = [r for r in legacy_kept if r['href']]
+        legacy_ids = {id(r) for r in legacy_kept}
+        kept_ids = {id(r) for r in kept}
+        assert legacy_ids <= kept_ids, f"{profile}: classifier dropped results the legacy filter kept"
+        for r in kept:
+            if id(r) not in legacy_ids:
+                assert domain_outside_host(r, SOCIAL + WEB_SKIP), f"{profile}: unexpected difference for {r['href']}"
+        print(f"{profile:<18} {legacy_t * 1000:10.1f} {new_t * 1000:14.1f} {legacy_t / new_t:7.2f}x  {len(kept)}")
@@ -0,0 +1,160 @@
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+BREVO_API_URL = "https://api.brevo.com/v3/smtp/email"
+# Recipients per batch request (one messageVersions entry each)
+BREVO_BATCH_SIZE = int(os.getenv("BREVO_BATCH_SIZE", "50"))
+BREVO_TIMEOUT = float(os.getenv("BREVO_TIMEOUT", "15"))
+# Keep-alive connections held by the shared session
+BREVO_POOL_SIZE = int(os.getenv("BREVO_POOL_SIZE", "10"))
+
+OK_STATUSES = (200, 201, 202)
+
+
+class TransportError(str):
+    """Error text for a request whose outcome is unknown (timeout, dropped
+    connection, 5xx): Brevo may have sent the mail, so it must not be re-sent
+    straight away by another route."""
+
+
+def is_valid_address(address):
+    return isinstance(address, str) and '@' in address and '.' in address.rsplit('@', 1)[-1]
+
+
+class BrevoTransport:
+    """Brevo transactional email over one keep-alive requests.Session.
+
+    send() posts a single message; send_batch() packs many personalised
+    messages into messageVersions payloads (one request per BREVO_BATCH_SIZE
+    recipients). A batch Brevo rejects with a 4xx is retried as single sends
+    so every recipient gets its own result; any other failure is returned
+    as a TransportError for every message in the batch.
+
+    Messages are dicts with to, name, subject, text and html. Brevo assigns
+    the Message-ID header itself; the id it reports for a sent message is
+    written back to message['message_id'].
+    """
+
+    def __init__(self, api_key, sender_email, sender_name="Lead Outreach AI", session=None,
+                 batch_size=None, timeout=None):
+        self.sender = {"email": sender_email, "name": sender_name}
+        self.batch_size = max(1, batch_size or BREVO_BATCH_SIZE)
+        self.timeout = timeout or BREVO_TIMEOUT
+        self.session = session or self._new_session()
+        self.session.headers.update({
+            "accept": "application/json", "content-type": "application/json", "api-key": api_key,
+        })
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'batches': 0, 'batched_messages': 0, 'batch_fallbacks': 0,
+                      'single_sends': 0, 'failures': 0}
+
+    @staticmethod
+    def _new_session():
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=BREVO_POOL_SIZE)
+        session.mount("https://", adapter)
+        return session
+
+    def _count(self, name, n=1):
+        with self.lock:
+            self.stats[name] += n
+
+    def _post(self, payload):
+        """(success, error, response body) for one API request."""
+        self._count('requests')
+        response = self.session.post(BREVO_API_URL, json=payload, timeout=self.timeout)
+        if response.status_code in OK_STATUSES:
+            try:
+                return True, None, response.json()
+            except ValueError:
+                return True, None, {}
+        err = f"Brevo API responded with {response.status_code}: {response.text}"
+        if response.status_code < 500:
+            return False, err, {}
+        return False, TransportError(err), {}
+
+    def send(self, message):
+        """Send one message; returns (success, error)."""
+        self._count('single_sends')
+        payload = {
+            "sender": self.sender,
+            "to": [{"email": message['to'], "name": message.get('name') or message['to'].split('@')[0]}],
+            "subject": message['subject'],
+            "textContent": message['text'],
+            "htmlContent": message['html'],
+        }
+        try:
+            ok, err, body = self._post(payload)
+        except requests.RequestException as e:
+            ok, err, body = False, TransportError(f"Brevo request failed: {e}"), {}
+        if ok and body.get('messageId'):
+            message['message_id'] = body['messageId']
+        if not ok:
+            self._count('failures')
+        return ok, err
+
+    def _version(self, message):
+        return {
+            "to": [{"email": message['to'], "name": message.get('name') or message['to'].split('@')[0]}],
+            "subject": message['subject'],
+            "textContent": message['text'],
+            "htmlContent": message['html'],
+        }
+
+    def send_batch(self, messages):
+        """Send many messages; returns a (success, error) per message, in order."""
+        results = [None] * len(messages)
+        valid = []
+        for i, message in enumerate(messages):
+            if is_valid_address(message.get('to')):
+                valid.append(i)
+            else:
+                # Rejected up front so one bad address can't fail a whole batch
+                results[i] = (False, "Invalid or missing recipient email address")
+
+        for start in range(0, len(valid), self.batch_size):
+            chunk = valid[start:start + self.batch_size]
+            if len(chunk) == 1:
+                results[chunk[0]] = self.send(messages[chunk[0]])
+                continue
+            first = messages[chunk[0]]
+            payload = {
+                "sender": self.sender,
+                "subject": first['subject'],
+                "textContent": first['text'],
+                "htmlContent": first['html'],
+                "messageVersions": [self._version(messages[i]) for i in chunk],
+            }
+            try:
+                ok, err, body = self._post(payload)
+            except requests.RequestException as e:
+                ok, err, body = False, TransportError(f"Brevo request failed: {e}"), {}
+            if ok:
+                self._count('batches')
+                self._count('batched_messages', len(chunk))
+                # One id per messageVersions entry, in order
+                message_ids = body.get('messageIds') or []
+                for n, i in enumerate(chunk):
+                    results[i] = (True, None)
+                    if len(message_ids) == len(chunk):
+                        messages[i]['message_id'] = message_ids[n]
+                continue
+            if isinstance(err, TransportError):
+                # Re-sending now could deliver twice; the caller retries later
+                print(f"⚠️ Brevo batch of {len(chunk)} did not complete ({err}); not retrying")
+                self._count('failures', len(chunk))
+                for i in chunk:
+                    results[i] = (False, err)
+                continue
+            print(f"⚠️ Brevo batch of {len(chunk)} rejected ({err}); retrying as single sends")
+            self._count('batch_fallbacks')
+            for i in chunk:
+                results[i] = self.send(messages[i])
+        return results
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats, batch_size=self.batch_size)
@@ -8,6 +8,14 @@ load_dotenv()
 # Also check parent directory for .env
 load_dotenv(os.path.join(os.path.dirname(__file__), '..', '.env'))
 
+# Claims skip rows another worker has locked (MySQL 8.0+ / MariaDB 10.6+); set false on older servers to wait instead
+DB_SKIP_LOCKED = os.getenv('DB_SKIP_LOCKED', 'true').lower() in ('1', 'true', 'yes')
+LOCK_ROWS = "FOR UPDATE SKIP LOCKED" if DB_SKIP_LOCKED else "FOR UPDATE"
+# Lead statuses the follow-up/drip scheduler may still send to
+SCHEDULED_STATUSES = "('outreach_sent', 'followup_sent')"
+# Values of outreach_logs.type
+OUTREACH_LOG_TYPES = ('email', 'whatsapp', 'reply', 'open')
+
 def get_db_connection():
     """Establishes a connection to the MySQL database."""
     try:
@@ -78,7 +86,7 @@ def init_db():
         CREATE TABLE IF NOT EXISTS outreach_logs (
             id INT AUTO_INCREMENT PRIMARY KEY,
             lead_id INT,
-            type ENUM('email', 'whatsapp'),
+            type ENUM('email', 'whatsapp', 'reply', 'open'),
             message TEXT,
             sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             response TEXT,
@@ -86,6 +94,12 @@ def init_db():
         )
         """)
 
+        # Replies and opens are logged too; older tables only allow email/whatsapp
+        try:
+            cursor.execute("ALTER TABLE outreach_logs MODIFY COLUMN type ENUM('email', 'whatsapp', 'reply', 'open')")
+        except Error:
+            pass
+
         # Settings Table
         cursor.execute("""
         CREATE TABLE IF NOT EXISTS settings (
@@ -150,6 +164,30 @@ def init_db():
         except Error:
             pass
 
+        # When the next follow-up/drip is due (NULL = nothing scheduled); set on every send
+        try:
+            cursor.execute("ALTER TABLE leads ADD COLUMN next_action_at DATETIME NULL")
+        except Error:
+            pass
+        try:
+            cursor.execute("CREATE INDEX idx_leads_next_action ON leads (next_action_at)")
+        except Error:
+            pass  # Index might already exist
+        # Scheduler batch holding the lead while its next_action_at is a lease (see claim_due_leads)
+        try:
+            cursor.execute("ALTER TABLE leads ADD COLUMN claim_token CHAR(32) NULL")
+        except Error:
+            pass
+        # Failed AI analyses; the lead leaves 'new' after ANALYSIS_MAX_ATTEMPTS (see record_analysis_failures)
+        try:
+            cursor.execute("ALTER TABLE leads ADD COLUMN analysis_attempts INT DEFAULT 0")
+        except Error:
+            pass
+        try:
+            cursor.execute("CREATE INDEX idx_leads_email ON leads (email)")
+        except Error:
+            pass  # Index might already exist
+
         # Campaign Sequences Table
         cursor.execute("""
         CREATE TABLE IF NOT EXISTS campaign_sequences (
@@ -231,6 +269,16 @@ def init_db():
         )
         """)
 
+        # One row per (lead, score type) so rescoring upserts instead of appending
+        try:
+            cursor.execute("""
+            DELETE s1 FROM lead_scores s1
+            JOIN lead_scores s2 ON s1.lead_id = s2.lead_id AND s1.score_type = s2.score_type AND s1.id < s2.id
+            """)
+            cursor.execute("ALTER TABLE lead_scores ADD UNIQUE KEY uniq_lead_score_type (lead_id, score_type)")
+        except Error:
+            pass  # Key might already exist
+
         # Lead Enrichment Table
         cursor.execute("""
         CREATE TABLE IF NOT EXISTS lead_enrichment (
@@ -343,6 +391,104 @@ def init_db():
         )
         """)
 
+        # Query planner statistics (per search query template, persisted across runs)
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS query_template_stats (
+            template_key CHAR(40) PRIMARY KEY,
+            offering VARCHAR(100),
+            template TEXT,
+            runs INT DEFAULT 0,
+            results INT DEFAULT 0,
+            leads INT DEFAULT 0,
+            duplicates INT DEFAULT 0,
+            total_latency_ms BIGINT DEFAULT 0,
+            zero_streak INT DEFAULT 0,
+            last_run_at TIMESTAMP NULL
+        )
+        """)
+
+        # Persistent LLM response cache (second tier behind the in-memory cache)
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS llm_response_cache (
+            cache_key CHAR(64) PRIMARY KEY,
+            model VARCHAR(128),
+            response MEDIUMTEXT,
+            hits INT DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            expires_at DATETIME NOT NULL,
+            INDEX idx_llm_cache_expires (expires_at)
+        )
+        """)
+
+        # Outbound mail queue drained by the outbox worker pool
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            idempotency_key VARCHAR(191) NOT NULL,
+            lead_id INT NULL,
+            kind VARCHAR(32) DEFAULT 'outreach',
+            to_email VARCHAR(255) NOT NULL,
+            to_name VARCHAR(255),
+            sender VARCHAR(255),
+            subject VARCHAR(998),
+            body MEDIUMTEXT,
+            html_body MEDIUMTEXT NULL,
+            message_id VARCHAR(255) NULL,
+            after_send JSON,
+            status VARCHAR(16) DEFAULT 'queued',
+            attempts INT DEFAULT 0,
+            max_attempts INT DEFAULT 5,
+            next_attempt_at DATETIME NOT NULL,
+            claim_token CHAR(32) NULL,
+            claimed_by VARCHAR(64) NULL,
+            lease_until DATETIME NULL,
+            provider VARCHAR(16) NULL,
+            dry_run BOOLEAN DEFAULT FALSE,
+            last_error TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            sent_at DATETIME NULL,
+            UNIQUE KEY uniq_outbox_idempotency (idempotency_key),
+            INDEX idx_outbox_due (status, next_attempt_at),
+            INDEX idx_outbox_claim (claim_token),
+            INDEX idx_outbox_sent (sent_at)
+        )
+        """)
+
+        # Pre-rendered HTML from the template engine (outbox tables created before it)
+        try:
+            cursor.execute("ALTER TABLE outbox ADD COLUMN html_body MEDIUMTEXT NULL AFTER body")
+        except Error:
+            pass  # Column might already exist
+
+        # Message-ID header each email goes out with, so replies can be threaded back to the lead
+        try:
+            cursor.execute("ALTER TABLE outbox ADD COLUMN message_id VARCHAR(255) NULL AFTER html_body")
+        except Error:
+            pass  # Column might already exist
+        try:
+            cursor.execute("CREATE INDEX idx_outbox_message_id ON outbox (message_id)")
+        except Error:
+            pass  # Index might already exist
+
+        # One row per AI provider request (or cache hit), written in batches by ai_ledger
+        cursor.execute("""
+        CREATE TABLE IF NOT EXISTS ai_calls (
+            id BIGINT AUTO_INCREMENT PRIMARY KEY,
+            agent VARCHAR(64),
+            provider VARCHAR(32),
+            model VARCHAR(128),
+            prompt_tokens INT DEFAULT 0,
+            response_tokens INT DEFAULT 0,
+            latency_ms INT DEFAULT 0,
+            status VARCHAR(20),
+            cache_hit BOOLEAN DEFAULT FALSE,
+            error VARCHAR(255),
+            created_at DATETIME NOT NULL,
+            INDEX idx_ai_calls_created (created_at),
+            INDEX idx_ai_calls_agent (agent, created_at)
+        )
+        """)
+
         conn.commit()
         cursor.close()
         conn.close()
@@ -579,6 +725,111 @@ def update_lead_analysis(lead_id, analysis_json, trust_score, status):
         cursor.close()
         conn.close()
 
+def get_leads_by_ids(lead_ids):
+    """Fetch many leads in one query; returns them in the order of `lead_ids`."""
+    lead_ids = [int(i) for i in lead_ids or []]
+    if not lead_ids:
+        return []
+    conn = get_db_connection()
+    leads = []
+    if conn:
+        cursor = conn.cursor(dictionary=True)
+        placeholders = ", ".join(["%s"] * len(lead_ids))
+        cursor.execute(f"SELECT * FROM leads WHERE id IN ({placeholders})", tuple(lead_ids))
+        by_id = {row['id']: row for row in cursor.fetchall()}
+        leads = [by_id[i] for i in lead_ids if i in by_id]
+        cursor.close()
+        conn.close()
+    return leads
+
+def get_leads_by_status(status, limit=None):
+    conn = get_db_connection()
+    leads = []
+    if conn:
+        cursor = conn.cursor(dictionary=True)
+        sql = "SELECT * FROM leads WHERE status = %s ORDER BY id"
+        params = [status]
+        if limit:
+            sql += " LIMIT %s"
+            params.append(int(limit))
+        cursor.execute(sql, tuple(params))
+        leads = cursor.fetchall()
+        cursor.close()
+        conn.close()
+    return leads
+
+def update_leads_analysis_batch(rows, chunk_size=500):
+    """Write many (lead_id, analysis_json, trust_score, status) rows.
+
+    Each chunk is a single UPDATE ... CASE statement, and all chunks are
+    committed together.
+    """
+    rows = list(rows or [])
+    if not rows:
+        return 0
+    conn = get_db_connection()
+    if not conn:
+        return 0
+    cursor = conn.cursor()
+    updated = 0
+    try:
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            cases = " ".join(["WHEN %s THEN %s"] * len(chunk))
+            placeholders = ", ".join(["%s"] * len(chunk))
+            sql = (
+                f"UPDATE leads SET "
+                f"ai_analysis = CASE id {cases} END, "
+                f"trust_score = CASE id {cases} END, "
+                f"status = CASE id {cases} END "
+                f"WHERE id IN ({placeholders})"
+            )
+            params = []
+            for column in range(1, 4):
+                for row in chunk:
+                    params.extend((row[0], row[column]))
+            params.extend(row[0] for row in chunk)
+            cursor.execute(sql, tuple(params))
+            updated += cursor.rowcount
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+    return updated
+
+def record_analysis_failures(lead_ids, max_attempts):
+    """Count a failed analysis for each 'new' lead; leads reaching max_attempts
+    move to 'analysis_failed' so the autopilot stops retrying them. Returns
+    the number of leads given up on."""
+    lead_ids = list(lead_ids or [])
+    if not lead_ids:
+        return 0
+    conn = get_db_connection()
+    if not conn:
+        return 0
+    cursor = conn.cursor()
+    placeholders = ", ".join(["%s"] * len(lead_ids))
+    # MySQL applies SET assignments left to right, so status reads the old attempt count
+    cursor.execute(
+        f"UPDATE leads SET "
+        f"status = CASE WHEN COALESCE(analysis_attempts, 0) + 1 >= %s THEN 'analysis_failed' ELSE status END, "
+        f"analysis_attempts = COALESCE(analysis_attempts, 0) + 1 "
+        f"WHERE id IN ({placeholders}) AND status = 'new'",
+        (max_attempts, *lead_ids),
+    )
+    cursor.execute(
+        f"SELECT COUNT(*) FROM leads WHERE id IN ({placeholders}) AND status = 'analysis_failed'",
+        tuple(lead_ids),
+    )
+    given_up = cursor.fetchone()[0]
+    conn.commit()
+    cursor.close()
+    conn.close()
+    return given_up
+
 def update_lead_status(lead_id, status):
     """Backwards-compatible helper to update a lead's status."""
     conn = get_db_connection()
@@ -608,6 +859,109 @@ def log_outreach(lead_id, outreach_type, message, update_status=True):
         cursor.close()
         conn.close()
 
+def record_outreach_batch(entries, chunk_size=500):
+    """Log many sent messages and advance their leads, normally in one transaction.
+
+    Each entry is a dict with lead_id, type and message, plus optional
+    update_status (default True: status 'outreach_sent' and last_outreach_at),
+    lead_status, sequence_step and next_action_in (seconds from now until the
+    next scheduled send; None clears it, a missing key leaves it alone). Logs
+    go in as multi-row INSERTs and every lead is updated once, with its last
+    entry winning. If the batch fails, each lead's entries are retried in
+    their own transaction so one bad row (a deleted lead, say) only loses
+    itself. Returns the number of entries written.
+    """
+    entries = [e for e in entries or [] if e.get('lead_id')]
+    if not entries:
+        return 0
+    conn = get_db_connection()
+    if not conn:
+        return 0
+    cursor = conn.cursor()
+    try:
+        try:
+            _write_outreach_entries(cursor, entries, chunk_size)
+            conn.commit()
+            return len(entries)
+        except Error as e:
+            conn.rollback()
+            print(f"Error recording outreach batch, retrying per lead: {e}")
+        by_lead = {}
+        for e in entries:
+            by_lead.setdefault(e['lead_id'], []).append(e)
+        written = 0
+        for lead_id, lead_entries in by_lead.items():
+            try:
+                _write_outreach_entries(cursor, lead_entries, chunk_size)
+                conn.commit()
+                written += len(lead_entries)
+            except Error as e:
+                conn.rollback()
+                print(f"Error recording outreach for lead {lead_id}: {e}")
+        return written
+    finally:
+        cursor.close()
+        conn.close()
+
+def _write_outreach_entries(cursor, entries, chunk_size):
+    """Run record_outreach_batch's log INSERTs and lead UPDATEs; the caller commits."""
+    # Fold entries into the final state per lead, in order
+    final = {}
+    for e in entries:
+        state = final.setdefault(e['lead_id'], {'status': None, 'step': None, 'touch': False})
+        if 'next_action_in' in e:
+            state['next'] = e['next_action_in']
+        if e.get('update_status', True):
+            state['status'], state['touch'] = 'outreach_sent', True
+        if e.get('lead_status'):
+            state['status'], state['touch'] = e['lead_status'], True
+        if e.get('sequence_step') is not None:
+            state['step'] = e['sequence_step']
+
+    for start in range(0, len(entries), chunk_size):
+        chunk = entries[start:start + chunk_size]
+        sql = "INSERT INTO outreach_logs (lead_id, type, message) VALUES " + ", ".join(["(%s, %s, %s)"] * len(chunk))
+        params = []
+        for e in chunk:
+            params.extend((e['lead_id'], e.get('type') or 'email', e['message']))
+        cursor.execute(sql, tuple(params))
+
+    lead_ids = list(final)
+    for start in range(0, len(lead_ids), chunk_size):
+        chunk = lead_ids[start:start + chunk_size]
+        sets, params = [], []
+        for column, key in (('status', 'status'), ('current_sequence_step', 'step')):
+            changed = [i for i in chunk if final[i][key] is not None]
+            if changed:
+                sets.append(f"{column} = CASE id {' '.join(['WHEN %s THEN %s'] * len(changed))} ELSE {column} END")
+                for i in changed:
+                    params.extend((i, final[i][key]))
+        scheduled = [i for i in chunk if 'next' in final[i]]
+        if scheduled:
+            cases = []
+            for i in scheduled:
+                if final[i]['next'] is None:
+                    cases.append("WHEN %s THEN NULL")
+                    params.append(i)
+                else:
+                    cases.append("WHEN %s THEN NOW() + INTERVAL %s SECOND")
+                    params.extend((i, int(final[i]['next'])))
+            sets.append(f"next_action_at = CASE id {' '.join(cases)} ELSE next_action_at END")
+            # The send's own schedule wins over the claim that queued it
+            sets.append(f"claim_token = CASE WHEN id IN ({', '.join(['%s'] * len(scheduled))}) THEN NULL ELSE claim_token END")
+            params.extend(scheduled)
+        touched = [i for i in chunk if final[i]['touch']]
+        if touched:
+            sets.append(f"last_outreach_at = CASE WHEN id IN ({', '.join(['%s'] * len(touched))}) THEN NOW() ELSE last_outreach_at END")
+            params.extend(touched)
+        if not sets:
+            continue
+        params.extend(chunk)
+        cursor.execute(
+            f"UPDATE leads SET {', '.join(sets)} WHERE id IN ({', '.join(['%s'] * len(chunk))})",
+            tuple(params)
+        )
+
 def update_lead_sequence_step(lead_id, step):
     conn = get_db_connection()
     if conn:
@@ -709,13 +1063,110 @@ def mark_lead_replied(lead_id, subject, body):
     conn = get_db_connection()
     if conn:
         cursor = conn.cursor()
-        cursor.execute("UPDATE leads SET replied = TRUE, replied_at = NOW(), status = 'replied', reply_subject = %s, reply_body = %s WHERE id = %s", (subject, body, lead_id))
+        cursor.execute("UPDATE leads SET replied = TRUE, replied_at = NOW(), status = 'replied', reply_subject = %s, reply_body = %s, next_action_at = NULL WHERE id = %s", (subject, body, lead_id))
         conn.commit()
         cursor.close()
         conn.close()
         return True
     return False
 
+def record_replies(replies, chunk_size=500):
+    """Mark many leads replied and log each reply.
+
+    `replies` is a list of (lead_id, subject, body); a lead replying more
+    than once keeps its last subject and body. The lead updates are committed
+    first and on their own, so a log row that fails (say, for a lead deleted
+    since it was indexed) never undoes them. Returns the number of leads, or
+    None if the leads could not be updated.
+    """
+    replies = [r for r in replies or [] if r[0]]
+    if not replies:
+        return 0
+    conn = get_db_connection()
+    if not conn:
+        return None
+    final = {lead_id: ((subject or '')[:255], body or '') for lead_id, subject, body in replies}
+    cursor = conn.cursor()
+    try:
+        lead_ids = list(final)
+        for start in range(0, len(lead_ids), chunk_size):
+            chunk = lead_ids[start:start + chunk_size]
+            cases = ' '.join(['WHEN %s THEN %s'] * len(chunk))
+            params = []
+            for column in (0, 1):
+                for i in chunk:
+                    params.extend((i, final[i][column]))
+            params.extend(chunk)
+            cursor.execute(
+                f"UPDATE leads SET replied = TRUE, replied_at = NOW(), status = 'replied', next_action_at = NULL, claim_token = NULL, "
+                f"reply_subject = CASE id {cases} ELSE reply_subject END, "
+                f"reply_body = CASE id {cases} ELSE reply_body END "
+                f"WHERE id IN ({', '.join(['%s'] * len(chunk))})",
+                tuple(params)
+            )
+        conn.commit()
+    except Error as e:
+        conn.rollback()
+        print(f"Error recording replies: {e}")
+        cursor.close()
+        conn.close()
+        return None
+
+    rows = [(lead_id, f"Incoming reply: {subject or '(no subject)'}") for lead_id, subject, _ in replies]
+    try:
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            sql = "INSERT INTO outreach_logs (lead_id, type, message) VALUES " + ", ".join(["(%s, 'reply', %s)"] * len(chunk))
+            try:
+                cursor.execute(sql, tuple(value for row in chunk for value in row))
+                conn.commit()
+            except Error:
+                # One bad row fails the whole statement; log the rest one by one
+                conn.rollback()
+                for row in chunk:
+                    try:
+                        cursor.execute("INSERT INTO outreach_logs (lead_id, type, message) VALUES (%s, 'reply', %s)", row)
+                        conn.commit()
+                    except Error as e:
+                        conn.rollback()
+                        print(f"Error logging reply for lead {row[0]}: {e}")
+    finally:
+        cursor.close()
+        conn.close()
+    return len(final)
+
+def get_lead_emails_since(after_id, limit=5000):
+    """(id, email) of leads with an address and an id above after_id, oldest first."""
+    conn = get_db_connection()
+    rows = []
+    if conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT id, email FROM leads WHERE id > %s AND email IS NOT NULL AND email <> '' ORDER BY id LIMIT %s",
+            (after_id, limit)
+        )
+        rows = cursor.fetchall()
+        cursor.close()
+        conn.close()
+    return rows
+
+def get_sent_message_ids_since(after_id, days=120, limit=5000):
+    """(outbox id, lead_id, message_id) of lead emails queued in the last `days`, above after_id."""
+    conn = get_db_connection()
+    rows = []
+    if conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT id, lead_id, message_id FROM outbox "
+            "WHERE id > %s AND message_id IS NOT NULL AND lead_id IS NOT NULL "
+            "AND created_at >= NOW() - INTERVAL %s DAY ORDER BY id LIMIT %s",
+            (after_id, days, limit)
+        )
+        rows = cursor.fetchall()
+        cursor.close()
+        conn.close()
+    return rows
+
 def get_follow_up_candidates(days=2):
     """Get leads that were contacted X days ago and haven't replied yet."""
     conn = get_db_connection()
@@ -735,35 +1186,299 @@ def get_follow_up_candidates(days=2):
         conn.close()
     return leads
 
-def get_auto_follow_up_candidates(days=2, max_step=3):
-    """Get leads for automatic follow-up sequence."""
+def get_next_actions(within_seconds, limit=1000):
+    """(database NOW(), [(lead_id, next_action_at)]) for the earliest scheduled sends due within the window.
+
+    Uses idx_leads_next_action. The database clock comes back with the rows
+    so callers can compare due times against it rather than their own clock.
+    """
+    conn = get_db_connection()
+    if not conn:
+        return None, []
+    cursor = conn.cursor()
+    cursor.execute("SELECT NOW()")
+    db_now = cursor.fetchone()[0]
+    cursor.execute(
+        "SELECT id, next_action_at FROM leads WHERE next_action_at IS NOT NULL "
+        f"AND next_action_at <= NOW() + INTERVAL %s SECOND AND status IN {SCHEDULED_STATUSES} "
+        "ORDER BY next_action_at LIMIT %s",
+        (int(within_seconds), int(limit))
+    )
+    rows = cursor.fetchall()
+    cursor.close()
+    conn.close()
+    return db_now, rows
+
+def claim_due_leads(lead_ids, claim_token, lease_seconds, limit=None):
+    """Claim those of lead_ids that are due, unanswered and still in an outreach status for one scheduler batch.
+
+    Every row is locked with SKIP LOCKED before it is written, so workers in
+    other processes pass over leads already being claimed instead of waiting
+    on them. A claimed lead gets claim_token and has next_action_at pushed to
+    the end of the lease: if the claimer dies before release_claimed_leads,
+    the lead comes due again then. Due leads that have left the outreach statuses (re-analysed,
+    skipped, ...) get next_action_at cleared instead. Returns the claimed rows.
+    """
+    lead_ids = [int(i) for i in lead_ids or []]
+    if not lead_ids:
+        return []
+    conn = get_db_connection()
+    if not conn:
+        return []
+    cursor = conn.cursor(dictionary=True)
+    try:
+        placeholders = ", ".join(["%s"] * len(lead_ids))
+        cursor.execute(
+            f"SELECT id FROM leads WHERE id IN ({placeholders}) AND next_action_at <= NOW() "
+            f"AND replied = FALSE AND status IN {SCHEDULED_STATUSES} ORDER BY next_action_at LIMIT %s {LOCK_ROWS}",
+            (*lead_ids, int(limit or len(lead_ids)))
+        )
+        claimed = [row['id'] for row in cursor.fetchall()]
+        # Lock stale rows the same way before clearing them, so no statement here waits on another claimer
+        cursor.execute(
+            f"SELECT id FROM leads WHERE id IN ({placeholders}) AND next_action_at <= NOW() "
+            f"AND status NOT IN {SCHEDULED_STATUSES} {LOCK_ROWS}",
+            tuple(lead_ids)
+        )
+        stale = [row['id'] for row in cursor.fetchall()]
+        if stale:
+            cursor.execute(
+                f"UPDATE leads SET next_action_at = NULL, claim_token = NULL WHERE id IN ({', '.join(['%s'] * len(stale))})",
+                tuple(stale)
+            )
+        leads = []
+        if claimed:
+            placeholders = ", ".join(["%s"] * len(claimed))
+            cursor.execute(
+                f"UPDATE leads SET claim_token = %s, next_action_at = NOW() + INTERVAL %s SECOND WHERE id IN ({placeholders})",
+                (claim_token, int(lease_seconds), *claimed)
+            )
+            cursor.execute(f"SELECT * FROM leads WHERE id IN ({placeholders}) ORDER BY id", tuple(claimed))
+            leads = cursor.fetchall()
+        conn.commit()
+        return leads
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+
+def release_claimed_leads(lead_ids, claim_token, next_action_in=None):
+    """End a claim: clear next_action_at, or with next_action_in push it that many seconds out.
+
+    Only leads still holding claim_token change; a send that already
+    recorded its next step (record_outreach_batch drops the token) or a
+    claim taken over after the lease ran out is left alone.
+    """
+    lead_ids = [int(i) for i in lead_ids or []]
+    if not lead_ids:
+        return 0
+    conn = get_db_connection()
+    if not conn:
+        return 0
+    cursor = conn.cursor()
+    placeholders = ", ".join(["%s"] * len(lead_ids))
+    if next_action_in is None:
+        cursor.execute(
+            f"UPDATE leads SET claim_token = NULL, next_action_at = NULL WHERE claim_token = %s AND id IN ({placeholders})",
+            (claim_token, *lead_ids)
+        )
+    else:
+        cursor.execute(
+            f"UPDATE leads SET claim_token = NULL, next_action_at = NOW() + INTERVAL %s SECOND "
+            f"WHERE claim_token = %s AND id IN ({placeholders})",
+            (int(next_action_in), claim_token, *lead_ids)
+        )
+    released = cursor.rowcount
+    conn.commit()
+    cursor.close()
+    conn.close()
+    return released
+
+def backfill_next_action_at(delay_days, max_step):
+    """Schedule follow-ups for contacted leads sent before next_action_at existed."""
+    conn = get_db_connection()
+    if not conn:
+        return 0
+    cursor = conn.cursor()
+    cursor.execute("""
+        UPDATE leads SET next_action_at = last_outreach_at + INTERVAL %s DAY
+        WHERE next_action_at IS NULL AND last_outreach_at IS NOT NULL
+        AND status IN ('outreach_sent', 'followup_sent') AND replied = FALSE
+        AND current_sequence_step < %s
+    """, (int(delay_days), int(max_step)))
+    count = cursor.rowcount
+    conn.commit()
+    cursor.close()
+    conn.close()
+    return count
+
+def get_replied_leads(limit=100):
     conn = get_db_connection()
     leads = []
     if conn:
         cursor = conn.cursor(dictionary=True)
-        query = """
-            SELECT * FROM leads 
-            WHERE status IN ('outreach_sent', 'followup_sent')
-            AND replied = FALSE 
-            AND current_sequence_step < %s
-            AND last_outreach_at <= DATE_SUB(NOW(), INTERVAL %s DAY)
-        """
-        cursor.execute(query, (max_step, days))
+        cursor.execute("SELECT * FROM leads WHERE replied = TRUE ORDER BY replied_at DESC LIMIT %s", (limit,))
         leads = cursor.fetchall()
         cursor.close()
         conn.close()
     return leads
 
-def get_replied_leads(limit=100):
+# Query planner statistics
+
+def get_query_template_stats(template_keys):
+    """Return {template_key: stats_row} for the given template keys."""
     conn = get_db_connection()
-    leads = []
+    stats = {}
+    if conn and template_keys:
+        cursor = conn.cursor(dictionary=True)
+        placeholders = ', '.join(['%s'] * len(template_keys))
+        # Idle time is worked out on the database clock, the one last_run_at is written with
+        cursor.execute(
+            f"SELECT *, TIMESTAMPDIFF(SECOND, last_run_at, NOW()) AS idle_seconds "
+            f"FROM query_template_stats WHERE template_key IN ({placeholders})",
+            tuple(template_keys),
+        )
+        for row in cursor.fetchall():
+            stats[row['template_key']] = row
+        cursor.close()
+    if conn:
+        conn.close()
+    return stats
+
+def record_query_template_runs(runs):
+    """Accumulate per-template run results in one multi-row upsert.
+
+    Each run is a dict with template_key, offering, template, results, leads,
+    duplicates and latency_ms.
+    """
+    if not runs:
+        return False
+    conn = get_db_connection()
+    if not conn:
+        return False
+    cursor = conn.cursor()
+    placeholders = ', '.join(['(%s, %s, %s, 1, %s, %s, %s, %s, %s, NOW())'] * len(runs))
+    values = []
+    for r in runs:
+        values.extend([
+            r['template_key'], r.get('offering'), r.get('template'),
+            r.get('results', 0), r.get('leads', 0), r.get('duplicates', 0),
+            int(r.get('latency_ms', 0)), 0 if r.get('leads') else 1
+        ])
+    sql = f"""
+    INSERT INTO query_template_stats
+        (template_key, offering, template, runs, results, leads, duplicates, total_latency_ms, zero_streak, last_run_at)
+    VALUES {placeholders}
+    ON DUPLICATE KEY UPDATE
+        runs = runs + 1,
+        results = results + VALUES(results),
+        leads = leads + VALUES(leads),
+        duplicates = duplicates + VALUES(duplicates),
+        total_latency_ms = total_latency_ms + VALUES(total_latency_ms),
+        zero_streak = IF(VALUES(leads) > 0, 0, zero_streak + 1),
+        last_run_at = NOW()
+    """
+    cursor.execute(sql, tuple(values))
+    conn.commit()
+    cursor.close()
+    conn.close()
+    return True
+
+def get_all_query_template_stats():
+    conn = get_db_connection()
+    stats = []
     if conn:
         cursor = conn.cursor(dictionary=True)
-        cursor.execute("SELECT * FROM leads WHERE replied = TRUE ORDER BY replied_at DESC LIMIT %s", (limit,))
-        leads = cursor.fetchall()
+        cursor.execute("SELECT *, TIMESTAMPDIFF(SECOND, last_run_at, NOW()) AS idle_seconds "
+                       "FROM query_template_stats ORDER BY offering, leads DESC")
+        stats = cursor.fetchall()
         cursor.close()
         conn.close()
-    return leads
+    return stats
+
+# LLM response cache
+
+def get_llm_cache_entry(cache_key):
+    """Return the cached response text for a key if it has not expired."""
+    conn = get_db_connection()
+    response = None
+    if conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT response FROM llm_response_cache WHERE cache_key = %s AND expires_at > NOW()",
+            (cache_key,)
+        )
+        row = cursor.fetchone()
+        if row:
+            response = row[0]
+            cursor.execute("UPDATE llm_response_cache SET hits = hits + 1 WHERE cache_key = %s", (cache_key,))
+            conn.commit()
+        cursor.close()
+        conn.close()
+    return response
+
+def put_llm_cache_entry(cache_key, model, response, ttl_seconds):
+    conn = get_db_connection()
+    if not conn:
+        return False
+    cursor = conn.cursor()
+    cursor.execute("""
+    INSERT INTO llm_response_cache (cache_key, model, response, expires_at)
+    VALUES (%s, %s, %s, NOW() + INTERVAL %s SECOND)
+    ON DUPLICATE KEY UPDATE
+        model = VALUES(model),
+        response = VALUES(response),
+        created_at = CURRENT_TIMESTAMP,
+        expires_at = VALUES(expires_at)
+    """, (cache_key, model, response, int(ttl_seconds)))
+    conn.commit()
+    cursor.close()
+    conn.close()
+    return True
+
+def delete_llm_cache_entry(cache_key):
+    conn = get_db_connection()
+    if conn:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM llm_response_cache WHERE cache_key = %s", (cache_key,))
+        conn.commit()
+        cursor.close()
+        conn.close()
+
+def prune_llm_cache(max_rows):
+    """Delete expired rows, then the oldest rows beyond max_rows. Returns rows deleted."""
+    conn = get_db_connection()
+    if not conn:
+        return 0
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM llm_response_cache WHERE expires_at <= NOW()")
+    deleted = cursor.rowcount
+    cursor.execute("SELECT COUNT(*) FROM llm_response_cache")
+    excess = cursor.fetchone()[0] - int(max_rows)
+    if excess > 0:
+        cursor.execute("DELETE FROM llm_response_cache ORDER BY created_at ASC LIMIT %s", (excess,))
+        deleted += cursor.rowcount
+    conn.commit()
+    cursor.close()
+    conn.close()
+    return deleted
+
+def get_llm_cache_stats():
+    conn = get_db_connection()
+    stats = {}
+    if conn:
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute("""
+        SELECT COUNT(*) AS entries, COALESCE(SUM(hits), 0) AS hits,
+               SUM(expires_at <= NOW()) AS expired
+        FROM llm_response_cache
+        """)
+        stats = cursor.fetchone() or {}
+        cursor.close()
+        conn.close()
+    return stats
 
 # ===== NEW ENHANCED FEATURES FUNCTIONS =====
 
@@ -844,6 +1559,71 @@ def save_lead_score(lead_id, score_type, score, reasoning=""):
         cursor.close()
         conn.close()
 
+def save_lead_scores_batch(rows, chunk_size=500):
+    """Upsert many (lead_id, score_type, score, reasoning) rows.
+
+    Each chunk is one multi-row INSERT ... ON DUPLICATE KEY UPDATE, and all
+    chunks are committed together.
+    """
+    rows = list(rows or [])
+    if not rows:
+        return 0
+    conn = get_db_connection()
+    if not conn:
+        return 0
+    cursor = conn.cursor()
+    written = 0
+    try:
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            values = ", ".join(["(%s, %s, %s, %s)"] * len(chunk))
+            sql = (
+                f"INSERT INTO lead_scores (lead_id, score_type, score, reasoning) VALUES {values} "
+                "ON DUPLICATE KEY UPDATE score = VALUES(score), reasoning = VALUES(reasoning), scored_at = CURRENT_TIMESTAMP"
+            )
+            params = []
+            for row in chunk:
+                params.extend(row)
+            cursor.execute(sql, tuple(params))
+            written += len(chunk)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+    return written
+
+def get_leads_for_scoring(status=None, min_trust_score=None, max_trust_score=None, unscored_only=False, limit=None):
+    """Leads matching a batch-scoring filter (only the columns the scoring prompt uses)."""
+    conn = get_db_connection()
+    leads = []
+    if conn:
+        cursor = conn.cursor(dictionary=True)
+        sql = "SELECT l.id, l.name, l.company, l.email, l.phone, l.location FROM leads l WHERE 1=1"
+        params = []
+        if status:
+            sql += " AND l.status = %s"
+            params.append(status)
+        if min_trust_score is not None:
+            sql += " AND l.trust_score >= %s"
+            params.append(int(min_trust_score))
+        if max_trust_score is not None:
+            sql += " AND l.trust_score <= %s"
+            params.append(int(max_trust_score))
+        if unscored_only:
+            sql += " AND NOT EXISTS (SELECT 1 FROM lead_scores s WHERE s.lead_id = l.id AND s.score_type = 'overall')"
+        sql += " ORDER BY l.id"
+        if limit:
+            sql += " LIMIT %s"
+            params.append(int(limit))
+        cursor.execute(sql, tuple(params))
+        leads = cursor.fetchall()
+        cursor.close()
+        conn.close()
+    return leads
+
 def get_lead_scores(lead_id):
     conn = get_db_connection()
     scores = []
@@ -1263,3 +2043,311 @@ def get_enhanced_dashboard_stats():
         conn.close()
     
     return stats
+
+AI_CALL_COLUMNS = ('agent', 'provider', 'model', 'prompt_tokens', 'response_tokens',
+                   'latency_ms', 'status', 'cache_hit', 'error', 'created_at')
+
+def insert_ai_calls_batch(rows, chunk_size=500):
+    """Insert many ai_calls rows (dicts keyed by AI_CALL_COLUMNS) with multi-row INSERTs."""
+    rows = list(rows or [])
+    if not rows:
+        return 0
+    conn = get_db_connection()
+    if not conn:
+        return 0
+    cursor = conn.cursor()
+    try:
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            placeholders = "(" + ", ".join(["%s"] * len(AI_CALL_COLUMNS)) + ")"
+            sql = f"INSERT INTO ai_calls ({', '.join(AI_CALL_COLUMNS)}) VALUES " + ", ".join([placeholders] * len(chunk))
+            params = []
+            for row in chunk:
+                params.extend(row.get(column) for column in AI_CALL_COLUMNS)
+            cursor.execute(sql, tuple(params))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+    return len(rows)
+
+def get_ai_calls_since(hours=24, limit=50000):
+    """Recent ai_calls rows (newest first), or None if the database is unavailable."""
+    conn = get_db_connection()
+    if not conn:
+        return None
+    cursor = conn.cursor(dictionary=True)
+    cursor.execute(
+        f"SELECT {', '.join(AI_CALL_COLUMNS)} FROM ai_calls "
+        "WHERE created_at >= NOW() - INTERVAL %s HOUR ORDER BY id DESC LIMIT %s",
+        (int(hours), int(limit))
+    )
+    rows = cursor.fetchall()
+    cursor.close()
+    conn.close()
+    return rows
+
+OUTBOX_COLUMNS = ('idempotency_key', 'lead_id', 'kind', 'to_email', 'to_name', 'sender',
+                  'subject', 'body', 'html_body', 'message_id', 'after_send', 'max_attempts')
+
+def enqueue_outbox(items, chunk_size=500):
+    """Queue outbound emails (dicts keyed by OUTBOX_COLUMNS; after_send may be a dict).
+
+    Items whose idempotency_key already exists are not queued again.
+    Returns {idempotency_key: (outbox_id, status, duplicate)} for every item.
+    """
+    items = list(items or [])
+    if not items:
+        return {}
+    conn = get_db_connection()
+    if not conn:
+        return {}
+    cursor = conn.cursor()
+
+    def lookup(keys):
+        found = {}
+        for start in range(0, len(keys), chunk_size):
+            chunk = keys[start:start + chunk_size]
+            placeholders = ", ".join(["%s"] * len(chunk))
+            cursor.execute(f"SELECT id, idempotency_key, status FROM outbox WHERE idempotency_key IN ({placeholders})", tuple(chunk))
+            for outbox_id, key, status in cursor.fetchall():
+                found[key] = (outbox_id, status)
+        return found
+
+    try:
+        existing = lookup(list({item['idempotency_key'] for item in items}))
+        new_items, seen = [], set(existing)
+        for item in items:
+            if item['idempotency_key'] not in seen:
+                seen.add(item['idempotency_key'])
+                new_items.append(item)
+        for start in range(0, len(new_items), chunk_size):
+            chunk = new_items[start:start + chunk_size]
+            placeholders = "(" + ", ".join(["%s"] * len(OUTBOX_COLUMNS)) + ", NOW())"
+            # IGNORE covers a concurrent enqueue of the same key between lookup and insert
+            sql = (
+                f"INSERT IGNORE INTO outbox ({', '.join(OUTBOX_COLUMNS)}, next_attempt_at) VALUES "
+                + ", ".join([placeholders] * len(chunk))
+            )
+            params = []
+            for item in chunk:
+                for column in OUTBOX_COLUMNS:
+                    value = item.get(column)
+                    if column == 'after_send' and value is not None and not isinstance(value, str):
+                        value = json.dumps(value)
+                    params.append(value)
+            cursor.execute(sql, tuple(params))
+        conn.commit()
+
+        created = lookup([item['idempotency_key'] for item in new_items]) if new_items else {}
+        result = {key: (outbox_id, status, True) for key, (outbox_id, status) in existing.items()}
+        for key, (outbox_id, status) in created.items():
+            result[key] = (outbox_id, status, False)
+        return result
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+
+def claim_outbox(worker_id, claim_token, limit, lease_seconds):
+    """Atomically claim up to `limit` due emails (or ones whose lease expired).
+
+    A single UPDATE stamps the rows with `claim_token`, so concurrent workers
+    never claim the same row. Expired leases that already used their last
+    attempt are moved to 'dead' instead of being retried. Returns the claimed rows.
+    """
+    conn = get_db_connection()
+    if not conn:
+        return []
+    cursor = conn.cursor(dictionary=True)
+    # claim_token is kept so a worker that did send before its lease ran out can still record 'sent'
+    cursor.execute("""
+        UPDATE outbox
+        SET status = 'dead', lease_until = NULL, last_error = 'Lease expired after the final attempt'
+        WHERE status = 'sending' AND lease_until < NOW() AND attempts >= max_attempts
+    """)
+    if cursor.rowcount:
+        print(f"[OUTBOX] Dead-lettered {cursor.rowcount} email(s) whose lease expired on the final attempt")
+    cursor.execute("""
+        UPDATE outbox
+        SET status = 'sending', claim_token = %s, claimed_by = %s,
+            lease_until = NOW() + INTERVAL %s SECOND, attempts = attempts + 1
+        WHERE (status = 'queued' AND next_attempt_at <= NOW())
+           OR (status = 'sending' AND lease_until < NOW() AND attempts < max_attempts)
+        ORDER BY next_attempt_at, id
+        LIMIT %s
+    """, (claim_token, worker_id, int(lease_seconds), int(limit)))
+    conn.commit()
+    rows = []
+    if cursor.rowcount:
+        cursor.execute("SELECT * FROM outbox WHERE claim_token = %s AND status = 'sending' ORDER BY id", (claim_token,))
+        rows = cursor.fetchall()
+    cursor.close()
+    conn.close()
+    return rows
+
+def extend_outbox_lease(claim_token, lease_seconds):
+    """Push out lease_until for the rows still held under `claim_token`; returns how many are."""
+    conn = get_db_connection()
+    if not conn:
+        return 0
+    cursor = conn.cursor()
+    cursor.execute(
+        "UPDATE outbox SET lease_until = NOW() + INTERVAL %s SECOND WHERE claim_token = %s AND status = 'sending'",
+        (int(lease_seconds), claim_token),
+    )
+    conn.commit()
+    renewed = cursor.rowcount
+    cursor.close()
+    conn.close()
+    return renewed
+
+def complete_outbox(results):
+    """Record send outcomes for claimed rows in one transaction.
+
+    results: iterable of dicts with id, claim_token and either status='sent'
+    (provider, dry_run, optional message_id) or status 'queued' / 'dead'
+    (error, retry_in seconds).
+    Rows whose claim was taken over by another worker are left alone.
+    """
+    results = list(results or [])
+    if not results:
+        return 0
+    conn = get_db_connection()
+    if not conn:
+        return 0
+    cursor = conn.cursor()
+    updated = 0
+    try:
+        sent = [r for r in results if r['status'] == 'sent']
+        if sent:
+            cases = " ".join(["WHEN %s THEN %s"] * len(sent))
+            conditions = " OR ".join(["(id = %s AND claim_token = %s)"] * len(sent))
+            params = []
+            for r in sent:
+                params.extend((r['id'], r.get('provider')))
+            for r in sent:
+                params.extend((r['id'], bool(r.get('dry_run'))))
+            # The provider may have sent under its own Message-ID
+            renamed = [r for r in sent if r.get('message_id')]
+            message_ids = ""
+            if renamed:
+                message_ids = f", message_id = CASE id {' '.join(['WHEN %s THEN %s'] * len(renamed))} ELSE message_id END"
+                for r in renamed:
+                    params.extend((r['id'], r['message_id'][:255]))
+            for r in sent:
+                params.extend((r['id'], r['claim_token']))
+            cursor.execute(
+                f"UPDATE outbox SET status = 'sent', sent_at = NOW(), lease_until = NULL, last_error = NULL, "
+                f"provider = CASE id {cases} END, dry_run = CASE id {cases} END{message_ids} WHERE {conditions}",
+                tuple(params)
+            )
+            updated += cursor.rowcount
+        for r in results:
+            if r['status'] == 'sent':
+                continue
+            cursor.execute(
+                "UPDATE outbox SET status = %s, last_error = %s, lease_until = NULL, "
+                "next_attempt_at = NOW() + INTERVAL %s SECOND WHERE id = %s AND claim_token = %s",
+                (r['status'], (r.get('error') or '')[:2000], int(r.get('retry_in') or 0), r['id'], r['claim_token'])
+            )
+            updated += cursor.rowcount
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+    return updated
+
+def requeue_dead_outbox(ids=None):
+    """Move dead-lettered emails (all, or the given ids) back to the queue."""
+    conn = get_db_connection()
+    if not conn:
+        return 0
+    cursor = conn.cursor()
+    sql = "UPDATE outbox SET status = 'queued', attempts = 0, next_attempt_at = NOW(), last_error = NULL WHERE status = 'dead'"
+    params = ()
+    if ids:
+        sql += f" AND id IN ({', '.join(['%s'] * len(ids))})"
+        params = tuple(int(i) for i in ids)
+    cursor.execute(sql, params)
+    count = cursor.rowcount
+    conn.commit()
+    cursor.close()
+    conn.close()
+    return count
+
+def get_outbox_stats():
+    """Queue depth by status, lag of the oldest due email and recent throughput."""
+    conn = get_db_connection()
+    if not conn:
+        return None
+    cursor = conn.cursor(dictionary=True)
+    cursor.execute("SELECT status, COUNT(*) AS count FROM outbox GROUP BY status")
+    by_status = {row['status']: row['count'] for row in cursor.fetchall()}
+    cursor.execute("""
+        SELECT COUNT(*) AS due, TIMESTAMPDIFF(SECOND, MIN(next_attempt_at), NOW()) AS lag_seconds
+        FROM outbox WHERE status = 'queued' AND next_attempt_at <= NOW()
+    """)
+    due = cursor.fetchone()
+    cursor.execute("""
+        SELECT SUM(sent_at >= NOW() - INTERVAL 1 MINUTE) AS last_minute,
+               SUM(sent_at >= NOW() - INTERVAL 1 HOUR) AS last_hour,
+               AVG(CASE WHEN sent_at >= NOW() - INTERVAL 1 HOUR THEN TIMESTAMPDIFF(SECOND, created_at, sent_at) END) AS avg_delivery_seconds
+        FROM outbox WHERE status = 'sent' AND sent_at >= NOW() - INTERVAL 1 HOUR
+    """)
+    sent = cursor.fetchone()
+    cursor.execute("SELECT id, to_email, attempts, last_error FROM outbox WHERE status = 'dead' ORDER BY id DESC LIMIT 20")
+    dead = cursor.fetchall()
+    cursor.close()
+    conn.close()
+    return {
+        'by_status': by_status,
+        'due': int(due['due'] or 0),
+        'lag_seconds': int(due['lag_seconds'] or 0),
+        'sent_last_minute': int(sent['last_minute'] or 0),
+        'sent_last_hour': int(sent['last_hour'] or 0),
+        'avg_delivery_seconds': float(sent['avg_delivery_seconds']) if sent['avg_delivery_seconds'] is not None else None,
+        'recent_dead': dead,
+    }
+
+def get_outbox_pending_lead_ids(lead_ids):
+    """Ids among lead_ids that have an email queued or being sent"""
+    lead_ids = list(lead_ids or [])
+    if not lead_ids:
+        return set()
+    conn = get_db_connection()
+    if not conn:
+        return set()
+    cursor = conn.cursor()
+    placeholders = ", ".join(["%s"] * len(lead_ids))
+    cursor.execute(
+        f"SELECT DISTINCT lead_id FROM outbox WHERE status IN ('queued', 'sending') AND lead_id IN ({placeholders})",
+        tuple(lead_ids)
+    )
+    pending = {row[0] for row in cursor.fetchall()}
+    cursor.close()
+    conn.close()
+    return pending
+
+def get_outbox_item(outbox_id):
+    conn = get_db_connection()
+    item = None
+    if conn:
+        cursor = conn.cursor(dictionary=True)
+        cursor.execute(
+            "SELECT id, idempotency_key, lead_id, kind, to_email, subject, status, attempts, provider, "
+            "dry_run, last_error, created_at, sent_at, next_attempt_at FROM outbox WHERE id = %s",
+            (outbox_id,)
+        )
+        item = cursor.fetchone()
+        cursor.close()
+        conn.close()
+    return item
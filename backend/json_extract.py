@@ -0,0 +1,437 @@
+import re
+import json
+
+# Extraction of JSON objects/arrays embedded in LLM output in one left-to-right pass.
+#
+# iter_json_values() decodes at each opening bracket with the C decoder. A
+# failed decode is not cheap on a long text (JSONDecodeError counts the
+# newlines before the error position), so values are decoded from a slice
+# that grows until it holds the value or its error; only values past
+# _WINDOW_MAX are decoded in place. When a value fails, the text before the
+# error is a valid JSON prefix: the complete arrays and objects in it are
+# decoded one by one, descending into the one that holds the error, and
+# scanning resumes at the error, so no bracket is tried twice. (If the error
+# sits in or right after a string, that quote was likely prose, and scanning
+# resumes inside it instead.) Re-decoding along the path to the error is
+# capped at four times the text's length; past it, the rest of the prefix
+# is scanned for balanced spans instead.
+#
+# The streaming extractor can't decode a value before it closes, so it
+# scans: it tracks bracket nesting and JSON string state, records balanced
+# [...] / {...} spans with their nested spans, and decodes only those spans;
+# a span that isn't JSON falls back to its nested spans. A quote that
+# doesn't close on its line (a raw newline in a string, or stray prose
+# quoting) can throw the string state off; when a bracket opened before it
+# never closes, the text after that bracket is scanned once more matching
+# brackets only, ignoring quotes.
+
+_OPENERS = re.compile(r'[\[{]')
+# A complete string is consumed as one token; a lone quote starts an unterminated one
+_TOKEN = re.compile(r'"(?:[^"\\\n]|\\.)*"|[\[\]{}"]')
+_BRACKETS = re.compile(r'[\[\]{}]')
+_STRING_END = re.compile(r'["\\\n]')
+_MATCHING = {']': '[', '}': '{'}
+# What may sit between the children of a JSON array/object: separators and scalars
+_GAP = re.compile(r'(?:\s+|[,:]|"(?:[^"\\\n]|\\.)*"|-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?|true|false|null)*')
+_WHITESPACE = re.compile(r'[ \t\n\r]*')
+# Everything up to the next array/object inside a valid JSON prefix; group 1 is the last string
+_SKIP = re.compile(r'(?:[^"\[{]+|("[^"\\]*(?:\\.[^"\\]*)*"))*')
+# Brackets that can open a JSON value: '[' before a value or ']', '{' before a key or '}'
+_VALUE_OPENERS = re.compile(r'\[(?=[ \t\n\r]*[\]\[{"\-0-9tfnNI])|\{(?=[ \t\n\r]*["}])')
+# First slice decoded for a string or container; grows 8x until it holds the value,
+# and past _WINDOW_MAX the value is decoded in place from the whole text
+_WINDOW = 512
+_WINDOW_MAX = 32768
+# A slice that cuts a number, literal or escape fails this close to its end
+_WINDOW_MARGIN = 16
+
+_decoder = json.JSONDecoder()
+
+
+class _Frame:
+    __slots__ = ('char', 'start', 'children', 'broken', 'checked', 'verified_to', 'verified_inner')
+
+    def __init__(self, char, start):
+        self.char = char
+        self.start = start
+        self.children = []
+        # Streaming only: the bracket can't open a JSON value (e.g. "[1 and {...}"),
+        # so children are emitted as they close instead of waiting for it
+        self.broken = False
+        self.checked = 0
+        self.verified_to = start + 1
+        self.verified_inner = None
+
+
+class SpanScanner:
+    """Incremental bracket/string scanner.
+
+    feed(text, offset) scans a chunk whose first character sits at absolute
+    position `offset` and returns the top-level spans completed in it, each
+    as (start, end, children) in absolute positions. State (open brackets,
+    string/escape state) carries over between chunks. With strings=False
+    quotes are ignored and only brackets are matched.
+    """
+
+    def __init__(self, strings=True):
+        self.token = _TOKEN if strings else _BRACKETS
+        self.stack = []
+        self.in_string = False
+        self.escape = False
+        # Absolute position of the last quote that didn't close on its own line
+        self.lone_quote = None
+
+    def feed(self, text, offset=0, pos=0):
+        """Scan text[pos:]; returns the top-level spans completed in it."""
+        done = []
+        length = len(text)
+        stack = self.stack
+        while pos < length:
+            if self.escape:
+                self.escape = False
+                pos += 1
+                continue
+            if self.in_string:
+                m = _STRING_END.search(text, pos)
+                if not m:
+                    break
+                char = m.group()
+                pos = m.end()
+                if char == '\\':
+                    self.escape = True
+                else:
+                    # A raw newline can't occur inside a JSON string: treat it as
+                    # stray prose quoting rather than swallowing the rest of the text
+                    self.in_string = False
+                continue
+            m = (self.token if stack else _OPENERS).search(text, pos)
+            if not m:
+                break
+            token = m.group()
+            pos = m.end()
+            if token[0] == '"':
+                if len(token) == 1:
+                    self.in_string = True
+                    self.lone_quote = offset + pos - 1
+            elif token in '[{':
+                stack.append(_Frame(token, offset + pos - 1))
+            else:
+                self._close(_MATCHING[token], offset + pos, done)
+        return done
+
+    def _close(self, opener, end, done):
+        stack = self.stack
+        for i in range(len(stack) - 1, -1, -1):
+            if stack[i].char == opener:
+                break
+        else:
+            return  # stray closer
+        # Unclosed frames above the match are malformed; keep their balanced children
+        while len(stack) - 1 > i:
+            orphan = stack.pop()
+            self._attach(orphan.children, done)
+        frame = stack.pop()
+        if frame.broken:
+            # Its text was never kept; its children went out as they closed
+            done.extend(frame.children)
+            return
+        self._attach([(frame.start, end, frame.children)], done)
+
+    def _attach(self, spans, done):
+        stack = self.stack
+        if stack and not stack[-1].broken:
+            stack[-1].children.extend(spans)
+        else:
+            done.extend(spans)
+
+    def finish(self):
+        """Balanced spans left inside brackets that never closed (e.g. a truncated response)."""
+        spans = []
+        for frame in self.stack:
+            spans.extend(frame.children)
+        self.stack = []
+        self.in_string = self.escape = False
+        self.lone_quote = None
+        return spans
+
+
+def _rescan_from(scanner, skip_to=0):
+    """Where scanning must start again once the text ends, or None.
+
+    If a quote that never closed on its line sits inside the outermost
+    bracket still open, everything scanned after that bracket is suspect.
+    Spans already handed out (up to `skip_to`) are not scanned again.
+    """
+    lone = scanner.lone_quote
+    if not scanner.stack or lone is None or lone < scanner.stack[0].start:
+        return None
+    return max(scanner.stack[0].start + 1, skip_to)
+
+
+def _remaining_spans(text, scanner, base=0, skip_to=0):
+    """Spans left once the text ends: finish() unless the string state lost sync.
+
+    A re-scan matches brackets only, once: brackets inside strings may then
+    split or merge spans, but every span is still validated by the decoder.
+    """
+    start = _rescan_from(scanner, skip_to)
+    if start is None:
+        return scanner.finish()
+    scanner.finish()
+    rescan = SpanScanner(strings=False)
+    return rescan.feed(text, base, start - base) + rescan.finish()
+
+
+def _decode_span(text, span, base=0):
+    """Yield (value, start, end) for a span, falling back to its nested spans if it isn't JSON.
+
+    Only the span itself is handed to the decoder, so a failure costs at most
+    the span's length.
+    """
+    stack = [span]
+    while stack:
+        start, end, children = stack.pop()
+        try:
+            value = _decoder.decode(text[start - base:end - base])
+        except (ValueError, RecursionError):
+            stack.extend(reversed(children))
+            continue
+        yield value, start, end
+
+
+def _decode_at(text, pos):
+    """Decode the array or object starting at text[pos].
+
+    Returns (True, value, end), or (False, None, error position); the error
+    position is None when the value nests too deep for the decoder.
+    """
+    # scan_once raises a bare StopIteration(index) where no value can start,
+    # which costs nothing; other errors raise JSONDecodeError
+    try:
+        window = _WINDOW
+        while window <= _WINDOW_MAX:
+            piece = text[pos:pos + window]
+            try:
+                value, end = _decoder.scan_once(piece, 0)
+                return True, value, pos + end
+            except StopIteration as e:
+                error, unterminated = e.value, False
+            except ValueError as e:
+                error, unterminated = e.pos, e.msg.startswith('Unterminated string')
+            if pos + window >= len(text) or (error < len(piece) - _WINDOW_MARGIN and not unterminated):
+                return False, None, pos + error
+            window *= 8
+        value, end = _decoder.scan_once(text, pos)
+        return True, value, end
+    except StopIteration as e:
+        return False, None, e.value
+    except ValueError as e:
+        return False, None, e.pos
+    except RecursionError:
+        return False, None, None
+
+
+def _nested_values(text, start, error, budget):
+    """Yield the complete values inside the value at `start` that fails to decode at `error`.
+
+    text[start:error] is a valid prefix, so everything but arrays and
+    objects can be skipped by pattern; those are decoded in turn, and the
+    one that fails is the one holding the error and is walked the same way.
+    Once re-decoding on that path would pass `budget` characters, the rest
+    of the prefix is scanned for balanced spans instead (its string state is
+    reliable, so they all decode).
+
+    Returns (characters re-decoded, quote): quote is the position of the
+    string the error sits in or right after, which is likely stray prose
+    quoting rather than JSON, else None.
+    """
+    spent = 0
+    container = start
+    while container is not None:
+        pos = container + 1
+        container = quote = None
+        while True:
+            m = _SKIP.match(text, pos, error)
+            pos = m.end()
+            if pos >= error:
+                if m.group(1) and _WHITESPACE.match(text, m.end(1)).end() >= error:
+                    quote = m.start(1)
+                break
+            if text[pos] == '"':
+                # A string still open at the error
+                quote = pos
+                break
+            if spent + error - pos > budget:
+                scanner = SpanScanner()
+                spans = scanner.feed(text[pos:error], pos)
+                for span in spans + scanner.finish():
+                    yield from _decode_span(text, span)
+                return spent, None
+            ok, value, end = _decode_at(text, pos)
+            if not ok:
+                if end is not None:
+                    spent += end - pos
+                    container = pos
+                break
+            yield value, pos, end
+            pos = end
+    return spent, quote
+
+
+def _skip_nested(text, pos):
+    """Position after the brackets opened at `pos` close (or the end of the text).
+
+    Quotes are ignored: this only steps over a value too deep to decode.
+    """
+    depth = 0
+    for m in _BRACKETS.finditer(text, pos):
+        depth += 1 if m.group() in '[{' else -1
+        if depth <= 0:
+            return m.end()
+    return len(text)
+
+
+def iter_json_values(text):
+    """Yield (value, start, end) for each top-level JSON object/array in `text`, in order.
+
+    Values nested in an object/array that doesn't decode (malformed or cut
+    off) are yielded in its place, except inside one nested too deep for the
+    decoder, which is skipped whole.
+    """
+    if not text:
+        return
+    budget = 4 * len(text)
+    pos = 0
+    while True:
+        m = _VALUE_OPENERS.search(text, pos)
+        if not m:
+            return
+        pos = m.start()
+        ok, value, end = _decode_at(text, pos)
+        if ok:
+            yield value, pos, end
+            pos = end
+        elif end is None:
+            pos = _skip_nested(text, pos)
+        else:
+            spent, quote = yield from _nested_values(text, pos, end, budget)
+            budget -= spent
+            # Brackets inside a string that ran into the error may hold the real values
+            pos = quote + 1 if quote is not None else max(end, pos + 1)
+
+
+def first_json_value(text, types=(list, dict)):
+    for value, _, _ in iter_json_values(text):
+        if isinstance(value, types):
+            return value
+    return None
+
+
+class JSONStreamExtractor:
+    """Streaming mode: feed() response chunks as they arrive and get back the JSON
+    values completed so far. Only the text of the value still being received
+    is buffered.
+
+    An open bracket whose contents so far can't be JSON (prose such as
+    "(see [1 and ...") is marked broken: the values completed inside it are
+    returned right away rather than when it closes, which may be never.
+    If the string state is lost inside a bracket that never closes, close()
+    scans the text after it again, skipping what was already returned, so
+    a value that overlaps a span returned from a broken bracket is not
+    recovered.
+    """
+
+    def __init__(self):
+        self.scanner = SpanScanner()
+        self.chunks = []
+        self.base = 0       # absolute position of the first buffered character
+        self.consumed = 0   # absolute position after the last buffered character
+        self.scanned_to = 0  # absolute end of the last span handed out
+
+    def feed(self, chunk):
+        if not chunk:
+            return []
+        offset = self.consumed
+        self.consumed += len(chunk)
+        spans = self.scanner.feed(chunk, offset)
+        self.chunks.append(chunk)
+        stack = self.scanner.stack
+        if spans or self._unchecked():
+            text = ''.join(self.chunks)
+            self.chunks = [text]
+            spans.extend(self._break_frames(text))
+        if spans:
+            self.scanned_to = max(self.scanned_to, max(end for _, end, _ in spans))
+        found = []
+        for span in spans:
+            found.extend(_decode_span(self.chunks[0], span, self.base))
+        # Spans of newly broken frames closed before this chunk's; keep stream order
+        found.sort(key=lambda item: item[1])
+
+        # Keep text from the outermost bracket that may still close into a value,
+        # or from where close() has to scan again after a lost string state
+        keep = next((frame.start for frame in stack if not frame.broken), self.consumed)
+        rescan = _rescan_from(self.scanner, self.scanned_to)
+        if rescan is not None:
+            keep = min(keep, rescan)
+        if keep >= self.consumed:
+            self.chunks = []
+        elif keep > self.base:
+            self.chunks = [''.join(self.chunks)[keep - self.base:]]
+        self.base = keep
+        return [value for value, _, _ in found]
+
+    def _unchecked(self):
+        # Whether an intact open frame has children or an inner frame not yet checked by _break_frames
+        stack = self.scanner.stack
+        for i, frame in enumerate(stack):
+            if frame.broken:
+                continue
+            if len(frame.children) > frame.checked:
+                return True
+            if i + 1 < len(stack) and frame.verified_inner != stack[i + 1].start:
+                return True
+        return False
+
+    def _break_frames(self, text):
+        """Mark open frames whose contents can't be JSON; returns the child spans they held."""
+        stack = self.scanner.stack
+        base = self.base
+        broken = -1
+        for i, frame in enumerate(stack):
+            if frame.broken:
+                continue
+            pos = frame.verified_to
+            ok = True
+            for start, end, _ in frame.children[frame.checked:]:
+                if _GAP.fullmatch(text, pos - base, start - base) is None:
+                    ok = False
+                    break
+                pos = end
+            inner = stack[i + 1].start if i + 1 < len(stack) else None
+            if ok and inner is not None and frame.verified_inner != inner:
+                ok = _GAP.fullmatch(text, pos - base, inner - base) is not None
+            if not ok:
+                broken = i
+                break
+            frame.checked = len(frame.children)
+            frame.verified_to = pos
+            frame.verified_inner = inner
+        spans = []
+        # A broken frame can't decode, so neither can the frames around it
+        for frame in stack[:broken + 1]:
+            if not frame.broken:
+                frame.broken = True
+                spans.extend(frame.children)
+                frame.children = []
+        return spans
+
+    def close(self):
+        """Values nested inside brackets that never closed."""
+        text = ''.join(self.chunks)
+        values = []
+        for span in _remaining_spans(text, self.scanner, self.base, self.scanned_to):
+            values.extend(v for v, _, _ in _decode_span(text, span, self.base))
+        self.chunks = []
+        self.base = self.consumed
+        return values
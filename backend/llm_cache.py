@@ -0,0 +1,146 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+import db
+
+# Set LLM_CACHE_ENABLED=false to bypass the cache globally
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() not in ("0", "false", "no")
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600)))
+# In-memory tier size (entries) and persistent tier size (rows)
+LLM_CACHE_MEMORY_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MEMORY_MAX_ENTRIES", "1000"))
+LLM_CACHE_DB_MAX_ROWS = int(os.getenv("LLM_CACHE_DB_MAX_ROWS", "50000"))
+# Responses sampled above this temperature are too random to reuse
+LLM_CACHE_MAX_TEMPERATURE = float(os.getenv("LLM_CACHE_MAX_TEMPERATURE", "0.5"))
+# Prune the DB tier after this many writes
+LLM_CACHE_PRUNE_EVERY = 200
+
+
+def cache_key(model, prompt, temperature=None):
+    """Fingerprint of everything that determines the response."""
+    temp = '' if temperature is None else f"{float(temperature):.3f}"
+    raw = f"{model}\0{temp}\0{prompt}"
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def is_cacheable(temperature):
+    return temperature is None or float(temperature) <= LLM_CACHE_MAX_TEMPERATURE
+
+
+class LLMResponseCache:
+    """Two-tier (memory LRU -> llm_response_cache table) cache of LLM response text."""
+
+    def __init__(self, ttl=None, max_entries=None, max_rows=None):
+        self.ttl = LLM_CACHE_TTL if ttl is None else ttl
+        self.max_entries = max_entries or LLM_CACHE_MEMORY_MAX_ENTRIES
+        self.max_rows = max_rows or LLM_CACHE_DB_MAX_ROWS
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes = 0
+        self.stats = {'memory_hits': 0, 'db_hits': 0, 'misses': 0, 'stores': 0, 'bypassed': 0, 'errors': 0}
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.stats['memory_hits'] += 1
+                return entry[1]
+            if entry:
+                del self._entries[key]
+
+        try:
+            text = db.get_llm_cache_entry(key)
+        except Exception as e:
+            print(f"[LLM-CACHE] DB lookup failed: {e}")
+            self._count('errors')
+            text = None
+        if text is not None:
+            self._remember(key, text)
+            self._count('db_hits')
+            return text
+        self._count('misses')
+        return None
+
+    def _remember(self, key, text):
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, text)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def put(self, key, model, text):
+        if not text:
+            return
+        self._remember(key, text)
+        with self._lock:
+            self.stats['stores'] += 1
+            self._writes += 1
+            prune = self._writes % LLM_CACHE_PRUNE_EVERY == 0
+        try:
+            db.put_llm_cache_entry(key, model, text, self.ttl)
+            if prune:
+                db.prune_llm_cache(self.max_rows)
+        except Exception as e:
+            print(f"[LLM-CACHE] DB write failed: {e}")
+            self._count('errors')
+
+    def lookup(self, model, prompt, temperature=None, use_cache=True):
+        """Return (key, cached_text). key is None when the call must not be cached."""
+        if not (use_cache and LLM_CACHE_ENABLED and is_cacheable(temperature)):
+            self._count('bypassed')
+            return None, None
+        key = cache_key(model, prompt, temperature)
+        return key, self.get(key)
+
+    def get_or_call(self, model, prompt, call, temperature=None, use_cache=True):
+        """Return the cached text for (model, prompt, temperature) or call() and cache it.
+
+        `call` takes no arguments and returns the response text. Pass
+        use_cache=False to always call the model (the result is not stored).
+        """
+        key, text = self.lookup(model, prompt, temperature, use_cache)
+        if text is not None:
+            return text
+        text = call()
+        if key:
+            self.put(key, model, text)
+        return text
+
+    def replace(self, model, prompt, text, temperature=None):
+        """Overwrite the cached response for a prompt (e.g. with a repaired version)."""
+        if LLM_CACHE_ENABLED and is_cacheable(temperature):
+            self.put(cache_key(model, prompt, temperature), model, text)
+
+    def discard(self, model, prompt, temperature=None):
+        key = cache_key(model, prompt, temperature)
+        with self._lock:
+            self._entries.pop(key, None)
+        try:
+            db.delete_llm_cache_entry(key)
+        except Exception as e:
+            print(f"[LLM-CACHE] DB delete failed: {e}")
+
+    def clear_memory(self):
+        with self._lock:
+            self._entries.clear()
+
+    def metrics(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['memory_entries'] = len(self._entries)
+        lookups = stats['memory_hits'] + stats['db_hits'] + stats['misses']
+        stats['hit_rate'] = round((stats['memory_hits'] + stats['db_hits']) / lookups, 4) if lookups else 0.0
+        stats['ttl_seconds'] = self.ttl
+        stats['enabled'] = LLM_CACHE_ENABLED
+        return stats
+
+
+LLM_CACHE = LLMResponseCache()
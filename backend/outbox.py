@@ -0,0 +1,254 @@
+import os
+import json
+import time
+import uuid
+import random
+import socket
+import threading
+from email.utils import make_msgid
+
+import db
+from ai_executor import TokenBucket
+
+# Sender threads draining the outbox table (0 disables the worker pool)
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "2"))
+# Rows claimed (and logged afterwards) per round trip, and how long a claim is held before another worker may take it over
+OUTBOX_CLAIM_BATCH = int(os.getenv("OUTBOX_CLAIM_BATCH", "50"))
+OUTBOX_LEASE_SECONDS = int(os.getenv("OUTBOX_LEASE_SECONDS", "300"))
+# Idle workers poll this often; enqueue() wakes them immediately
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "5"))
+# Attempts before an email is dead-lettered, and the exponential retry backoff
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+OUTBOX_BACKOFF_BASE = float(os.getenv("OUTBOX_BACKOFF_BASE", "30"))
+OUTBOX_BACKOFF_MAX = float(os.getenv("OUTBOX_BACKOFF_MAX", "3600"))
+# Emails per minute per provider and per sending address
+OUTBOX_BREVO_RATE_PER_MIN = int(os.getenv("OUTBOX_BREVO_RATE_PER_MIN", "300"))
+OUTBOX_SMTP_RATE_PER_MIN = int(os.getenv("OUTBOX_SMTP_RATE_PER_MIN", "30"))
+OUTBOX_SENDER_RATE_PER_MIN = int(os.getenv("OUTBOX_SENDER_RATE_PER_MIN", os.getenv("OUTREACH_SEND_RATE_PER_MIN", "60")))
+# Right-hand side of generated Message-IDs (defaults to the sending address's domain)
+MESSAGE_ID_DOMAIN = os.getenv("MESSAGE_ID_DOMAIN") or (os.getenv("SMTP_EMAIL") or "").partition("@")[2] or "lead-outreach.local"
+
+STATUS_QUEUED = 'queued'
+STATUS_SENT = 'sent'
+STATUS_DEAD = 'dead'
+
+PERMANENT_ERRORS = ('invalid or missing recipient', 'invalid address', 'user unknown', 'mailbox unavailable')
+
+
+def is_permanent_error(error):
+    """Errors retrying can't fix, so the email goes straight to the dead-letter state."""
+    text = (error or '').lower()
+    return any(marker in text for marker in PERMANENT_ERRORS)
+
+
+def backoff_seconds(attempts, base=None, cap=None):
+    """Exponential backoff with full jitter for the given attempt number (1-based)."""
+    base = OUTBOX_BACKOFF_BASE if base is None else base
+    cap = OUTBOX_BACKOFF_MAX if cap is None else cap
+    return random.uniform(base / 2, min(cap, base * 2 ** max(0, attempts - 1)))
+
+
+def _bucket(rate):
+    return TokenBucket(rate, capacity=max(1, rate // 6)) if rate > 0 else None
+
+
+class OutboxWorkerPool:
+    """Background senders for the outbox table.
+
+    Each worker claims a batch of due rows with a lease, hands them to
+    `deliver(rows, throttle)` and records the outcome. `deliver` returns one
+    dict per row with success, error, provider, dry_run and message_id (the
+    Message-ID the provider sent it under, if it differs), and must call
+    `throttle(provider, count)` before handing messages to a provider so the
+    per-provider limits hold across workers. `on_sent(pairs)` receives the
+    (row, outcome) pairs of a batch once they are marked sent, so logging and
+    lead status updates can be written in bulk.
+
+    Failed rows are retried with exponential backoff until max_attempts,
+    then dead-lettered. A worker that dies mid-send leaves its rows in
+    'sending'; they are claimed again once the lease expires. While a worker
+    waits on the rate limits its lease is renewed, so a slow batch isn't
+    taken over and sent twice.
+    """
+
+    def __init__(self, deliver, on_sent=None, workers=None, claim_batch=None, lease_seconds=None,
+                 poll_interval=None, provider_rates=None, sender_rate=None):
+        self.deliver = deliver
+        self.on_sent = on_sent
+        self.workers = OUTBOX_WORKERS if workers is None else workers
+        self.claim_batch = claim_batch or OUTBOX_CLAIM_BATCH
+        self.lease_seconds = lease_seconds or OUTBOX_LEASE_SECONDS
+        self.poll_interval = OUTBOX_POLL_INTERVAL if poll_interval is None else poll_interval
+        rates = provider_rates or {'brevo': OUTBOX_BREVO_RATE_PER_MIN, 'smtp': OUTBOX_SMTP_RATE_PER_MIN}
+        self.provider_buckets = {name: _bucket(rate) for name, rate in rates.items()}
+        self.sender_rate = OUTBOX_SENDER_RATE_PER_MIN if sender_rate is None else sender_rate
+        self.sender_buckets = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.threads = []
+        self.host = socket.gethostname()
+        self.counters = {'claimed': 0, 'sent': 0, 'dry_runs': 0, 'retried': 0, 'dead': 0,
+                         'lost_claims': 0, 'lease_renewals': 0, 'errors': 0}
+
+    def _count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def throttle(self, provider, count=1, lease=None):
+        """Block until `provider` may take `count` more emails, renewing `lease` while waiting."""
+        bucket = self.provider_buckets.get(provider)
+        for _ in range(count if bucket else 0):
+            bucket.acquire()
+            self._keep_lease(lease)
+
+    def _throttle_sender(self, sender, count, lease=None):
+        if self.sender_rate <= 0:
+            return
+        with self.lock:
+            bucket = self.sender_buckets.get(sender)
+            if bucket is None:
+                bucket = self.sender_buckets[sender] = _bucket(self.sender_rate)
+        for _ in range(count):
+            bucket.acquire()
+            self._keep_lease(lease)
+
+    def _keep_lease(self, lease):
+        """Extend a claim's lease once a third of it has passed."""
+        if lease is None:
+            return
+        now = time.monotonic()
+        if now - lease['renewed_at'] < self.lease_seconds / 3:
+            return
+        lease['renewed_at'] = now
+        try:
+            if not db.extend_outbox_lease(lease['token'], self.lease_seconds):
+                print(f"[OUTBOX] Lease {lease['token']} was already taken over")
+            self._count('lease_renewals')
+        except Exception as e:
+            print(f"[OUTBOX] Could not renew lease {lease['token']}: {e}")
+
+    def wake(self):
+        self.wakeup.set()
+
+    def start(self):
+        if self.threads or self.workers <= 0:
+            return
+        for n in range(self.workers):
+            worker_id = f"{self.host}-{os.getpid()}-{n + 1}"
+            thread = threading.Thread(target=self._loop, args=(worker_id,), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        print(f"[OUTBOX] {self.workers} sender worker(s) started")
+
+    def _loop(self, worker_id):
+        while True:
+            try:
+                processed = self.run_once(worker_id)
+            except Exception as e:
+                self._count('errors')
+                print(f"[OUTBOX] worker {worker_id} error: {e}")
+                processed = 0
+            if not processed:
+                self.wakeup.wait(self.poll_interval)
+                self.wakeup.clear()
+
+    def run_once(self, worker_id):
+        """Claim and send one batch; returns the number of rows processed."""
+        token = uuid.uuid4().hex
+        rows = db.claim_outbox(worker_id, token, self.claim_batch, self.lease_seconds)
+        if not rows:
+            return 0
+        self._count('claimed', len(rows))
+        lease = {'token': token, 'renewed_at': time.monotonic()}
+
+        def throttle(provider, count=1):
+            self.throttle(provider, count, lease)
+
+        by_sender = {}
+        for row in rows:
+            by_sender.setdefault(row.get('sender') or '', []).append(row)
+        for sender, group in by_sender.items():
+            self._throttle_sender(sender, len(group), lease)
+            try:
+                outcomes = self.deliver(group, throttle)
+            except Exception as e:
+                outcomes = [{'success': False, 'error': str(e)} for _ in group]
+            self._complete(token, group, outcomes)
+        return len(rows)
+
+    def _complete(self, token, rows, outcomes):
+        updates = []
+        for row, outcome in zip(rows, outcomes):
+            if outcome.get('success'):
+                updates.append({'id': row['id'], 'claim_token': token, 'status': STATUS_SENT,
+                                'provider': outcome.get('provider'), 'dry_run': outcome.get('dry_run'),
+                                'message_id': outcome.get('message_id')})
+                continue
+            error = outcome.get('error') or 'Unknown send failure'
+            if is_permanent_error(error) or row['attempts'] >= (row.get('max_attempts') or OUTBOX_MAX_ATTEMPTS):
+                updates.append({'id': row['id'], 'claim_token': token, 'status': STATUS_DEAD, 'error': error})
+                print(f"[OUTBOX] Dead-lettered #{row['id']} to {row.get('to_email')} after {row['attempts']} attempt(s): {error}")
+            else:
+                updates.append({'id': row['id'], 'claim_token': token, 'status': STATUS_QUEUED, 'error': error,
+                                'retry_in': backoff_seconds(row['attempts'])})
+
+        updated = db.complete_outbox(updates)
+        if updated < len(updates):
+            # Lease expired and another worker re-claimed some rows; its outcome wins
+            self._count('lost_claims', len(updates) - updated)
+
+        sent = []
+        for row, outcome, update in zip(rows, outcomes, updates):
+            if update['status'] == STATUS_SENT:
+                self._count('sent')
+                if outcome.get('dry_run'):
+                    self._count('dry_runs')
+                sent.append((row, outcome))
+            elif update['status'] == STATUS_DEAD:
+                self._count('dead')
+            else:
+                self._count('retried')
+        if sent and self.on_sent:
+            try:
+                self.on_sent(sent)
+            except Exception as e:
+                print(f"[OUTBOX] after-send hook failed for {len(sent)} email(s): {e}")
+
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+        return {
+            'workers': len(self.threads),
+            'claim_batch': self.claim_batch,
+            'lease_seconds': self.lease_seconds,
+            'provider_tokens': {name: round(bucket.available(), 2) for name, bucket in self.provider_buckets.items() if bucket},
+            'sender_rate_per_min': self.sender_rate,
+            **counters,
+        }
+
+
+def make_message_id():
+    # make_msgid's default domain is a getfqdn() lookup on every call
+    return make_msgid(domain=MESSAGE_ID_DOMAIN)
+
+
+def outbox_item(to_email, subject, body, idempotency_key=None, lead_id=None, to_name=None, sender=None,
+                kind='outreach', after_send=None, max_attempts=None, html_body=None, message_id=None):
+    """Row for db.enqueue_outbox; a random key is used when the caller has none.
+
+    The Message-ID is fixed here so every retry goes out with the same one.
+    """
+    return {
+        'idempotency_key': (idempotency_key or f"auto:{uuid.uuid4().hex}")[:191],
+        'lead_id': lead_id,
+        'kind': kind,
+        'to_email': to_email,
+        'to_name': to_name,
+        'sender': sender,
+        'subject': subject,
+        'body': body,
+        'html_body': html_body,
+        'message_id': message_id or make_message_id(),
+        'after_send': json.dumps(after_send) if after_send is not None else None,
+        'max_attempts': max_attempts or OUTBOX_MAX_ATTEMPTS,
+    }
@@ -0,0 +1,110 @@
+import os
+import numpy as np
+import pandas as pd
+
+# First-stage, rule-based lead scoring. Leads whose rule score is clearly high
+# or clearly low are decided here; only the band in between goes to the LLM.
+PRESCORE_ENABLED = os.getenv("PRESCORE_ENABLED", "true").lower() not in ("0", "false", "no")
+PRESCORE_ACCEPT_THRESHOLD = int(os.getenv("PRESCORE_ACCEPT_THRESHOLD", "85"))
+PRESCORE_REJECT_THRESHOLD = int(os.getenv("PRESCORE_REJECT_THRESHOLD", "35"))
+
+# Same signals as the offline (no API key) analysis in agent_analyze_business
+BASE_SCORE = 50
+TECH_KEYWORDS = r'tech|software'
+LEGAL_SUFFIXES = r'\bltd\b|\binc\b|limited|pvt|llp'
+METRO_LOCATIONS = r'chennai|bangalore|bengaluru'
+TECH_POINTS = 20
+LEGAL_POINTS = 10
+METRO_POINTS = 15
+# Contact completeness
+PHONE_POINTS = 5
+WEBSITE_POINTS = 5
+NO_EMAIL_PENALTY = 25
+
+STAGE_RULES = 'rules'
+STAGE_LLM = 'llm'
+
+DECISION_ACCEPT = 'accept'
+DECISION_REJECT = 'reject'
+DECISION_UNCERTAIN = 'uncertain'
+
+
+def _text(df, column):
+    if column not in df:
+        return pd.Series('', index=df.index)
+    return df[column].fillna('').astype(str).str.lower()
+
+
+def _present(df, column):
+    if column not in df:
+        return pd.Series(False, index=df.index)
+    return df[column].fillna('').astype(str).str.strip() != ''
+
+
+def compute_features(leads):
+    """Rule features and scores for all leads at once. Returns a DataFrame indexed like `leads`."""
+    df = pd.DataFrame(list(leads))
+    if df.empty:
+        return pd.DataFrame(columns=['id', 'rule_score', 'business_maturity', 'growth_potential', 'decision'])
+
+    company = _text(df, 'company')
+    location = _text(df, 'location')
+    out = pd.DataFrame(index=df.index)
+    out['id'] = df['id'] if 'id' in df else None
+    out['tech'] = company.str.contains(TECH_KEYWORDS, regex=True)
+    out['legal'] = company.str.contains(LEGAL_SUFFIXES, regex=True)
+    out['metro'] = location.str.contains(METRO_LOCATIONS, regex=True)
+    out['has_email'] = _present(df, 'email')
+    out['has_phone'] = _present(df, 'phone')
+    out['has_website'] = _present(df, 'website')
+
+    score = (
+        BASE_SCORE
+        + out['tech'] * TECH_POINTS
+        + out['legal'] * LEGAL_POINTS
+        + out['metro'] * METRO_POINTS
+        + out['has_phone'] * PHONE_POINTS
+        + out['has_website'] * WEBSITE_POINTS
+        - (~out['has_email']) * NO_EMAIL_PENALTY
+    )
+    out['rule_score'] = score.clip(0, 100).astype(int)
+    out['business_maturity'] = np.select(
+        [out['rule_score'] > 80, out['rule_score'] > 60], ['Enterprise', 'SMB'], default='Startup')
+    out['growth_potential'] = np.select(
+        [out['rule_score'] > 80, out['rule_score'] > 60], ['High', 'Medium'], default='Low')
+    return out
+
+
+def prescore_leads(leads, accept_threshold=None, reject_threshold=None):
+    """Split leads into rule-decided analyses and leads that need the LLM.
+
+    Returns (decided, uncertain, counts): `decided` maps lead id -> analysis
+    dict (with 'decided_by': 'rules'), `uncertain` is the list of leads to
+    send to the LLM stage, and `counts` tallies accept/reject/uncertain.
+    """
+    leads = list(leads or [])
+    accept = PRESCORE_ACCEPT_THRESHOLD if accept_threshold is None else accept_threshold
+    reject = PRESCORE_REJECT_THRESHOLD if reject_threshold is None else reject_threshold
+    counts = {DECISION_ACCEPT: 0, DECISION_REJECT: 0, DECISION_UNCERTAIN: 0}
+    if not leads:
+        return {}, [], counts
+
+    features = compute_features(leads)
+    features['decision'] = np.select(
+        [features['rule_score'] >= accept, features['rule_score'] <= reject],
+        [DECISION_ACCEPT, DECISION_REJECT], default=DECISION_UNCERTAIN)
+
+    decided, uncertain = {}, []
+    for lead, row in zip(leads, features.itertuples(index=False)):
+        counts[row.decision] += 1
+        if row.decision == DECISION_UNCERTAIN:
+            uncertain.append(lead)
+            continue
+        decided[lead['id']] = {
+            'trust_score': int(row.rule_score),
+            'business_maturity': row.business_maturity,
+            'growth_potential': row.growth_potential,
+            'reasoning': f"Rule-based pre-score {row.rule_score} ({row.decision}; thresholds {reject}/{accept})",
+            'decided_by': STAGE_RULES,
+        }
+    return decided, uncertain, counts
@@ -0,0 +1,185 @@
+import os
+import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import db
+
+# A template is dropped after this many consecutive runs without a single new lead
+QUERY_TEMPLATE_MAX_ZERO_RUNS = int(os.getenv("QUERY_TEMPLATE_MAX_ZERO_RUNS", "5"))
+# A dropped template is run again once it has sat idle this long, so a bad week doesn't drop it for good
+QUERY_TEMPLATE_REPROBE_HOURS = float(os.getenv("QUERY_TEMPLATE_REPROBE_HOURS", "72"))
+# Number of search queries issued concurrently per targeted search
+QUERY_PLANNER_CONCURRENCY = int(os.getenv("QUERY_PLANNER_CONCURRENCY", "4"))
+# Smoothing prior so templates without history are still tried early
+QUERY_PRIOR_RUNS = 2
+QUERY_PRIOR_LEADS = 2
+
+
+def template_key(offering, template):
+    return hashlib.sha1(f"{offering}\n{template}".encode('utf-8')).hexdigest()
+
+
+def expected_yield(stats):
+    """Smoothed leads-per-run estimate for a template's stats row (or None)."""
+    stats = stats or {}
+    runs = stats.get('runs') or 0
+    leads = stats.get('leads') or 0
+    return (leads + QUERY_PRIOR_LEADS) / float(runs + QUERY_PRIOR_RUNS)
+
+
+def average_latency_ms(stats):
+    stats = stats or {}
+    runs = stats.get('runs') or 0
+    return (stats.get('total_latency_ms') or 0) / runs if runs else None
+
+
+def is_dropped(stats, max_zero_runs=None, reprobe_seconds=None):
+    """True while a template sits out: too many zero-lead runs in a row, and
+    not yet idle (stats['idle_seconds']) long enough to be probed again."""
+    stats = stats or {}
+    max_zero_runs = QUERY_TEMPLATE_MAX_ZERO_RUNS if max_zero_runs is None else max_zero_runs
+    reprobe_seconds = QUERY_TEMPLATE_REPROBE_HOURS * 3600 if reprobe_seconds is None else reprobe_seconds
+    if (stats.get('zero_streak') or 0) < max_zero_runs:
+        return False
+    idle = stats.get('idle_seconds')
+    return idle is not None and idle < reprobe_seconds
+
+
+class QueryPlanner:
+    """Orders, runs and learns from the search query templates of one offering.
+
+    `templates` are format strings using {niche}, {location} and {negatives}.
+    Statistics (leads, duplicates, latency) are read from and written back to
+    the query_template_stats table so ordering improves across runs.
+    """
+
+    def __init__(self, offering, templates, max_workers=None, max_zero_runs=None, reprobe_hours=None):
+        self.offering = offering
+        self.templates = list(templates)
+        self.max_workers = max_workers or QUERY_PLANNER_CONCURRENCY
+        self.max_zero_runs = QUERY_TEMPLATE_MAX_ZERO_RUNS if max_zero_runs is None else max_zero_runs
+        self.reprobe_seconds = 3600 * (QUERY_TEMPLATE_REPROBE_HOURS if reprobe_hours is None else reprobe_hours)
+        self.keys = {t: template_key(offering, t) for t in self.templates}
+        self.stats = {}
+
+    def load_stats(self):
+        try:
+            self.stats = db.get_query_template_stats(list(self.keys.values()))
+        except Exception as e:
+            print(f"[PLANNER] Could not load query stats: {e}")
+            self.stats = {}
+        return self.stats
+
+    def plan(self):
+        """Return templates in descending order of historical yield, minus dropped ones.
+
+        A template is dropped once it has gone `max_zero_runs` consecutive runs
+        without a new lead, until it has been idle for the re-probe interval;
+        the probe run then either resets its streak or drops it again. The
+        best template is always kept so a search never ends up with an empty plan.
+        """
+        ranked = sorted(
+            self.templates,
+            key=lambda t: (-expected_yield(self.stats.get(self.keys[t])),
+                           average_latency_ms(self.stats.get(self.keys[t])) or 0)
+        )
+        active = [
+            t for t in ranked
+            if not is_dropped(self.stats.get(self.keys[t]), self.max_zero_runs, self.reprobe_seconds)
+        ]
+        dropped = [t for t in ranked if t not in active]
+        if dropped:
+            print(f"[PLANNER] Dropping {len(dropped)} zero-yield template(s) for '{self.offering}'")
+        return active or ranked[:1]
+
+    def run(self, search_fn, handle_results, target=None, **fmt):
+        """Run the planned queries concurrently and stop once `target` leads are found.
+
+        search_fn(query) -> list of search results (runs in worker threads).
+        handle_results(results) -> (new_leads, duplicates) and runs on the
+        calling thread, so the caller's lead list needs no locking.
+        Returns the number of new leads found.
+        """
+        total = 0
+        for step in self.iter_run(search_fn, handle_results, target=target, **fmt):
+            total = step['total_leads']
+        return total
+
+    def iter_run(self, search_fn, handle_results, target=None, **fmt):
+        """Generator form of run(): yields a summary dict after each query completes.
+
+        Closing the generator early cancels the queries that have not started
+        yet; statistics for the completed queries are still recorded. A query
+        whose search raised is reported with an error and left out of the
+        statistics, so an outage can't count against its template.
+        """
+        plan = self.plan()
+        runs = []
+        total = 0
+        completed = 0
+
+        pool = ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(plan))))
+        futures = {}
+        try:
+            for template in plan:
+                query = template.format(**fmt)
+                futures[pool.submit(self._timed_search, search_fn, query)] = (template, query)
+
+            for future in as_completed(futures):
+                template, query = futures[future]
+                try:
+                    results, latency_ms = future.result()
+                except Exception as e:
+                    print(f"[PLANNER] Query failed: {e}")
+                    completed += 1
+                    yield {
+                        'query': query,
+                        'error': str(e),
+                        'completed_queries': completed,
+                        'planned_queries': len(plan),
+                        'total_leads': total,
+                    }
+                    continue
+                new_leads, duplicates = handle_results(results)
+                total += new_leads
+                completed += 1
+                runs.append({
+                    'template_key': self.keys[template],
+                    'offering': self.offering,
+                    'template': template,
+                    'results': len(results),
+                    'leads': new_leads,
+                    'duplicates': duplicates,
+                    'latency_ms': latency_ms,
+                })
+                yield {
+                    'query': query,
+                    'results': len(results),
+                    'new_leads': new_leads,
+                    'duplicates': duplicates,
+                    'latency_ms': round(latency_ms),
+                    'completed_queries': completed,
+                    'planned_queries': len(plan),
+                    'total_leads': total,
+                }
+                if target and total >= target:
+                    cancelled = sum(1 for f in futures if f.cancel())
+                    print(f"[PLANNER] Reached {total}/{target} leads; cancelled {cancelled} pending quer(ies)")
+                    break
+        finally:
+            # Cancel by hand rather than shutdown(cancel_futures=True), which needs Python 3.9
+            for future in futures:
+                future.cancel()
+            pool.shutdown(wait=False)
+            try:
+                db.record_query_template_runs(runs)
+            except Exception as e:
+                print(f"[PLANNER] Could not record query stats: {e}")
+
+    @staticmethod
+    def _timed_search(search_fn, query):
+        print(f"   Running query: {query}")
+        start = time.perf_counter()
+        results = search_fn(query) or []
+        return results, (time.perf_counter() - start) * 1000
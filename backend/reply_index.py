@@ -0,0 +1,150 @@
+import os
+import time
+import threading
+
+import db
+
+# Rows loaded per query while filling the index
+REPLY_INDEX_PAGE_SIZE = int(os.getenv("REPLY_INDEX_PAGE_SIZE", "5000"))
+# Matching pulls new leads and sent Message-IDs at most this often; everything is reloaded every rebuild interval
+REPLY_INDEX_REFRESH_SECONDS = float(os.getenv("REPLY_INDEX_REFRESH_SECONDS", "30"))
+REPLY_INDEX_REBUILD_SECONDS = float(os.getenv("REPLY_INDEX_REBUILD_SECONDS", "3600"))
+# Sent Message-IDs older than this are not kept for threading
+REPLY_INDEX_MESSAGE_DAYS = int(os.getenv("REPLY_INDEX_MESSAGE_DAYS", "120"))
+
+
+def normalize_email(address):
+    """Lowercased address with any +tag dropped from the local part."""
+    address = (address or '').strip().lower()
+    local, at, domain = address.partition('@')
+    if not at:
+        return address
+    return f"{local.split('+', 1)[0]}@{domain}"
+
+
+def normalize_message_id(value):
+    return (value or '').strip().strip('<>').strip().lower()
+
+
+class ReplyIndex:
+    """In-memory map of normalized email and sent Message-ID to lead id.
+
+    match() threads a reply through In-Reply-To, then References (newest
+    first), then falls back to the sender, so replies from another address
+    still find their lead. Lookups are dict hits; the index is topped up
+    from the leads and outbox tables by id watermark (lead emails are never
+    edited after insert) and rebuilt periodically, which also prunes old
+    Message-IDs. Sends made by this process also call add_message().
+    """
+
+    def __init__(self, refresh_seconds=None, rebuild_seconds=None, message_days=None, page_size=None):
+        self.refresh_seconds = REPLY_INDEX_REFRESH_SECONDS if refresh_seconds is None else refresh_seconds
+        self.rebuild_seconds = REPLY_INDEX_REBUILD_SECONDS if rebuild_seconds is None else rebuild_seconds
+        self.message_days = message_days or REPLY_INDEX_MESSAGE_DAYS
+        self.page_size = page_size or REPLY_INDEX_PAGE_SIZE
+        self.by_email = {}
+        self.by_message_id = {}
+        self.last_lead_id = 0
+        self.last_outbox_id = 0
+        self.refreshed_at = 0
+        self.rebuilt_at = 0
+        self.lock = threading.Lock()
+        self.stats = {'rebuilds': 0, 'refreshes': 0, 'matched_thread': 0, 'matched_sender': 0, 'unmatched': 0,
+                      'automated': 0}
+
+    def add_message(self, lead_id, message_id):
+        key = normalize_message_id(message_id)
+        if key and lead_id:
+            with self.lock:
+                self.by_message_id[key] = lead_id
+
+    def _load(self, by_email, by_message_id, last_lead_id, last_outbox_id):
+        while True:
+            rows = db.get_lead_emails_since(last_lead_id, self.page_size)
+            for lead_id, email in rows:
+                key = normalize_email(email)
+                if key:
+                    by_email.setdefault(key, lead_id)
+            if rows:
+                last_lead_id = rows[-1][0]
+            if len(rows) < self.page_size:
+                break
+        while True:
+            rows = db.get_sent_message_ids_since(last_outbox_id, self.message_days, self.page_size)
+            for outbox_id, lead_id, message_id in rows:
+                key = normalize_message_id(message_id)
+                if key:
+                    by_message_id[key] = lead_id
+            if rows:
+                last_outbox_id = rows[-1][0]
+            if len(rows) < self.page_size:
+                break
+        return last_lead_id, last_outbox_id
+
+    def rebuild(self):
+        by_email, by_message_id = {}, {}
+        last_lead_id, last_outbox_id = self._load(by_email, by_message_id, 0, 0)
+        with self.lock:
+            # Rows written during the load sit above the watermarks and come in with the next refresh
+            self.by_email, self.by_message_id = by_email, by_message_id
+            self.last_lead_id, self.last_outbox_id = last_lead_id, last_outbox_id
+            self.rebuilt_at = self.refreshed_at = time.monotonic()
+            self.stats['rebuilds'] += 1
+
+    def refresh(self):
+        """Load leads and sent Message-IDs added since the last refresh."""
+        with self.lock:
+            by_email, by_message_id = {}, {}
+            last_lead_id, last_outbox_id = self.last_lead_id, self.last_outbox_id
+        last_lead_id, last_outbox_id = self._load(by_email, by_message_id, last_lead_id, last_outbox_id)
+        with self.lock:
+            for key, lead_id in by_email.items():
+                self.by_email.setdefault(key, lead_id)
+            self.by_message_id.update(by_message_id)
+            self.last_lead_id = max(self.last_lead_id, last_lead_id)
+            self.last_outbox_id = max(self.last_outbox_id, last_outbox_id)
+            self.refreshed_at = time.monotonic()
+            self.stats['refreshes'] += 1
+
+    def ensure_fresh(self):
+        now = time.monotonic()
+        if not self.rebuilt_at or now - self.rebuilt_at >= self.rebuild_seconds:
+            self.rebuild()
+        elif now - self.refreshed_at >= self.refresh_seconds:
+            self.refresh()
+
+    def match(self, message):
+        """Lead id for a message dict (in_reply_to, references, sender), or None.
+
+        Bounces and auto-replies (message['automated']) thread to our
+        Message-IDs too but are not replies, so they never match.
+        """
+        if message.get('automated'):
+            with self.lock:
+                self.stats['automated'] += 1
+            return None
+        candidates = [message.get('in_reply_to')] + list(reversed(message.get('references') or []))
+        with self.lock:
+            for value in candidates:
+                lead_id = self.by_message_id.get(normalize_message_id(value))
+                if lead_id:
+                    self.stats['matched_thread'] += 1
+                    return lead_id
+            lead_id = self.by_email.get(normalize_email(message.get('sender')))
+            self.stats['matched_sender' if lead_id else 'unmatched'] += 1
+            return lead_id
+
+    def match_many(self, messages):
+        """{uid: lead_id} for the messages that belong to a lead."""
+        self.ensure_fresh()
+        matches = {}
+        for message in messages:
+            lead_id = self.match(message)
+            if lead_id:
+                matches[message['uid']] = lead_id
+        return matches
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats, emails=len(self.by_email), message_ids=len(self.by_message_id),
+                        last_lead_id=self.last_lead_id, last_outbox_id=self.last_outbox_id)
@@ -0,0 +1,439 @@
+import os
+import re
+import ssl
+import html
+import time
+import quopri
+import base64
+import select
+import imaplib
+import itertools
+from email.parser import BytesHeaderParser
+from email.utils import parseaddr
+from email.header import decode_header, make_header
+
+# Seconds to stay in IDLE before re-issuing it (servers drop IDLE after ~30 minutes)
+IMAP_IDLE_SECONDS = int(os.getenv("IMAP_IDLE_SECONDS", "600"))
+# UIDs per header FETCH
+IMAP_FETCH_BATCH = int(os.getenv("IMAP_FETCH_BATCH", "200"))
+IMAP_TIMEOUT = float(os.getenv("IMAP_TIMEOUT", "60"))
+# Wait before reconnecting after a dropped connection (doubles up to 5 minutes)
+IMAP_RECONNECT_DELAY = float(os.getenv("IMAP_RECONNECT_DELAY", "5"))
+# Largest text part downloaded for a matched reply
+IMAP_MAX_BODY_BYTES = int(os.getenv("IMAP_MAX_BODY_BYTES", "262144"))
+
+HEADER_FIELDS = 'FROM SUBJECT MESSAGE-ID IN-REPLY-TO REFERENCES AUTO-SUBMITTED CONTENT-TYPE'
+# Senders of delivery status notifications
+SYSTEM_SENDERS = ('mailer-daemon', 'postmaster')
+UID_RE = re.compile(rb'UID (\d+)')
+
+
+def decode_mime_header(value):
+    try:
+        return str(make_header(decode_header(value or '')))
+    except Exception:
+        return value or ''
+
+
+def is_automated(headers, sender):
+    """Bounces (DSNs), auto-responders and other machine-sent mail (RFC 3834 / RFC 3464)."""
+    if sender.partition('@')[0] in SYSTEM_SENDERS:
+        return True
+    auto = (headers.get('Auto-Submitted') or '').strip().lower()
+    if auto.startswith('auto-'):
+        return True
+    content_type = (headers.get('Content-Type') or '').lower()
+    return content_type.startswith('multipart/report')
+
+
+def _tokenize(data):
+    """Tokens of an IMAP response: '(' / ')' / bytes (strings, atoms, literals) / None for NIL."""
+    i, n = 0, len(data)
+    while i < n:
+        c = data[i:i + 1]
+        if c in b' \r\n':
+            i += 1
+        elif c in b'()':
+            yield c.decode()
+            i += 1
+        elif c == b'"':
+            j, out = i + 1, bytearray()
+            while j < n and data[j:j + 1] != b'"':
+                if data[j:j + 1] == b'\\':
+                    j += 1
+                out += data[j:j + 1]
+                j += 1
+            yield bytes(out)
+            i = j + 1
+        elif c == b'{':
+            j = data.index(b'}', i)
+            size = int(data[i + 1:j])
+            j += 1
+            if data[j:j + 2] == b'\r\n':
+                j += 2
+            yield data[j:j + size]
+            i = j + size
+        else:
+            j = i
+            while j < n and data[j:j + 1] not in b' ()\r\n':
+                j += 1
+            atom = data[i:j]
+            yield None if atom.upper() == b'NIL' else atom
+            i = j
+
+
+def parse_sexp(data):
+    """Parse a parenthesised IMAP response into nested lists."""
+    stack = [[]]
+    for token in _tokenize(data):
+        if token == '(':
+            stack.append([])
+        elif token == ')':
+            if len(stack) > 1:
+                done = stack.pop()
+                stack[-1].append(done)
+        else:
+            stack[-1].append(token)
+    return stack[0]
+
+
+def _text(value):
+    return value.decode('utf-8', 'replace').lower() if isinstance(value, bytes) else ''
+
+
+def _params(value):
+    if not isinstance(value, list):
+        return {}
+    return {_text(value[i]): _text(value[i + 1]) for i in range(0, len(value) - 1, 2)}
+
+
+def find_text_part(structure, prefix=''):
+    """Best text part of a BODYSTRUCTURE: (part number, subtype, charset, encoding) or None.
+
+    text/plain wins over text/html; parts with an attachment disposition
+    are skipped.
+    """
+    if not structure:
+        return None
+    if isinstance(structure[0], list):
+        # Child parts come first, then the subtype and its extension data
+        children = list(itertools.takewhile(lambda part: isinstance(part, list), structure))
+        found = [find_text_part(child, f"{prefix}{i}.") for i, child in enumerate(children, 1)]
+        found = [f for f in found if f]
+        plain = [f for f in found if f[1] == 'plain']
+        return (plain or found or [None])[0]
+    if _text(structure[0]) != 'text' or _text(structure[1]) not in ('plain', 'html'):
+        return None
+    # text/* fields: type subtype params id desc encoding size lines [md5 disposition ...]
+    disposition = structure[9] if len(structure) > 9 else None
+    if isinstance(disposition, list) and disposition and _text(disposition[0]) == 'attachment':
+        return None
+    number = prefix.rstrip('.') or '1'
+    return number, _text(structure[1]), _params(structure[2]).get('charset') or 'utf-8', _text(structure[5])
+
+
+def decode_part(payload, charset, encoding):
+    if encoding == 'base64':
+        try:
+            payload = base64.b64decode(payload, validate=False)
+        except Exception:
+            pass
+    elif encoding == 'quoted-printable':
+        payload = quopri.decodestring(payload)
+    try:
+        return payload.decode(charset or 'utf-8', errors='ignore')
+    except LookupError:
+        return payload.decode('utf-8', errors='ignore')
+
+
+def html_to_text(markup):
+    text = re.sub(r'(?is)<(script|style).*?</\1>', '', markup)
+    text = re.sub(r'(?i)<br\s*/?>|</p>|</div>', '\n', text)
+    return html.unescape(re.sub(r'<[^>]+>', '', text)).strip()
+
+
+def connect_imap_ssl(host):
+    # imaplib's timeout argument needs Python 3.9; set it on the socket instead
+    conn = imaplib.IMAP4_SSL(host)
+    conn.sock.settimeout(IMAP_TIMEOUT)
+    return conn
+
+
+class IMAPReplyMonitor:
+    """Persistent IMAP connection that reports replies from known leads.
+
+    Mail is tracked by UID: each sync fetches only UIDs above the stored
+    watermark (reset when the mailbox's UIDVALIDITY changes), batch-fetches
+    a few headers with BODY.PEEK and downloads the text part only for
+    messages that `match` assigns to a lead. Only those replies are flagged
+    \\Seen (with mark_seen); other mail is left unread. Between syncs it
+    waits in IDLE, or polls with NOOP when the server lacks IDLE.
+
+    match(messages) -> {uid: lead_id} gets the header dicts of one FETCH
+    batch (uid, sender, subject, message_id, in_reply_to, references and
+    automated, set for bounces and auto-replies);
+    on_replies(pairs) then receives that batch's (lead_id, message) pairs,
+    with the message body filled in, and raises if they could not be recorded.
+    load_state() / save_state(value) persist the "uidvalidity:uid" watermark.
+    """
+
+    def __init__(self, host, username, password, match, on_replies, load_state, save_state,
+                 poll_interval=300, mailbox='INBOX', idle_seconds=None, mark_seen=True, connect=None):
+        self.host = host
+        self.username = username
+        self.password = password
+        self.match = match
+        self.on_replies = on_replies
+        self.load_state = load_state
+        self.save_state = save_state
+        self.poll_interval = poll_interval
+        self.mailbox = mailbox
+        self.idle_seconds = idle_seconds or IMAP_IDLE_SECONDS
+        self.mark_seen = mark_seen
+        self.connect = connect or connect_imap_ssl
+        self.conn = None
+        self.uidvalidity = None
+        self.last_uid = 0
+        self._tags = itertools.count(1)
+        self.status = {'connected': False, 'mode': None, 'last_sync': None, 'last_error': None,
+                       'last_processed': None, 'syncs': 0, 'fetched_headers': 0, 'matched': 0,
+                       'idle_wakeups': 0, 'reconnects': 0, 'last_uid': 0}
+
+    # -- connection ---------------------------------------------------------
+
+    def open(self):
+        conn = self.connect(self.host)
+        conn.login(self.username, self.password)
+        typ, _ = conn.select(self.mailbox)
+        if typ != 'OK':
+            raise imaplib.IMAP4.error(f"Cannot select {self.mailbox}")
+        self.conn = conn
+        uidvalidity = int(self._untagged('UIDVALIDITY') or 0)
+        uidnext = int(self._untagged('UIDNEXT') or 0)
+        saved_validity, saved_uid = self._saved_state()
+        if saved_validity == uidvalidity and saved_uid:
+            self.last_uid = saved_uid
+        else:
+            # First run or the mailbox was rebuilt: pick up what is unread now, then follow new mail
+            self.uidvalidity = uidvalidity
+            self.last_uid = max(0, uidnext - 1) if uidnext else self._max_uid()
+            self._process(self._search('UNSEEN'))
+        self.uidvalidity = uidvalidity
+        self._store_state()
+        self.status.update(connected=True, mode='idle' if self.supports_idle() else 'poll')
+
+    def close(self):
+        conn, self.conn = self.conn, None
+        self.status['connected'] = False
+        if conn is None:
+            return
+        for action in (conn.close, conn.logout):
+            try:
+                action()
+            except Exception:
+                pass
+
+    def supports_idle(self):
+        return self.conn is not None and 'IDLE' in self.conn.capabilities
+
+    def _untagged(self, name):
+        _, data = self.conn.response(name)
+        return data[0] if data and data[0] is not None else None
+
+    def _saved_state(self):
+        value = self.load_state() or ''
+        try:
+            validity, uid = value.split(':', 1)
+            return int(validity), int(uid)
+        except ValueError:
+            return None, 0
+
+    def _store_state(self):
+        self.status['last_uid'] = self.last_uid
+        self.save_state(f"{self.uidvalidity}:{self.last_uid}")
+
+    # -- sync ---------------------------------------------------------------
+
+    def _search(self, criteria):
+        typ, data = self.conn.uid('SEARCH', None, criteria)
+        if typ != 'OK' or not data or not data[0]:
+            return []
+        return sorted(int(uid) for uid in data[0].split())
+
+    def _max_uid(self):
+        uids = self._search('ALL')
+        return uids[-1] if uids else 0
+
+    def sync(self):
+        """Process mail that arrived since the watermark; returns the number of new messages."""
+        # "n:*" always includes the newest message, even when it is below n
+        uids = [uid for uid in self._search(f'UID {self.last_uid + 1}:*') if uid > self.last_uid]
+        self._process(uids)
+        self.status['syncs'] += 1
+        self.status['last_sync'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+        return len(uids)
+
+    def _process(self, uids):
+        """Hand each FETCH batch's replies to on_replies, then move the watermark past the batch.
+
+        If on_replies raises, the batch stays above the watermark and unflagged,
+        so it is fetched again after the reconnect.
+        """
+        for start in range(0, len(uids), IMAP_FETCH_BATCH):
+            batch = uids[start:start + IMAP_FETCH_BATCH]
+            headers = self.fetch_headers(batch)
+            matches = self.match(headers) if headers else {}
+            replies = []
+            for message in headers:
+                lead_id = matches.get(message['uid'])
+                if not lead_id:
+                    continue
+                message['body'] = self.fetch_text(message['uid'])
+                replies.append((lead_id, message))
+            if replies:
+                self.on_replies(replies)
+                self.status['matched'] += len(replies)
+                lead_id, message = replies[-1]
+                self.status['last_processed'] = {'lead_id': lead_id, 'sender': message['sender'],
+                                                 'subject': message['subject'], 'uid': message['uid'],
+                                                 'when': time.strftime('%Y-%m-%dT%H:%M:%S')}
+                if self.mark_seen:
+                    self.conn.uid('STORE', ','.join(str(m['uid']) for _, m in replies), '+FLAGS', '(\\Seen)')
+            self.last_uid = batch[-1]
+            self._store_state()
+
+    def fetch_headers(self, uids):
+        """From/Subject/Message-ID/In-Reply-To/References for many UIDs in one FETCH."""
+        if not uids:
+            return []
+        typ, data = self.conn.uid('FETCH', ','.join(str(u) for u in uids),
+                                  f'(UID BODY.PEEK[HEADER.FIELDS ({HEADER_FIELDS})])')
+        if typ != 'OK':
+            return []
+        parser = BytesHeaderParser()
+        messages = []
+        for item in data:
+            if not isinstance(item, tuple):
+                continue
+            match = UID_RE.search(item[0])
+            if not match:
+                continue
+            headers = parser.parsebytes(item[1])
+            sender = parseaddr(headers.get('From', ''))[1].strip().lower()
+            messages.append({
+                'uid': int(match.group(1)),
+                'sender': sender,
+                'automated': is_automated(headers, sender),
+                'subject': decode_mime_header(headers.get('Subject', '')),
+                'message_id': (headers.get('Message-ID') or '').strip(),
+                'in_reply_to': (headers.get('In-Reply-To') or '').strip(),
+                'references': (headers.get('References') or '').split(),
+            })
+        self.status['fetched_headers'] += len(messages)
+        return messages
+
+    def fetch_text(self, uid):
+        """Download just the text part of one message (text/plain preferred)."""
+        typ, data = self.conn.uid('FETCH', str(uid), '(BODYSTRUCTURE)')
+        if typ != 'OK' or not data:
+            return ''
+        raw = b''.join(part[0] + part[1] if isinstance(part, tuple) else part for part in data if part)
+        parsed = parse_sexp(raw[raw.find(b'('):])
+        items = parsed[0] if parsed and isinstance(parsed[0], list) else []
+        structure = None
+        for i, item in enumerate(items[:-1]):
+            if isinstance(item, bytes) and item.upper() == b'BODYSTRUCTURE':
+                structure = items[i + 1]
+        part = find_text_part(structure) if isinstance(structure, list) else None
+        if not part:
+            return ''
+        number, subtype, charset, encoding = part
+        typ, data = self.conn.uid('FETCH', str(uid), f'(BODY.PEEK[{number}]<0.{IMAP_MAX_BODY_BYTES}>)')
+        payload = b''.join(item[1] for item in data or [] if isinstance(item, tuple))
+        text = decode_part(payload, charset, encoding)
+        return html_to_text(text) if subtype == 'html' else text
+
+    # -- waiting ------------------------------------------------------------
+
+    def _buffered(self):
+        """True if a line can be read without waiting on the socket.
+
+        imaplib reads through a buffered file, so a response that arrived in
+        the same packet as the previous line sits there (or in the SSL
+        layer) where select() can't see it. A non-blocking peek moves
+        anything available into the buffer without ever waiting.
+        """
+        sock = self.conn.socket()
+        timeout = sock.gettimeout()
+        sock.settimeout(0)
+        try:
+            return bool(self.conn.file.peek(1))
+        except (ssl.SSLWantReadError, BlockingIOError):
+            return False
+        finally:
+            sock.settimeout(timeout)
+
+    def idle(self, timeout):
+        """IDLE until the server reports new mail or timeout passes; True if woken by mail.
+
+        imaplib before 3.14 has no IDLE, so the command is driven by hand:
+        send IDLE, wait for the continuation, watch the socket for an
+        untagged EXISTS, then send DONE and read up to the tagged reply.
+        """
+        conn = self.conn
+        tag = f"IDLE{next(self._tags)}".encode()
+        conn.send(tag + b' IDLE\r\n')
+        line = conn.readline()
+        if not line.startswith(b'+'):
+            raise imaplib.IMAP4.error(f"IDLE rejected: {line!r}")
+        woke = False
+        deadline = time.monotonic() + timeout
+        sock = conn.socket()
+        while not woke:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if not self._buffered() and not select.select([sock], [], [], min(remaining, 60))[0]:
+                continue
+            line = conn.readline()
+            if not line:
+                raise imaplib.IMAP4.abort("Connection closed during IDLE")
+            if line.startswith(b'* BYE'):
+                raise imaplib.IMAP4.abort(line.decode(errors='ignore'))
+            woke = b'EXISTS' in line or b'RECENT' in line
+        conn.send(b'DONE\r\n')
+        while True:
+            line = conn.readline()
+            if not line:
+                raise imaplib.IMAP4.abort("Connection closed ending IDLE")
+            if line.startswith(tag):
+                break
+            woke = woke or b'EXISTS' in line
+        if woke:
+            self.status['idle_wakeups'] += 1
+        return woke
+
+    def wait(self):
+        if self.supports_idle():
+            self.idle(self.idle_seconds)
+        else:
+            time.sleep(self.poll_interval)
+            self.conn.noop()
+
+    def run_forever(self):
+        delay = IMAP_RECONNECT_DELAY
+        while True:
+            try:
+                if self.conn is None:
+                    self.open()
+                    delay = IMAP_RECONNECT_DELAY
+                self.sync()
+                self.status['last_error'] = None
+                self.wait()
+            except Exception as exc:
+                self.status['last_error'] = str(exc)
+                self.status['reconnects'] += 1
+                print(f"[IMAP] Reply monitor error: {exc}; reconnecting in {delay:.0f}s")
+                self.close()
+                time.sleep(delay)
+                delay = min(delay * 2, 300)
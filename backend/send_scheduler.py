@@ -0,0 +1,174 @@
+import os
+import uuid
+import heapq
+import threading
+from datetime import datetime, timedelta
+
+import db
+
+# Leads dispatched per batch when many come due at once
+SCHEDULER_BATCH_SIZE = int(os.getenv("SCHEDULER_BATCH_SIZE", "50"))
+# How far ahead the heap is filled from the next_action_at index, and the most items it holds
+SCHEDULER_HORIZON_SECONDS = int(os.getenv("SCHEDULER_HORIZON_SECONDS", "3600"))
+SCHEDULER_HEAP_LIMIT = int(os.getenv("SCHEDULER_HEAP_LIMIT", "5000"))
+# A lead whose dispatch failed is retried after this long
+SCHEDULER_RETRY_SECONDS = int(os.getenv("SCHEDULER_RETRY_SECONDS", "900"))
+# How long a claimed batch belongs to this process; leads of a worker that died come due again after it
+SCHEDULER_LEASE_SECONDS = int(os.getenv("SCHEDULER_LEASE_SECONDS", "600"))
+
+
+class SendScheduler:
+    """Sleeps until the earliest leads.next_action_at and dispatches what is due.
+
+    A min-heap holds the (due_at, lead_id) pairs falling within the horizon.
+    It is refilled from the indexed next_action_at column when it runs dry
+    or every `refill_interval` seconds, so idle leads are never scanned.
+    Sends made by this process call notify() to push the new due time
+    without a database round trip.
+
+    Every process runs its own scheduler over the same table, so due leads
+    are claimed in the database (claim_due_leads: SKIP LOCKED plus a claim
+    token and lease) and a lead popped by several processes is dispatched
+    by only one of them.
+
+    `dispatch(leads)` gets the claimed lead rows of one batch and returns the
+    ids it could not handle; those are rescheduled after retry_seconds.
+    """
+
+    def __init__(self, dispatch, batch_size=None, horizon_seconds=None, refill_interval=None,
+                 heap_limit=None, retry_seconds=None, lease_seconds=None):
+        self.dispatch = dispatch
+        self.batch_size = batch_size or SCHEDULER_BATCH_SIZE
+        self.horizon = horizon_seconds or SCHEDULER_HORIZON_SECONDS
+        self.refill_interval = refill_interval or self.horizon
+        self.heap_limit = heap_limit or SCHEDULER_HEAP_LIMIT
+        self.retry_seconds = retry_seconds or SCHEDULER_RETRY_SECONDS
+        self.lease_seconds = lease_seconds or SCHEDULER_LEASE_SECONDS
+        self.heap = []
+        # lead_id -> due_at of its live heap entry; older entries for the lead are skipped
+        self.due = {}
+        self.condition = threading.Condition()
+        self.horizon_end = datetime.min
+        # Database clock minus ours, measured at each refill
+        self.clock_offset = timedelta(0)
+        self.thread = None
+        self.stats = {'refills': 0, 'dispatched': 0, 'batches': 0, 'failed': 0, 'stale': 0,
+                      'not_claimed': 0, 'last_dispatch_at': None}
+
+    def notify(self, lead_id, due_at):
+        """Record that lead_id is next due at due_at (None: nothing scheduled)."""
+        with self.condition:
+            if due_at is None:
+                self.due.pop(lead_id, None)
+                return
+            if due_at > self.horizon_end:
+                # Beyond what the heap covers; a later refill picks it up from the index
+                self.due.pop(lead_id, None)
+                return
+            self.due[lead_id] = due_at
+            heapq.heappush(self.heap, (due_at, lead_id))
+            self.condition.notify()
+
+    def refill(self):
+        db_now, rows = db.get_next_actions(self.horizon, self.heap_limit)
+        now = datetime.now()
+        if db_now is not None:
+            # NOW() is truncated to the second, so this errs towards firing a moment late,
+            # never before the claim's next_action_at <= NOW() holds
+            self.clock_offset = db_now - now
+        # The heap runs on this process's clock; due times from the table are on the database's
+        rows = [(lead_id, due_at - self.clock_offset) for lead_id, due_at in rows]
+        with self.condition:
+            self.heap = [(due_at, lead_id) for lead_id, due_at in rows]
+            heapq.heapify(self.heap)
+            self.due = {lead_id: due_at for lead_id, due_at in rows}
+            # A full heap may have cut the window short; only trust it up to its last item
+            full = len(rows) >= self.heap_limit
+            self.horizon_end = rows[-1][1] if full else now + timedelta(seconds=self.horizon)
+            self.stats['refills'] += 1
+            self.condition.notify()
+        return len(rows)
+
+    def _pop_due(self, now):
+        batch = []
+        while self.heap and self.heap[0][0] <= now and len(batch) < self.batch_size:
+            due_at, lead_id = heapq.heappop(self.heap)
+            if self.due.get(lead_id) != due_at:
+                self.stats['stale'] += 1
+                continue
+            del self.due[lead_id]
+            batch.append(lead_id)
+        return batch
+
+    def run_once(self):
+        """Dispatch one batch of due leads; returns how many were dispatched."""
+        with self.condition:
+            lead_ids = self._pop_due(datetime.now())
+        if not lead_ids:
+            return 0
+        token = uuid.uuid4().hex
+        leads = db.claim_due_leads(lead_ids, token, self.lease_seconds, self.batch_size)
+        failed = []
+        if leads:
+            try:
+                failed = list(self.dispatch(leads) or [])
+            except Exception as e:
+                print(f"[SCHEDULER] dispatch failed: {e}")
+                failed = [lead['id'] for lead in leads]
+        failed_ids = set(failed)
+        db.release_claimed_leads([lead['id'] for lead in leads if lead['id'] not in failed_ids], token)
+        db.release_claimed_leads(failed, token, self.retry_seconds)
+        for lead_id in failed:
+            self.notify(lead_id, datetime.now() + timedelta(seconds=self.retry_seconds))
+        with self.condition:
+            # Replied, rescheduled or claimed by another process since the heap was filled
+            self.stats['not_claimed'] += len(lead_ids) - len(leads)
+            self.stats['batches'] += 1
+            self.stats['dispatched'] += len(leads) - len(failed)
+            self.stats['failed'] += len(failed)
+            self.stats['last_dispatch_at'] = datetime.now().isoformat()
+        return len(leads)
+
+    def _wait(self, next_refill):
+        """Sleep until the earliest heap item or the next refill, or until notify() pushes an earlier one."""
+        with self.condition:
+            until = next_refill
+            if self.heap and self.heap[0][0] < until:
+                until = self.heap[0][0]
+            wait = (until - datetime.now()).total_seconds()
+            if wait > 0:
+                self.condition.wait(wait)
+
+    def _loop(self):
+        next_refill = datetime.min
+        while True:
+            try:
+                now = datetime.now()
+                if now >= next_refill:
+                    self.refill()
+                    next_refill = now + timedelta(seconds=self.refill_interval)
+                if self.run_once():
+                    continue
+                self._wait(next_refill)
+            except Exception as e:
+                print(f"[SCHEDULER] error: {e}")
+                with self.condition:
+                    self.condition.wait(self.retry_seconds / 10)
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def snapshot(self):
+        with self.condition:
+            upcoming = heapq.nsmallest(5, self.heap)
+            return dict(
+                self.stats,
+                heap_size=len(self.heap),
+                lease_seconds=self.lease_seconds,
+                clock_offset_seconds=self.clock_offset.total_seconds(),
+                horizon_end=self.horizon_end.isoformat() if self.horizon_end != datetime.min else None,
+                next_due=[{'lead_id': lead_id, 'due_at': due_at.isoformat()} for due_at, lead_id in upcoming],
+            )
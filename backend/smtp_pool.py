@@ -0,0 +1,285 @@
+import os
+import time
+import socket
+import smtplib
+import itertools
+import threading
+
+# Authenticated sessions kept open at once
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", "2"))
+# Messages sent on one session before it is replaced (providers cap these)
+SMTP_MAX_MESSAGES_PER_SESSION = int(os.getenv("SMTP_MAX_MESSAGES_PER_SESSION", "100"))
+# An idle session is NOOP-checked before reuse, and closed once idle this long
+SMTP_NOOP_AFTER_SECONDS = float(os.getenv("SMTP_NOOP_AFTER_SECONDS", "30"))
+SMTP_MAX_IDLE_SECONDS = float(os.getenv("SMTP_MAX_IDLE_SECONDS", "240"))
+# Background keepalive sweep interval (0 disables the thread)
+SMTP_KEEPALIVE_INTERVAL = float(os.getenv("SMTP_KEEPALIVE_INTERVAL", "60"))
+SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT", "10"))
+# Longest a send waits for a free session
+SMTP_ACQUIRE_TIMEOUT = float(os.getenv("SMTP_ACQUIRE_TIMEOUT", "60"))
+# Allow a server that doesn't offer STARTTLS (local stand-ins only: the password then goes out in cleartext)
+SMTP_ALLOW_PLAINTEXT = os.getenv("SMTP_ALLOW_PLAINTEXT", "false").lower() in ('1', 'true', 'yes')
+
+SERVICE_NOT_AVAILABLE = 421
+
+
+def default_factory(host, port, timeout):
+    """Open a connection: implicit TLS on 465, otherwise STARTTLS.
+
+    A server that doesn't offer STARTTLS is refused (a stripped STARTTLS
+    would otherwise send the login in cleartext) unless SMTP_ALLOW_PLAINTEXT is set.
+    """
+    if port == 465:
+        return smtplib.SMTP_SSL(host, port, timeout=timeout)
+    server = smtplib.SMTP(host, port, timeout=timeout)
+    try:
+        server.ehlo()
+        if server.has_extn('starttls'):
+            server.starttls()
+            server.ehlo()
+        elif not SMTP_ALLOW_PLAINTEXT:
+            raise smtplib.SMTPNotSupportedError(f"{host}:{port} does not offer STARTTLS")
+    except Exception:
+        server.close()
+        raise
+    return server
+
+
+def is_connection_error(exc):
+    """True when the session is unusable and the send should be retried on a fresh one."""
+    if isinstance(exc, smtplib.SMTPServerDisconnected):
+        return True
+    if isinstance(exc, smtplib.SMTPResponseException) and exc.smtp_code == SERVICE_NOT_AVAILABLE:
+        return True
+    return isinstance(exc, (ConnectionError, socket.timeout, TimeoutError))
+
+
+def close_server(server):
+    """QUIT politely, or just drop the socket if the server is already gone."""
+    try:
+        server.quit()
+    except (smtplib.SMTPException, OSError):
+        try:
+            server.close()
+        except Exception:
+            pass
+
+
+class SMTPSession:
+    """One open, authenticated connection and its usage counters."""
+
+    _ids = itertools.count(1)
+
+    def __init__(self, server):
+        self.id = next(self._ids)
+        self.server = server
+        self.opened_at = time.monotonic()
+        self.last_used = self.opened_at
+        self.messages = 0
+        self.noops = 0
+        self.in_use = False
+
+    def idle_seconds(self, now=None):
+        return (now or time.monotonic()) - self.last_used
+
+    def noop(self):
+        """True if the server still answers on this connection."""
+        self.noops += 1
+        try:
+            code, _ = self.server.noop()
+        except (smtplib.SMTPException, OSError):
+            return False
+        return code == 250
+
+    def close(self):
+        close_server(self.server)
+
+    def info(self, now=None):
+        now = now or time.monotonic()
+        return {
+            'id': self.id,
+            'messages': self.messages,
+            'noops': self.noops,
+            'age_seconds': round(now - self.opened_at, 1),
+            'idle_seconds': round(self.idle_seconds(now), 1),
+            'in_use': self.in_use,
+        }
+
+
+class SMTPConnectionPool:
+    """Pool of authenticated SMTP sessions shared by every sender.
+
+    Sessions are reused LIFO, NOOP-checked when they have been idle, replaced
+    after max_messages sends, and reopened transparently when the server
+    drops the connection or answers 421. `factory(host, port, timeout)` opens
+    an unauthenticated connection; pass a stand-in to test without a server.
+    """
+
+    def __init__(self, host, port, username=None, password=None, size=None, max_messages=None,
+                 noop_after=None, max_idle=None, timeout=None, factory=None, keepalive_interval=None):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.size = size or SMTP_POOL_SIZE
+        self.max_messages = max_messages or SMTP_MAX_MESSAGES_PER_SESSION
+        self.noop_after = SMTP_NOOP_AFTER_SECONDS if noop_after is None else noop_after
+        self.max_idle = SMTP_MAX_IDLE_SECONDS if max_idle is None else max_idle
+        self.timeout = timeout or SMTP_TIMEOUT
+        self.factory = factory or default_factory
+        self.keepalive_interval = SMTP_KEEPALIVE_INTERVAL if keepalive_interval is None else keepalive_interval
+        self.slots = threading.BoundedSemaphore(self.size)
+        self.lock = threading.Lock()
+        self.idle = []
+        self.active = {}
+        self._keepalive_thread = None
+        self.counters = {'opened': 0, 'logins': 0, 'sent': 0, 'failed': 0, 'reconnects': 0,
+                         'noops': 0, 'noop_failures': 0, 'rotated': 0, 'idle_closed': 0}
+
+    def _count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def _open(self):
+        server = self.factory(self.host, self.port, self.timeout)
+        self._count('opened')
+        if self.username and self.password:
+            try:
+                server.login(self.username, self.password)
+            except Exception:
+                close_server(server)
+                raise
+            self._count('logins')
+        session = SMTPSession(server)
+        self._start_keepalive()
+        return session
+
+    def _checkout(self):
+        """An idle session that still answers, or a new one."""
+        while True:
+            with self.lock:
+                session = self.idle.pop() if self.idle else None
+            if session is None:
+                return self._open()
+            idle = session.idle_seconds()
+            if idle > self.max_idle:
+                session.close()
+                self._count('idle_closed')
+                continue
+            if idle > self.noop_after:
+                self._count('noops')
+                if not session.noop():
+                    self._count('noop_failures')
+                    session.close()
+                    continue
+            return session
+
+    def _checkin(self, session, healthy=True):
+        session.in_use = False
+        session.last_used = time.monotonic()
+        with self.lock:
+            self.active.pop(session.id, None)
+        if not healthy:
+            session.close()
+        elif session.messages >= self.max_messages:
+            session.close()
+            self._count('rotated')
+        else:
+            with self.lock:
+                self.idle.append(session)
+
+    def send_message(self, msg, from_addr=None, to_addrs=None):
+        """Send one email.message.Message. Raises the SMTP error if it can't be delivered."""
+        if not self.slots.acquire(timeout=SMTP_ACQUIRE_TIMEOUT):
+            self._count('failed')
+            raise TimeoutError("No SMTP session became available")
+        try:
+            for attempt in range(2):
+                session = None
+                try:
+                    session = self._checkout()
+                    session.in_use = True
+                    with self.lock:
+                        self.active[session.id] = session
+                    session.server.send_message(msg, from_addr, to_addrs)
+                except Exception as e:
+                    if session is not None:
+                        self._checkin(session, healthy=not is_connection_error(e))
+                    if attempt == 0 and is_connection_error(e):
+                        # Dropped session or 421: reconnect once and resend
+                        self._count('reconnects')
+                        continue
+                    self._count('failed')
+                    raise
+                session.messages += 1
+                self._checkin(session)
+                self._count('sent')
+                return True
+        finally:
+            self.slots.release()
+
+    def keepalive(self):
+        """NOOP sessions that have been idle for a while and close stale or dead ones."""
+        with self.lock:
+            sessions, self.idle = self.idle, []
+        keep = []
+        now = time.monotonic()
+        for session in sessions:
+            idle = session.idle_seconds(now)
+            if idle > self.max_idle:
+                session.close()
+                self._count('idle_closed')
+            elif idle > self.noop_after:
+                self._count('noops')
+                if session.noop():
+                    keep.append(session)
+                else:
+                    self._count('noop_failures')
+                    session.close()
+            else:
+                keep.append(session)
+        with self.lock:
+            self.idle = keep + self.idle
+            extra = self.idle[:max(0, len(self.idle) - self.size)]
+            del self.idle[:len(extra)]
+        for session in extra:
+            session.close()
+
+    def _start_keepalive(self):
+        if not self.keepalive_interval or self._keepalive_thread is not None:
+            return
+        with self.lock:
+            if self._keepalive_thread is not None:
+                return
+
+            def loop():
+                while True:
+                    time.sleep(self.keepalive_interval)
+                    try:
+                        self.keepalive()
+                    except Exception as e:
+                        print(f"[SMTP-POOL] keepalive failed: {e}")
+
+            self._keepalive_thread = threading.Thread(target=loop, daemon=True)
+            self._keepalive_thread.start()
+
+    def close_all(self):
+        with self.lock:
+            sessions, self.idle = self.idle, []
+        for session in sessions:
+            session.close()
+
+    def stats(self):
+        now = time.monotonic()
+        with self.lock:
+            connections = [s.info(now) for s in self.idle] + [s.info(now) for s in self.active.values()]
+            counters = dict(self.counters)
+        return {
+            'host': self.host,
+            'port': self.port,
+            'size': self.size,
+            'max_messages_per_session': self.max_messages,
+            'open_sessions': len(connections),
+            'connections': sorted(connections, key=lambda c: c['id']),
+            **counters,
+        }
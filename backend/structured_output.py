@@ -0,0 +1,298 @@
+import re
+import ast
+import json
+import threading
+from collections import defaultdict
+
+from json_extract import iter_json_values, SpanScanner
+
+# Longest broken fragment sent back to the model in a repair re-ask
+REPAIR_MAX_CHARS = 6000
+
+_FENCE_RE = re.compile(r'^\s*```[a-zA-Z0-9_-]*\s*\n?|\n?\s*```\s*$')
+_TRAILING_COMMA_RE = re.compile(r',\s*([}\]])')
+_SMART_QUOTES = str.maketrans({'“': '"', '”': '"', '‘': "'", '’': "'"})
+_WRAPPER_KEYS = ('leads', 'results', 'data', 'items')
+
+STAGE_PARSED = 'parsed'
+STAGE_LOCAL_REPAIR = 'local_repair'
+STAGE_REASK = 'reask'
+
+
+class StructuredOutputError(ValueError):
+    """The model output could not be parsed/validated, even after repair."""
+
+    def __init__(self, agent, errors, raw=None):
+        super().__init__(f"{agent}: {'; '.join(errors) if errors else 'invalid output'}")
+        self.agent = agent
+        self.errors = errors
+        self.raw = raw
+
+
+class Field:
+    """One key of a schema object.
+
+    kind: int, float, str, list or dict. choices are matched
+    case-insensitively and normalized to the spelling given here.
+    """
+
+    TYPE_NAMES = {int: 'integer', float: 'number', str: 'string', list: 'array', dict: 'object'}
+
+    def __init__(self, kind=str, required=False, choices=None, minimum=None, maximum=None, description=None):
+        self.kind = kind
+        self.required = required
+        self.choices = tuple(choices) if choices else None
+        self.minimum = minimum
+        self.maximum = maximum
+        self.description = description
+
+    def describe(self):
+        if self.choices:
+            text = 'one of ' + ', '.join(f"'{c}'" for c in self.choices)
+        else:
+            text = self.TYPE_NAMES.get(self.kind, 'value')
+            if self.minimum is not None and self.maximum is not None:
+                text += f" {self.minimum}-{self.maximum}"
+        if self.description:
+            text += f" ({self.description})"
+        if not self.required:
+            text += ', or null'
+        return text
+
+    def coerce(self, value):
+        """Return (value, error)."""
+        if value is None or value == '':
+            return None, 'is required' if self.required else None
+        try:
+            if self.kind is int:
+                value = int(round(float(value)))
+            elif self.kind is float:
+                value = float(value)
+            elif self.kind is str:
+                value = value if isinstance(value, str) else json.dumps(value) if isinstance(value, (dict, list)) else str(value)
+                value = value.strip()
+            elif self.kind is list and not isinstance(value, list):
+                value = [value]
+            elif self.kind is dict and not isinstance(value, dict):
+                return None, 'must be an object'
+        except (TypeError, ValueError, OverflowError):
+            return None, f"must be {self.TYPE_NAMES.get(self.kind, 'valid')}"
+        if self.choices:
+            match = next((c for c in self.choices if str(c).lower() == str(value).strip().lower()), None)
+            if match is None:
+                return None, f"must be one of {', '.join(map(str, self.choices))}"
+            value = match
+        if self.minimum is not None and value < self.minimum:
+            value = self.minimum
+        if self.maximum is not None and value > self.maximum:
+            value = self.maximum
+        return value, None
+
+
+class Schema:
+    """Expected shape of an agent's output: one object, or a list of objects (many=True)."""
+
+    def __init__(self, name, fields=None, many=False, allow_extra=True):
+        self.name = name
+        self.fields = fields or {}
+        self.many = many
+        self.allow_extra = allow_extra
+
+    def instructions(self):
+        shape = 'a JSON array of objects' if self.many else 'a single JSON object'
+        lines = [f"Return ONLY {shape} (no markdown, no commentary)."]
+        if self.fields:
+            lines.append('Keys:')
+            lines.extend(f"- {key}: {field.describe()}" for key, field in self.fields.items())
+        return '\n'.join(lines)
+
+    def validate_item(self, item):
+        """Return (normalized_item, errors) for one object."""
+        if not isinstance(item, dict):
+            return None, ['expected an object']
+        out = dict(item) if self.allow_extra else {}
+        errors = []
+        for key, field in self.fields.items():
+            value, error = field.coerce(item.get(key))
+            if error:
+                errors.append(f"{key} {error}")
+            out[key] = value
+        return (None, errors) if errors else (out, [])
+
+    def validate(self, value):
+        """Return (normalized_value, errors). For many=True invalid items are
+        dropped and reported; the result is an error only if nothing survives."""
+        if self.many:
+            if isinstance(value, dict):
+                wrapped = next((value[k] for k in _WRAPPER_KEYS if isinstance(value.get(k), list)), None)
+                value = wrapped if wrapped is not None else [value]
+            if not isinstance(value, list):
+                return None, ['expected a JSON array']
+            items, errors = [], []
+            for i, item in enumerate(value):
+                normalized, item_errors = self.validate_item(item)
+                if normalized is None:
+                    errors.extend(f"[{i}] {e}" for e in item_errors)
+                else:
+                    items.append(normalized)
+            if not items and value:
+                return None, errors
+            return items, errors
+        if isinstance(value, list) and len(value) == 1:
+            value = value[0]
+        return self.validate_item(value)
+
+
+def build_prompt(task, schema):
+    """Task text followed by the schema's output instructions."""
+    return f"{task.strip()}\n\n{schema.instructions()}\n"
+
+
+def strip_fences(text):
+    return _FENCE_RE.sub('', (text or '').strip())
+
+
+def _candidates(text, schema):
+    """JSON values found in the text, preferred shape first."""
+    values = [v for v, _, _ in iter_json_values(text)]
+    preferred = list if schema.many else dict
+    candidates = [v for v in values if isinstance(v, preferred)]
+    others = [v for v in values if not isinstance(v, preferred)]
+    if schema.many and others and all(isinstance(v, dict) for v in others):
+        # Loose objects (e.g. the complete items of a truncated array) form one list
+        others = [others]
+    return candidates + others
+
+
+def _json_region(text):
+    """The part of a response that was meant to be JSON (first opener to the end)."""
+    text = strip_fences(text)
+    m = re.search(r'[\[{]', text)
+    return text[m.start():] if m else text
+
+
+def broken_fragment(text):
+    return _json_region(text)[:REPAIR_MAX_CHARS]
+
+
+def repair_json_text(text):
+    """Lightweight local repair: smart quotes, trailing commas, Python literals
+    and unclosed brackets (truncated output). Returns a value or None."""
+    fragment = _json_region(text).translate(_SMART_QUOTES)
+    fragment = _TRAILING_COMMA_RE.sub(r'\1', fragment)
+    try:
+        return json.loads(fragment)
+    except ValueError:
+        pass
+    try:
+        value = ast.literal_eval(fragment)
+        if isinstance(value, (dict, list)):
+            return json.loads(json.dumps(value))
+    except (ValueError, SyntaxError, TypeError, MemoryError, RecursionError):
+        pass
+
+    # Truncated output: drop the dangling partial element and close what is open
+    scanner = SpanScanner()
+    scanner.feed(fragment)
+    if not scanner.stack:
+        return None
+    ends = [span[1] for frame in scanner.stack for span in frame.children]
+    cut = max(ends + [fragment.rfind(',')])
+    if cut <= 0:
+        return None
+    head = fragment[:cut].rstrip().rstrip(',')
+    scanner = SpanScanner()
+    scanner.feed(head)
+    closers = ''.join(']' if f.char == '[' else '}' for f in reversed(scanner.stack))
+    try:
+        return json.loads(_TRAILING_COMMA_RE.sub(r'\1', head + closers))
+    except ValueError:
+        return None
+
+
+def parse(text, schema):
+    """Parse and validate without any model call.
+
+    Returns (value, errors, stage) where stage is 'parsed' or 'local_repair';
+    value is None when nothing valid could be recovered.
+    """
+    cleaned = strip_fences(text)
+    errors = []
+    try:
+        candidates = [json.loads(cleaned)]
+    except ValueError:
+        candidates = _candidates(cleaned, schema)
+    for candidate in candidates:
+        value, errors = schema.validate(candidate)
+        if value is not None:
+            return value, errors, STAGE_PARSED
+    repaired = repair_json_text(cleaned)
+    if repaired is not None:
+        value, errors = schema.validate(repaired)
+        if value is not None:
+            return value, errors, STAGE_LOCAL_REPAIR
+    return None, errors or ['no JSON found'], None
+
+
+def repair_prompt(schema, fragment, errors):
+    problems = '; '.join(errors[:10]) if errors else 'not valid JSON'
+    return (
+        "The following output was supposed to be valid JSON but is broken "
+        f"({problems}). Fix it without adding new information.\n\n"
+        f"{schema.instructions()}\n\nBroken output:\n{fragment}\n"
+    )
+
+
+class ParseStats:
+    """Per-agent parse outcome counters."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = defaultdict(lambda: defaultdict(int))
+
+    def record(self, agent, outcome):
+        with self.lock:
+            self.counts[agent]['calls'] += 1
+            self.counts[agent][outcome] += 1
+
+    def snapshot(self):
+        with self.lock:
+            out = {}
+            for agent, counts in self.counts.items():
+                calls = counts['calls']
+                out[agent] = dict(counts)
+                out[agent]['parse_failure_rate'] = round(1 - counts[STAGE_PARSED] / calls, 4) if calls else 0.0
+                out[agent]['final_failure_rate'] = round(counts['failed'] / calls, 4) if calls else 0.0
+            return out
+
+
+PARSE_STATS = ParseStats()
+
+
+def generate(agent, prompt, schema, generate_fn, reask=True, on_invalid=None):
+    """Run one structured agent call.
+
+    generate_fn(prompt, repair=False) -> response text. If the response can't
+    be parsed even after local repair, the broken fragment alone (not the
+    original prompt) is sent back once for repair. on_invalid() is called
+    right after each response that could not be parsed. Returns (value,
+    raw_text, stage); raises StructuredOutputError when nothing valid comes back.
+    """
+    raw = generate_fn(prompt, repair=False)
+    value, errors, stage = parse(raw, schema)
+    if value is None and on_invalid:
+        on_invalid()
+    if value is None and reask and raw:
+        fixed = generate_fn(repair_prompt(schema, broken_fragment(raw), errors), repair=True)
+        value, errors, stage = parse(fixed, schema)
+        if value is not None:
+            stage = STAGE_REASK
+        elif on_invalid:
+            on_invalid()
+    if value is None:
+        PARSE_STATS.record(agent, 'failed')
+        raise StructuredOutputError(agent, errors, raw)
+    PARSE_STATS.record(agent, stage)
+    if errors:
+        print(f"[STRUCTURED] {agent}: dropped invalid items: {'; '.join(errors[:5])}")
+    return value, raw, stage
@@ -0,0 +1,125 @@
+import os
+import re
+import html
+import threading
+from collections import OrderedDict
+
+# Compiled subjects/bodies kept in memory (least recently used are dropped)
+TEMPLATE_CACHE_SIZE = int(os.getenv("TEMPLATE_CACHE_SIZE", "512"))
+
+# {name} in built-in and drip templates; saved email templates only use {{name}}
+PLACEHOLDER_RE = re.compile(r'\{([A-Za-z_]\w*)\}')
+SAVED_PLACEHOLDER_RE = re.compile(r'\{\{\s*([A-Za-z_]\w*)\s*\}\}')
+# Context lookups that find no value at all, as opposed to None
+_MISSING = object()
+PARAGRAPH_BREAK = '</p><p>'
+
+
+def text_to_html(text):
+    """Escape text and turn each line into a paragraph (the body of build_html_body)."""
+    return '<p>' + html.escape(text or '').replace('\n', PARAGRAPH_BREAK) + '</p>'
+
+
+def _format_literal(text):
+    return text.replace('{', '{{').replace('}', '}}')
+
+
+class CompiledTemplate:
+    """A subject or body parsed once into a positional format string.
+
+    `pattern` picks the placeholder syntax; any other braces are literal text.
+    render() fills placeholders from a context dict: None values render
+    empty, names the context does not have are left as written. render_pair() also returns the paragraph HTML that
+    build_html_body wraps; escaping the rendered text in one pass escapes
+    every value and is cheaper than escaping values one by one.
+    """
+
+    __slots__ = ('source', 'pattern', 'fields', 'text_format')
+
+    def __init__(self, source, pattern=PLACEHOLDER_RE):
+        self.source = source or ''
+        self.pattern = pattern
+        self.fields = []
+        parts = []
+        pos = 0
+        for match in pattern.finditer(self.source):
+            parts.append(_format_literal(self.source[pos:match.start()]))
+            parts.append(f"{{{len(self.fields)}}}")
+            self.fields.append((match.group(1), match.group()))
+            pos = match.end()
+        parts.append(_format_literal(self.source[pos:]))
+        self.text_format = ''.join(parts)
+
+    def render(self, context):
+        get = context.get
+        return self.text_format.format(*[
+            literal if (value := get(field, _MISSING)) is _MISSING else '' if value is None else value
+            for field, literal in self.fields
+        ])
+
+    def render_html(self, context):
+        return text_to_html(self.render(context))
+
+    def render_pair(self, context):
+        text = self.render(context)
+        return text, text_to_html(text)
+
+
+class TemplateCache:
+    """LRU of compiled templates keyed by (key, version).
+
+    key identifies the template (e.g. ('email_template', 12, 'body')); a new
+    version, or a changed source for templates without a version, replaces
+    the cached entry. Without a key the source text itself is the key, which
+    suits the built-in constant templates. Pass pattern=SAVED_PLACEHOLDER_RE
+    for saved email templates.
+    """
+
+    def __init__(self, max_size=None):
+        self.max_size = max_size or TEMPLATE_CACHE_SIZE
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'compiles': 0}
+
+    def _lookup(self, cache_key, source, version, pattern):
+        entry = self.entries.get(cache_key)
+        if entry is not None and entry[0] == version and entry[1].source == source and entry[1].pattern is pattern:
+            self.entries.move_to_end(cache_key)
+            self.stats['hits'] += 1
+            return entry[1]
+        return None
+
+    def _store(self, cache_key, source, version, pattern):
+        compiled = CompiledTemplate(source, pattern)
+        with self.lock:
+            self.entries[cache_key] = (version, compiled)
+            self.entries.move_to_end(cache_key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+            self.stats['compiles'] += 1
+        return compiled
+
+    def compile(self, source, key=None, version=None, pattern=PLACEHOLDER_RE):
+        source = source or ''
+        cache_key = key if key is not None else source
+        with self.lock:
+            compiled = self._lookup(cache_key, source, version, pattern)
+        return compiled or self._store(cache_key, source, version, pattern)
+
+    def compile_message(self, subject, body, key=None, version=None, pattern=PLACEHOLDER_RE):
+        """Compiled (subject, body) pair."""
+        subject, body = subject or '', body or ''
+        subject_key = (key, 'subject') if key is not None else subject
+        body_key = (key, 'body') if key is not None else body
+        with self.lock:
+            subject_t = self._lookup(subject_key, subject, version, pattern)
+            body_t = self._lookup(body_key, body, version, pattern)
+        return (subject_t or self._store(subject_key, subject, version, pattern),
+                body_t or self._store(body_key, body, version, pattern))
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats, cached=len(self.entries), max_size=self.max_size)
+
+
+TEMPLATES = TemplateCache()
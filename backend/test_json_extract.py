@@ -0,0 +1,72 @@
+import json
+
+from json_extract import JSONStreamExtractor, iter_json_values
+
+
+def feed_all(text, chunk_size):
+    extractor = JSONStreamExtractor()
+    during = []
+    for i in range(0, len(text), chunk_size):
+        during.extend(extractor.feed(text[i:i + chunk_size]))
+    return extractor, during, extractor.close()
+
+
+def test_values_arrive_during_feed_after_unmatched_opener():
+    leads = [{'company': f'Company {i} [main]', 'email': f'info{i}@company{i}.in'} for i in range(200)]
+    text = 'Here (see [1 and {"note": 1} ' + ' '.join(json.dumps(lead) for lead in leads)
+    extractor, during, at_close = feed_all(text, 256)
+    assert len(during) == 201
+    assert at_close == []
+    assert during == [value for value, _, _ in iter_json_values(text)]
+    # Nothing of the stale bracket's text is held on to
+    assert extractor.chunks == []
+
+
+def test_open_array_is_returned_whole():
+    leads = [{'company': f'Company {i}', 'email': f'info{i}@company{i}.in'} for i in range(50)]
+    _, during, at_close = feed_all('Sure: ' + json.dumps(leads) + ' done', 256)
+    assert during == [leads]
+    assert at_close == []
+
+
+def test_stream_matches_single_pass():
+    text = 'x {"leads": [{"a": 1}, {"b": [1, 2, {"c": "]"}]}], "n": 3} y [1, 2] (a [b] {"q": 1}'
+    expected = [value for value, _, _ in iter_json_values(text)]
+    for chunk_size in (1, 5, 256):
+        _, during, at_close = feed_all(text, chunk_size)
+        assert during + at_close == expected
+
+
+def test_recovers_after_raw_newline_in_string():
+    text = '{"a": "line\nbreak"} {"ok":true}'
+    assert [value for value, _, _ in iter_json_values(text)] == [{'ok': True}]
+    _, during, at_close = feed_all(text, 4)
+    assert during + at_close == [{'ok': True}]
+
+
+def test_recovers_after_stray_quote_in_prose_bracket():
+    text = 'Result [see "quote] then {"company":"Acme","email":"a@acme.com"}'
+    lead = {'company': 'Acme', 'email': 'a@acme.com'}
+    assert [value for value, _, _ in iter_json_values(text)] == [lead]
+    _, during, at_close = feed_all(text, 4)
+    assert during + at_close == [lead]
+
+
+def test_truncated_array_yields_complete_elements():
+    leads = [{'company': f'Company {i} [main]', 'email': f'info{i}@company{i}.in'} for i in range(100)]
+    text = 'Sure: {"leads": ' + json.dumps(leads)[:-40]
+    values = [value for value, _, _ in iter_json_values(text)]
+    assert values == leads[:len(values)]
+    assert len(values) == 99
+
+
+def test_json_after_stray_quote_is_found():
+    text = 'He said [ "hello ] {"a": 1} and {"x": [1, 2], "y": oops'
+    assert [value for value, _, _ in iter_json_values(text)] == [{'a': 1}, [1, 2]]
+
+
+def test_deep_nesting_does_not_raise():
+    text = '[' * 100000 + ']' * 100000 + ' {"ok": 1}'
+    assert [value for value, _, _ in iter_json_values(text)] == [{'ok': 1}]
+    _, during, at_close = feed_all('[' * 2000 + ']' * 2000 + ' {"ok": 1}', 4096)
+    assert (during + at_close)[-1] == {'ok': 1}
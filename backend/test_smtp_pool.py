@@ -0,0 +1,121 @@
+import smtplib
+from email.message import EmailMessage
+
+import pytest
+
+import smtp_pool
+from smtp_pool import SMTPConnectionPool
+
+
+class FakeServer:
+    """Stand-in for smtplib.SMTP; `fail_with` is raised by the next send_message."""
+
+    def __init__(self, fail_with=None, login_error=None):
+        self.fail_with = fail_with
+        self.login_error = login_error
+        self.sent = []
+        self.closed = False
+
+    def login(self, username, password):
+        if self.login_error:
+            raise self.login_error
+
+    def send_message(self, msg, from_addr=None, to_addrs=None):
+        if self.fail_with:
+            error, self.fail_with = self.fail_with, None
+            raise error
+        self.sent.append(msg)
+
+    def noop(self):
+        return 250, b'OK'
+
+    def quit(self):
+        self.closed = True
+
+    def close(self):
+        self.closed = True
+
+
+def make_pool(servers, **kwargs):
+    opened = []
+
+    def factory(host, port, timeout):
+        server = servers.pop(0) if servers else FakeServer()
+        opened.append(server)
+        return server
+
+    pool = SMTPConnectionPool('smtp.test', 587, 'user', 'secret', factory=factory, keepalive_interval=0, **kwargs)
+    return pool, opened
+
+
+def message():
+    msg = EmailMessage()
+    msg['To'] = 'lead@example.com'
+    msg.set_content('hi')
+    return msg
+
+
+def test_session_is_reused():
+    pool, opened = make_pool([])
+    for _ in range(3):
+        pool.send_message(message())
+    assert len(opened) == 1
+    assert len(opened[0].sent) == 3
+    assert pool.stats()['logins'] == 1
+
+
+def test_421_reconnects_and_resends_once():
+    busy = smtplib.SMTPResponseException(421, b'Service not available')
+    pool, opened = make_pool([FakeServer(fail_with=busy)])
+    pool.send_message(message())
+    assert len(opened) == 2
+    assert opened[0].closed and not opened[0].sent
+    assert len(opened[1].sent) == 1
+    stats = pool.stats()
+    assert stats['reconnects'] == 1 and stats['sent'] == 1 and stats['failed'] == 0
+
+
+def test_rejected_recipient_is_not_retried():
+    rejected = smtplib.SMTPRecipientsRefused({'lead@example.com': (550, b'User unknown')})
+    pool, opened = make_pool([FakeServer(fail_with=rejected)])
+    with pytest.raises(smtplib.SMTPRecipientsRefused):
+        pool.send_message(message())
+    assert len(opened) == 1
+    assert pool.stats()['failed'] == 1
+
+
+def test_session_is_rotated_after_max_messages():
+    pool, opened = make_pool([], max_messages=2)
+    for _ in range(5):
+        pool.send_message(message())
+    assert [len(server.sent) for server in opened] == [2, 2, 1]
+    assert opened[0].closed and opened[1].closed and not opened[2].closed
+    assert pool.stats()['rotated'] == 2
+
+
+def test_failed_login_closes_connection():
+    denied = smtplib.SMTPAuthenticationError(535, b'Bad credentials')
+    pool, opened = make_pool([FakeServer(login_error=denied)])
+    with pytest.raises(smtplib.SMTPAuthenticationError):
+        pool.send_message(message())
+    assert opened[0].closed
+
+
+class NoStartTLS(FakeServer):
+    def __init__(self, host, port, timeout=None):
+        super().__init__()
+
+    def ehlo(self):
+        pass
+
+    def has_extn(self, name):
+        return False
+
+
+def test_default_factory_requires_starttls(monkeypatch):
+    monkeypatch.setattr(smtplib, 'SMTP', NoStartTLS)
+    monkeypatch.setattr(smtp_pool, 'SMTP_ALLOW_PLAINTEXT', False)
+    with pytest.raises(smtplib.SMTPNotSupportedError):
+        smtp_pool.default_factory('smtp.test', 587, 5)
+    monkeypatch.setattr(smtp_pool, 'SMTP_ALLOW_PLAINTEXT', True)
+    assert isinstance(smtp_pool.default_factory('smtp.test', 587, 5), NoStartTLS)
@@ -0,0 +1,21 @@
+from templating import CompiledTemplate, TemplateCache, SAVED_PLACEHOLDER_RE
+
+
+def test_saved_templates_only_fill_double_braces():
+    t = CompiledTemplate("Hi {{ name }}, {name} stays as written", SAVED_PLACEHOLDER_RE)
+    assert t.render({'name': 'Asha'}) == "Hi Asha, {name} stays as written"
+
+
+def test_unknown_placeholders_are_left_literal():
+    saved = CompiledTemplate("{{company}} / {{unknown}}", SAVED_PLACEHOLDER_RE)
+    assert saved.render({'company': None}) == " / {{unknown}}"
+    builtin = CompiledTemplate("Hello {name}, {other} {")
+    assert builtin.render({'name': 'Acme'}) == "Hello Acme, {other} {"
+
+
+def test_cache_keeps_syntaxes_apart():
+    cache = TemplateCache()
+    builtin = cache.compile("Hi {name}")
+    saved = cache.compile("Hi {name}", pattern=SAVED_PLACEHOLDER_RE)
+    assert builtin.render({'name': 'A'}) == "Hi A"
+    assert saved.render({'name': 'A'}) == "Hi {name}"
@@ -116,7 +116,7 @@ const LeadsTable = ({ leads = [], onRefresh, loading = false }) => {
         lead_ids: selectedLeads,
         mode: 'ai' 
       });
-      alert(`Outreach process complete!\nSent: ${response.data.sent}\nFailed: ${response.data.failed}${response.data.dry_runs > 0 ? `\n(Note: ${response.data.dry_runs} were dry runs)` : ''}`);
+      alert(`Outreach queued!\nQueued: ${response.data.queued}\nFailed: ${response.data.failed}${response.data.duplicates > 0 ? `\n(${response.data.duplicates} already queued earlier)` : ''}`);
       if (onRefresh) onRefresh();
       setSelectedLeads([]);
     } catch (error) {
@@ -131,7 +131,7 @@ const LeadsTable = ({ leads = [], onRefresh, loading = false }) => {
     if (!window.confirm("Send AI-personalized outreach to this lead?")) return;
     try {
       const res = await api.post(`/outreach/${id}`, { outreach_type: 'ai' });
-      alert("Outreach sent successfully!");
+      alert("Outreach queued for sending!");
       if (onRefresh) onRefresh();
     } catch (error) {
       console.error("Outreach failed", error);
@@ -77,13 +77,13 @@ const Templates = () => {
             </div>
             <div>
               <label className="block text-sm font-medium text-gray-700 mb-1">
-                Email Body <span className="text-xs text-gray-500 font-normal">(Use {'{name}'} and {'{company}'} as placeholders)</span>
+                Email Body <span className="text-xs text-gray-500 font-normal">(Use {'{{name}}'} and {'{{company}}'} as placeholders)</span>
               </label>
               <textarea
                 value={newTemplate.body}
                 onChange={(e) => setNewTemplate({ ...newTemplate, body: e.target.value })}
                 className="w-full p-2 border rounded focus:ring-blue-500 focus:border-blue-500 h-48"
-                placeholder="Hi {name}, ..."
+                placeholder="Hi {{name}}, ..."
                 required
               />
             </div>